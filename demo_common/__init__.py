@@ -0,0 +1,5 @@
+"""Modules shared by the MFA demo apps (mfa-totp and mfa-cac).
+
+The apps put the repository root on sys.path to import them; the mfa-cac
+Docker setup mounts this directory next to /app.
+"""
@@ -0,0 +1,56 @@
+"""Responses for nginx auth_request checks of the MFA demo apps.
+
+nginx calls GET /auth before every request it proxies to the apps it
+gates, so the check only reads the session, renders nothing, and answers
+with a bare status: 200 (with the user in X-Auth-User) or 401.
+
+Allowed decisions carry X-Accel-Expires, which nginx's proxy_cache
+honours over Cache-Control, so a cache keyed by the session cookie can
+answer for ttl seconds without calling the app; a logout then takes up
+to ttl seconds to reach the cached decision. Cache-Control stays private
+so no other cache keeps them. Denials are never cached, so a user is let
+in as soon as they log in. A decision that does not come from the
+session must be sent with ttl 0: requests without a cookie all share
+the empty cache key.
+
+    location = /_auth {
+        internal;
+        proxy_pass http://flaskapp:8000/auth;
+        proxy_pass_request_body off;
+        proxy_set_header Content-Length "";
+        proxy_cache auth_cache;
+        proxy_cache_key $cookie_session;
+        # proxy_cache_path /var/cache/nginx/auth keys_zone=auth_cache:1m;
+    }
+    location /app/ {
+        auth_request /_auth;
+        auth_request_set $auth_user $upstream_http_x_auth_user;
+        proxy_set_header X-Auth-User $auth_user;
+        proxy_pass http://backend;
+    }
+"""
+import hmac
+
+
+def decision_response(app, username, ttl, headers=None):
+    """An empty 200 for username, or 401 if username is None."""
+    if username is None:
+        response = app.response_class(status=401)
+        response.headers['X-Accel-Expires'] = '0'
+        response.cache_control.no_store = True
+        return response
+    response = app.response_class(status=200)
+    response.headers['X-Auth-User'] = username
+    response.headers.update(headers or {})
+    response.headers['X-Accel-Expires'] = str(ttl)
+    response.cache_control.private = True
+    response.cache_control.max_age = ttl
+    return response
+
+
+def bearer_token_matches(request, token):
+    """True if the request carries `Authorization: Bearer <token>`; never for an unset token."""
+    if not token:
+        return False
+    scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
@@ -0,0 +1,97 @@
+"""Per-request overhead of the session backends of the MFA demo apps.
+
+Runs a minimal Flask app through its test client with each backend and
+reports the time per request of reading and of writing the session, on
+top of a request with no session at all, and the size of the cookie. It
+also replays a session cookie after logout, which only server-side
+sessions can refuse.
+
+Usage:
+    python3 bench_sessions.py --requests 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask, session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.sessions import MemorySessionStore, ServerSessionInterface, SqliteSessionStore, TieredSessionStore
+
+
+def make_app(session_interface):
+    app = Flask(__name__)
+    app.secret_key = 'bench_secret_key'
+    if session_interface:
+        app.session_interface = session_interface
+
+    @app.route('/none')
+    def no_session():
+        return ''
+
+    @app.route('/login')
+    def login():
+        session['authenticated'] = True
+        session['username'] = 'demo'
+        session['totp_verified'] = True
+        return ''
+
+    @app.route('/read')
+    def read():
+        return 'yes' if session.get('totp_verified') else 'no'
+
+    @app.route('/write')
+    def write():
+        session['counter'] = session.get('counter', 0) + 1
+        return ''
+
+    @app.route('/logout')
+    def logout():
+        session.clear()
+        return ''
+
+    return app
+
+
+def per_request(client, path, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(path)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    backends = (
+        ('cookie', None),
+        ('memory', ServerSessionInterface(MemorySessionStore())),
+        ('sqlite', ServerSessionInterface(SqliteSessionStore(os.path.join(directory, 'plain.db')))),
+        ('sqlite + memory', ServerSessionInterface(TieredSessionStore(
+            SqliteSessionStore(os.path.join(directory, 'tiered.db'))))),
+    )
+    for label, session_interface in backends:
+        app = make_app(session_interface)
+        client = app.test_client()
+        baseline = per_request(client, '/none', args.requests)
+        client.get('/login')
+        cookie = client.get_cookie('session')
+        read = per_request(client, '/read', args.requests)
+        write = per_request(client, '/write', args.requests)
+
+        # Replay the cookie taken before logout
+        client.get('/logout')
+        client.set_cookie('session', cookie.value)
+        revoked = client.get('/read').get_data(as_text=True) == 'no'
+        print(f"{label}: read +{(read - baseline) * 1e6:.1f} us, write +{(write - baseline) * 1e6:.1f} us "
+              f"per request (no session {baseline * 1e6:.0f} us); cookie {len(cookie.value)} bytes; "
+              f"replayed after logout: {'refused' if revoked else 'still logged in'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark of the user repository of the MFA demo apps.
+
+Measures lookups from the in-process cache against lookups that go to
+SQLite, then checks that worker processes sharing the database see each
+other's writes on their next read.
+
+Usage:
+    python3 bench_user_repository.py --users 10000 --lookups 200000 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.user_repository import UserRepository
+
+
+def bench_lookups(path, args):
+    for label, cache_ttl in (('cached', 60), ('uncached', 0)):
+        repository = UserRepository(path, cache_ttl=cache_ttl)
+        # Hot users: a few hundred people logging in again and again
+        names = [f'user{random.randrange(min(args.users, 500))}' for _ in range(args.lookups)]
+        start = time.perf_counter()
+        for name in names:
+            repository.get(name)
+        elapsed = time.perf_counter() - start
+        repository.close()
+        print(f"{label} get: {args.lookups / elapsed:,.0f} lookups/s ({elapsed / args.lookups * 1e6:.1f} us each)")
+
+    repository = UserRepository(path)
+    start = time.perf_counter()
+    for i in range(args.writes):
+        repository.update(f'user{i % args.users}', mfa_secret_key=f'SECRET{i}')
+    elapsed = time.perf_counter() - start
+    repository.close()
+    print(f"update: {args.writes / elapsed:,.0f} writes/s ({elapsed / args.writes * 1e3:.2f} ms each)")
+
+
+def worker(path, index, workers, rounds, barrier, results):
+    # Each worker enrolls its own users and checks the enrollments of the next worker
+    repository = UserRepository(path)
+    stale = 0
+    for round_number in range(rounds):
+        repository.update(f'user{index}', mfa_secret_key=f'{index}-{round_number}')
+        barrier.wait()
+        other = (index + 1) % workers
+        if repository.get(f'user{other}')['mfa_secret_key'] != f'{other}-{round_number}':
+            stale += 1
+        barrier.wait()
+    repository.close()
+    results.put(stale)
+
+
+def bench_workers(path, args):
+    barrier = multiprocessing.Barrier(args.workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(path, index, args.workers, args.rounds, barrier, results))
+                 for index in range(args.workers)]
+    for process in processes:
+        process.start()
+    stale = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    print(f"{args.workers} worker processes, {args.rounds} enrollment rounds: "
+          f"{stale} stale reads of another worker's write")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'users.db')
+    repository = UserRepository(path)
+    for i in range(args.users):
+        repository.add(f'user{i}', 'changeme')
+    repository.close()
+    bench_lookups(path, args)
+    bench_workers(path, args)
+
+
+if __name__ == '__main__':
+    main()
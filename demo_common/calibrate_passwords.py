@@ -0,0 +1,100 @@
+"""Pick password hashing parameters for this host.
+
+For each algorithm, the work factor is doubled until a single hash takes
+longer than the target latency; the largest factor within it is then
+checked for throughput with logins running on every pool thread at once,
+and lowered until the host sustains the target logins per second. The
+result is printed as an MFA_PASSWORD_HASHER value for the apps.
+
+Usage:
+    python3 calibrate_passwords.py --target-ms 100 --logins-per-second 20
+    python3 calibrate_passwords.py --algorithms pbkdf2_sha256 --target-ms 250
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.passwords import Pbkdf2Hasher, PasswordHasher, ScryptHasher
+
+CANDIDATES = {
+    'scrypt': [ScryptHasher(n=2 ** exponent) for exponent in range(12, 21)],
+    'pbkdf2_sha256': [Pbkdf2Hasher(iterations=50000 * 2 ** step) for step in range(8)],
+}
+
+
+def latency(hasher, repeats):
+    encoded = hasher.encode('calibration password')
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        hasher.derive('calibration password', b'0123456789abcdef', encoded.split('$')[1])
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def throughput(hasher, workers, seconds):
+    """Logins per second and p95 latency with more concurrent logins than pool threads."""
+    passwords = PasswordHasher(hasher, workers)
+    encoded = passwords.hash('calibration password')
+    stop = threading.Event()
+    latencies = []
+
+    def login():
+        while not stop.is_set():
+            start = time.perf_counter()
+            passwords.verify('calibration password', encoded)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=login) for _ in range(workers * 4)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    passwords.close()
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[int(len(latencies) * 0.95)] if latencies else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target-ms', type=float, default=100, help='latency of one hash')
+    parser.add_argument('--logins-per-second', type=float, default=10, help='throughput the host must sustain')
+    parser.add_argument('--algorithms', nargs='+', choices=sorted(CANDIDATES), default=sorted(CANDIDATES, reverse=True))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='password pool threads')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=3, help='duration of each throughput run')
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} CPU(s), {args.workers} pool thread(s); target {args.target_ms:g} ms per hash, "
+          f"{args.logins_per_second:g} logins/s")
+
+    for algorithm in args.algorithms:
+        fitting = []
+        for hasher in CANDIDATES[algorithm]:
+            seconds = latency(hasher, args.repeats)
+            print(f"  {hasher}: {seconds * 1000:.1f} ms")
+            if seconds > args.target_ms / 1000:
+                break
+            fitting.append(hasher)
+        chosen = None
+        for hasher in reversed(fitting):
+            rate, p95 = throughput(hasher, args.workers, args.seconds)
+            print(f"  {hasher}: {rate:.1f} logins/s, p95 {p95 * 1000:.0f} ms under load")
+            if rate >= args.logins_per_second:
+                chosen = hasher
+                break
+        if chosen is None:
+            print(f"{algorithm}: no parameters meet both targets on this host")
+        else:
+            print(f"{algorithm}: MFA_PASSWORD_HASHER={chosen}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Request timing and sampled profiling for the demo Flask apps.
+
+instrument(app) registers request hooks that record the route, status
+and duration of every request in a ring buffer of the last capacity
+requests, so memory stays flat however long the app runs and recording
+costs O(1) per request.
+
+Profiling is opt-in: with profile_every=N, one request in N runs under
+cProfile and its stats are dumped to profile_dir, named after the time,
+route and duration, for `python3 -m pstats` or snakeviz.
+
+GET /debug/requests shows the slowest recent requests and per-route
+figures, as JSON. It is only served when the app runs in debug mode or
+DEMO_DEBUG_ENDPOINT=1, and answers 404 otherwise.
+
+Environment variables read by instrument_from_env:
+    DEMO_REQUEST_LOG_SIZE   requests kept in the ring buffer (1000)
+    DEMO_PROFILE_EVERY      profile one request in N (0, off)
+    DEMO_PROFILE_DIR        where to dump the profiles (./profiles)
+    DEMO_DEBUG_ENDPOINT     1 to serve /debug/requests outside debug mode
+"""
+import collections
+import cProfile
+import itertools
+import os
+import re
+import threading
+import time
+
+from flask import g, jsonify, request
+
+RequestRecord = collections.namedtuple('RequestRecord', 'started method route status seconds profile')
+
+
+class RequestLog:
+    def __init__(self, capacity=1000):
+        # deque.append with a maxlen is atomic, no lock needed to record
+        self.records = collections.deque(maxlen=capacity)
+
+    def record(self, record):
+        self.records.append(record)
+
+    def slowest(self, count=20):
+        return sorted(list(self.records), key=lambda record: record.seconds, reverse=True)[:count]
+
+    def routes(self):
+        """Return {route: {count, mean, p95, max}} over the recent requests, in milliseconds."""
+        durations = collections.defaultdict(list)
+        for record in list(self.records):
+            durations[f'{record.method} {record.route}'].append(record.seconds)
+        summary = {}
+        for route, seconds in sorted(durations.items()):
+            seconds.sort()
+            summary[route] = {
+                'count': len(seconds),
+                'mean_ms': round(sum(seconds) / len(seconds) * 1000, 3),
+                'p95_ms': round(seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] * 1000, 3),
+                'max_ms': round(seconds[-1] * 1000, 3),
+            }
+        return summary
+
+
+def instrument(app, capacity=1000, profile_every=0, profile_dir='profiles', debug_endpoint=False):
+    """Register the timing hooks and the debug endpoint on app; return its RequestLog."""
+    log = RequestLog(capacity)
+    counter = itertools.count(1)
+    profile_lock = threading.Lock()
+    if profile_every:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def route():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    def finish(status):
+        started = g.pop('instrumentation_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        profiler = g.pop('instrumentation_profiler', None)
+        path = None
+        if profiler is not None:
+            profiler.disable()
+            profile_lock.release()
+            name = re.sub(r'[^A-Za-z0-9]+', '_', route()).strip('_') or 'root'
+            path = os.path.join(profile_dir, f'{int(time.time() * 1000)}-{request.method}-{name}-{seconds * 1000:.0f}ms.prof')
+            profiler.dump_stats(path)
+        log.record(RequestRecord(time.time() - seconds, request.method, route(), status, seconds, path))
+
+    # Registered first: timing starts before and ends after the other hooks
+    @app.before_request
+    def start_request_timer():
+        g.instrumentation_started = time.perf_counter()
+        if profile_every and next(counter) % profile_every == 0:
+            # One profiled request at a time: newer Python versions refuse
+            # a second profiler, and the stats would mix anyway
+            if profile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    profile_lock.release()
+                else:
+                    g.instrumentation_profiler = profiler
+
+    @app.after_request
+    def record_request_time(response):
+        finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exc):
+        # after_request does not run when the view raised
+        finish(500)
+
+    @app.route('/debug/requests')
+    def debug_requests():
+        if not (app.debug or debug_endpoint):
+            return 'Not found', 404
+        count = request.args.get('count', 20, type=int)
+        return jsonify({
+            'slowest': [dict(record._asdict(), seconds=round(record.seconds, 6)) for record in log.slowest(count)],
+            'routes': log.routes(),
+        })
+
+    return log
+
+
+def instrument_from_env(app, directory):
+    """instrument() with the DEMO_* environment variables; profiles go under directory by default."""
+    return instrument(app,
+                      capacity=int(os.environ.get('DEMO_REQUEST_LOG_SIZE', '1000')),
+                      profile_every=int(os.environ.get('DEMO_PROFILE_EVERY', '0')),
+                      profile_dir=os.environ.get('DEMO_PROFILE_DIR', os.path.join(directory, 'profiles')),
+                      debug_endpoint=os.environ.get('DEMO_DEBUG_ENDPOINT') == '1')
@@ -0,0 +1,147 @@
+"""Load test of the login rate limiter of the MFA demo apps.
+
+Runs the app in-process through Flask test clients. Legitimate users log
+in with the right password, each from an IP of its own, while attacker
+threads send wrong passwords for random usernames from a small pool of
+IPs at a fixed rate (credential stuffing). It reports the login latency
+of the legitimate users with no attack, then under attack without and
+with the limiter.
+
+Usage:
+    python3 load_rate_limit.py --app totp --attack-rate 2000 --duration 10
+    python3 load_rate_limit.py --app cac --attack-ips 20
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.rate_limit import LoginLimiter
+
+APPS = {
+    'totp': ('mfa-totp', 'demo_app_mfa_totp'),
+    'cac': ('mfa-cac', 'demo_app_mfa_cac'),
+}
+
+
+class NoLimit:
+    def check(self, ip, username):
+        return 0
+
+    def failed(self, username):
+        pass
+
+    def succeeded(self, username):
+        pass
+
+
+def load_app(name):
+    directory, module = APPS[name]
+    # Users of the load test go to a throwaway database
+    os.environ.setdefault('MFA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'users.db'))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', directory))
+    return importlib.import_module(module)
+
+
+def post_login(client, app_name, ip, username, password):
+    data = {'username': username, 'password': password}
+    if app_name == 'cac':
+        # Behind nginx, the client IP comes in X-Real-IP
+        return client.post('/login', data=data, headers={'X-Real-IP': ip})
+    return client.post('/login', data=data, environ_base={'REMOTE_ADDR': ip})
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def run(module, args, attack_rate):
+    stop = threading.Event()
+    latencies = []
+    attack_statuses = {}
+    lock = threading.Lock()
+
+    def legitimate():
+        client = module.app.test_client()
+        i = 0
+        while not stop.is_set():
+            user = i % args.users
+            start = time.perf_counter()
+            response = post_login(client, args.app, f'10.1.{user // 256}.{user % 256}', f'legit{user}', 'changeme')
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code in (200, 302), response.status_code
+            i += 1
+            time.sleep(args.think_time)
+
+    def attacker(rate):
+        client = module.app.test_client()
+        next_time = time.perf_counter()
+        while not stop.is_set():
+            response = post_login(client, args.app, f'203.0.113.{random.randrange(args.attack_ips)}',
+                                  f'victim{random.randrange(1000000)}', 'password123')
+            with lock:
+                attack_statuses[response.status_code] = attack_statuses.get(response.status_code, 0) + 1
+            # Fixed rate: an attacker does not slow down because the app does
+            next_time += 1 / rate
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    threads = [threading.Thread(target=legitimate)]
+    if attack_rate:
+        threads += [threading.Thread(target=attacker, args=(attack_rate / args.attackers,))
+                    for _ in range(args.attackers)]
+    # The routes print the user table on every request
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return latencies, attack_statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--app', choices=sorted(APPS), default='totp')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per phase')
+    parser.add_argument('--users', type=int, default=1000, help='legitimate users, one IP each')
+    parser.add_argument('--think-time', type=float, default=0.01, help='seconds between legitimate logins')
+    parser.add_argument('--attackers', type=int, default=8, help='attacker threads')
+    parser.add_argument('--attack-rate', type=float, default=2000, help='attack requests per second, all threads')
+    parser.add_argument('--attack-ips', type=int, default=50)
+    args = parser.parse_args()
+
+    module = load_app(args.app)
+    for user in range(args.users):
+        module.users.add(f'legit{user}', 'changeme')
+
+    phases = (
+        ('no attack', 0, LoginLimiter()),
+        ('attack, no limiter', args.attack_rate, NoLimit()),
+        ('attack, limiter', args.attack_rate, LoginLimiter()),
+    )
+    for label, attack_rate, limiter in phases:
+        module.login_limiter = limiter
+        latencies, statuses = run(module, args, attack_rate)
+        attacks = sum(statuses.values())
+        rejected = statuses.get(429, 0)
+        print(f"{label}: {len(latencies)} legitimate logins, p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms"
+              + (f"; {attacks / args.duration:,.0f} attack requests/s, {rejected} rejected with 429"
+                 if attack_rate else ""))
+        if isinstance(limiter, LoginLimiter):
+            print(f"    limiter state: {len(limiter.ips)} IP buckets, {len(limiter.usernames)} username buckets")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Password hashing for the MFA demo apps.
+
+Stored passwords carry their algorithm and work parameters:
+
+    scrypt$n=16384,r=8,p=1$<salt>$<hash>
+    pbkdf2_sha256$600000$<salt>$<hash>
+
+so the cost can be raised at any time: a password stored with other
+parameters, another algorithm, or still in plaintext (the seed users of
+the demos) is verified as it is and re-hashed with the current hasher on
+the next successful login.
+
+A KDF worth its name costs tens of milliseconds of CPU, so verification
+runs in a pool: its size bounds how many hashes run at once whatever the
+number of request threads, and hashlib releases the GIL while hashing, so
+a thread pool is enough for the hash itself to run in parallel.
+"""
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import secrets
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class ScryptHasher:
+    algorithm = 'scrypt'
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def __str__(self):
+        return f'scrypt:n={self.n},r={self.r},p={self.p}'
+
+    @property
+    def parameters(self):
+        return f'n={self.n},r={self.r},p={self.p}'
+
+    def derive(self, password, salt, parameters=None):
+        n, r, p = self.n, self.r, self.p
+        if parameters is not None:
+            values = dict(item.split('=') for item in parameters.split(','))
+            n, r, p = int(values['n']), int(values['r']), int(values['p'])
+        # 128 * n * r bytes of memory, plus headroom
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+    def encode(self, password):
+        salt = secrets.token_bytes(16)
+        return f'scrypt${self.parameters}${_b64encode(salt)}${_b64encode(self.derive(password, salt))}'
+
+
+class Pbkdf2Hasher:
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=600000):
+        self.iterations = iterations
+
+    def __str__(self):
+        return f'pbkdf2_sha256:iterations={self.iterations}'
+
+    @property
+    def parameters(self):
+        return str(self.iterations)
+
+    def derive(self, password, salt, parameters=None):
+        iterations = self.iterations if parameters is None else int(parameters)
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+
+    def encode(self, password):
+        salt = secrets.token_bytes(16)
+        return f'pbkdf2_sha256${self.parameters}${_b64encode(salt)}${_b64encode(self.derive(password, salt))}'
+
+
+HASHERS = {hasher.algorithm: hasher for hasher in (ScryptHasher, Pbkdf2Hasher)}
+
+
+def hasher_from_string(text):
+    """Build a hasher from e.g. 'scrypt:n=32768,r=8,p=1' or 'pbkdf2_sha256:iterations=600000'."""
+    algorithm, _, parameters = text.partition(':')
+    if algorithm not in HASHERS:
+        raise ValueError(f"Unknown password hasher '{algorithm}'")
+    kwargs = {}
+    if parameters:
+        for item in parameters.split(','):
+            name, _, value = item.partition('=')
+            kwargs[name.strip()] = int(value)
+    return HASHERS[algorithm](**kwargs)
+
+
+def check_password(password, encoded):
+    """Return True if password matches the stored value encoded; a missing password never does."""
+    if not isinstance(password, str):
+        return False
+    algorithm, _, rest = encoded.partition('$')
+    hasher_class = HASHERS.get(algorithm)
+    if hasher_class is None or rest.count('$') != 2:
+        # Not hashed yet
+        return hmac.compare_digest(password.encode(), encoded.encode())
+    parameters, salt, expected = rest.split('$')
+    derived = hasher_class().derive(password, _b64decode(salt), parameters)
+    return hmac.compare_digest(derived, _b64decode(expected))
+
+
+def _verify(hasher, password, encoded):
+    # Runs in the pool: the check and, if needed, the upgraded hash
+    if not check_password(password, encoded):
+        return False, None
+    algorithm, _, rest = encoded.partition('$')
+    if algorithm == hasher.algorithm and rest.split('$')[0] == hasher.parameters:
+        return True, None
+    return True, hasher.encode(password)
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords in a pool of threads (or processes)."""
+
+    def __init__(self, hasher=None, workers=None, processes=False):
+        self.hasher = hasher or ScryptHasher()
+        workers = workers or os.cpu_count()
+        executor = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+        self.pool = executor(workers)
+        # Checked for unknown usernames, so that they take as long as known ones
+        self.dummy = self.hasher.encode(secrets.token_hex(16))
+
+    def hash(self, password):
+        return self.pool.submit(self.hasher.encode, password).result()
+
+    def verify(self, password, encoded):
+        """Return (matches, new encoded value or None).
+
+        The new value is set when the password matched but was stored
+        with another hasher or other parameters; the caller stores it.
+        encoded may be None for an unknown user: the password is then
+        checked against a dummy hash and never matches, as is a
+        password that is missing or not a string.
+        """
+        if encoded is None or not isinstance(password, str):
+            self.pool.submit(check_password, password if isinstance(password, str) else '', self.dummy).result()
+            return False, None
+        return self.pool.submit(_verify, self.hasher, password, encoded).result()
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,174 @@
+"""Login rate limiting and lockout shared by the MFA demo apps.
+
+Each key (a client IP, a username) has a token bucket: it holds up to
+burst tokens and refills at rate tokens per second. A bucket is stored as
+a (tokens, timestamp) tuple and only while it is not full: a bucket left
+alone for burst / rate seconds is full again, which is exactly what a key
+without an entry means, so idle entries are dropped without losing
+anything. max_keys is a hard cap on top of that; past it the least
+recently used buckets are dropped early, which only forgets some
+attempts of the quietest keys.
+
+LoginLimiter combines two buckets for the login forms:
+    - per client IP, charged for every attempt, which stops one client
+      from hammering the form whatever usernames it tries
+    - per username, charged for failed attempts only, which locks an
+      account out after a run of failures (from any number of IPs) and is
+      cleared by a successful login
+Both are checked before any credential or TOTP work is done.
+
+RateLimiter keeps its buckets in the memory of one process, so with
+several worker processes each would allow burst attempts of its own.
+SqliteRateLimiter keeps them in a SQLite table instead, where every
+worker charges the same bucket; LoginLimiter uses it when given a path.
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # Seconds after which an untouched bucket is full again
+        self.ttl = burst / rate
+        # key -> (tokens, timestamp), least recently used first
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def _tokens(self, key, now):
+        # Called with the lock held; also drops the buckets that are full again
+        while self.buckets:
+            oldest, (tokens, stamp) = next(iter(self.buckets.items()))
+            if now - stamp < self.ttl:
+                break
+            del self.buckets[oldest]
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, stamp = bucket
+        return min(self.burst, tokens + (now - stamp) * self.rate)
+
+    def wait_time(self, key, now=None):
+        """Return the seconds until key has a token, 0 if it has one now."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens = self._tokens(key, now)
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, key, now=None):
+        """Take a token from key; return 0, or the seconds to wait if there is none."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens = self._tokens(key, now)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return 0
+
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+
+
+class SqliteRateLimiter:
+    """A RateLimiter whose buckets are rows of a SQLite table shared by every worker process.
+
+    Timestamps are wall-clock time, the only clock the processes share.
+    """
+    # Full buckets are purged once every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, table, rate, burst):
+        self.table = table
+        self.rate = rate
+        self.burst = burst
+        self.ttl = burst / rate
+        self.writes = 0
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, stamp REAL NOT NULL)')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {self.table} WHERE stamp > ?',
+                                           (time.time() - self.ttl,)).fetchone()[0]
+
+    def _tokens(self, key, now):
+        row = self.connection.execute(f'SELECT tokens, stamp FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return self.burst
+        tokens, stamp = row
+        return min(self.burst, tokens + max(now - stamp, 0) * self.rate)
+
+    def wait_time(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens = self._tokens(key, now)
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            # Read and charged in one write transaction, so no other worker
+            # spends the same token
+            self.connection.execute('BEGIN IMMEDIATE')
+            with self.connection:
+                tokens = self._tokens(key, now)
+                if tokens < 1:
+                    return (1 - tokens) / self.rate
+                self.connection.execute(f'INSERT OR REPLACE INTO {self.table} (key, tokens, stamp) VALUES (?, ?, ?)',
+                                        (key, tokens - 1, now))
+                self.writes += 1
+                if self.writes % self.PURGE_EVERY == 0:
+                    self.connection.execute(f'DELETE FROM {self.table} WHERE stamp <= ?', (now - self.ttl,))
+            return 0
+
+    def reset(self, key):
+        with self.lock:
+            self.connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+
+class LoginLimiter:
+    """Per-IP attempt limit and per-username failure lockout for a login form.
+
+    Defaults: 10 attempts per IP in a burst then one every 2 seconds, and
+    5 failures per username then one more try every 60 seconds. With a
+    path, the buckets are kept in that SQLite database and shared by every
+    worker process.
+    """
+
+    def __init__(self, ip_rate=0.5, ip_burst=10, user_rate=1 / 60, user_burst=5, max_keys=100000, path=None):
+        if path is None:
+            self.ips = RateLimiter(ip_rate, ip_burst, max_keys)
+            self.usernames = RateLimiter(user_rate, user_burst, max_keys)
+        else:
+            self.ips = SqliteRateLimiter(path, 'login_ip_buckets', ip_rate, ip_burst)
+            self.usernames = SqliteRateLimiter(path, 'login_username_buckets', user_rate, user_burst)
+
+    def check(self, ip, username):
+        """Charge an attempt to ip; return 0 if it may go ahead, or the seconds to wait."""
+        # The username is only checked, not charged: only failures count against it
+        wait = self.usernames.wait_time(username) if username else 0
+        if wait:
+            return wait
+        return self.ips.consume(ip)
+
+    def failed(self, username):
+        if username:
+            self.usernames.consume(username)
+
+    def succeeded(self, username):
+        self.usernames.reset(username)
@@ -0,0 +1,279 @@
+"""Server-side sessions for the MFA demo apps.
+
+The session cookie only holds an opaque random ID; the session data stays
+on the server. Requests need no HMAC signing or verifying, the cookie
+stays small whatever the session holds, and a session can be revoked by
+deleting it (logout does, as Flask clears the session).
+
+Stores:
+    MemorySessionStore   sharded dicts, each with its own lock, so
+                         concurrent requests rarely wait on each other;
+                         one worker process only
+    SqliteSessionStore   a SQLite database (WAL) every worker shares
+    TieredSessionStore   a MemorySessionStore in front of a
+                         SqliteSessionStore: reads stay in memory and are
+                         dropped as soon as any worker writes
+
+The session ID is replaced, and the old one deleted, whenever the
+session's login state changes (authenticated, totp_verified, username)
+or it is cleared, so an ID planted in a browser before login (session
+fixation) never becomes a logged-in session.
+
+A session lives ttl seconds after its last write, and is written again
+once less than half of its ttl is left, so an active user is not logged
+out. MemorySessionStore also caps the number of sessions kept, dropping
+the least recently written first.
+
+session_interface_from_env picks a store from MFA_SESSION_STORE:
+cookie (Flask's signed cookie), memory, or sqlite (tiered).
+shared_state_path tells the apps whether the other state their workers
+must agree on (login limits, used TOTP codes) goes to the same database.
+"""
+import collections
+import contextlib
+import json
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SecureCookieSession, SessionInterface
+
+
+class ServerSession(SecureCookieSession):
+    # The base class tracks modified; new and sid are set by the interface
+    def __init__(self, initial=None, sid=None, new=False):
+        super().__init__(initial)
+        self.sid = sid
+        self.new = new
+        self.cleared = False
+        # Values of the interface's rotate_on keys when the session was opened
+        self.login_state = None
+
+    def clear(self):
+        super().clear()
+        self.cleared = True
+
+
+class MemorySessionStore:
+    def __init__(self, ttl=3600, max_sessions=100000, shards=16):
+        self.ttl = ttl
+        self.max_per_shard = max(1, max_sessions // shards)
+        # sid -> (expiry, data) per shard, least recently written first
+        self.shards = [(collections.OrderedDict(), threading.Lock()) for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(sessions) for sessions, _ in self.shards)
+
+    def _shard(self, sid):
+        return self.shards[hash(sid) % len(self.shards)]
+
+    def get(self, sid):
+        """Return (data, expiry) of a live session, or None."""
+        now = time.time()
+        sessions, lock = self._shard(sid)
+        with lock:
+            # Written in expiry order, so expired sessions are at the front
+            while sessions:
+                oldest, (expiry, _) = next(iter(sessions.items()))
+                if expiry > now:
+                    break
+                del sessions[oldest]
+            entry = sessions.get(sid)
+        if entry is None or entry[0] <= now:
+            return None
+        return dict(entry[1]), entry[0]
+
+    def set(self, sid, data, expiry=None):
+        sessions, lock = self._shard(sid)
+        with lock:
+            sessions[sid] = (time.time() + self.ttl if expiry is None else expiry, dict(data))
+            sessions.move_to_end(sid)
+            while len(sessions) > self.max_per_shard:
+                sessions.popitem(last=False)
+
+    def delete(self, sid):
+        sessions, lock = self._shard(sid)
+        with lock:
+            sessions.pop(sid, None)
+
+    def clear(self):
+        for sessions, lock in self.shards:
+            with lock:
+                sessions.clear()
+
+
+class SqliteSessionStore:
+    # Expired sessions are purged once every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl=3600, pool_size=4):
+        self.path = path
+        self.ttl = ttl
+        self.writes = 0
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(self._connect())
+        with self.connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                               '(sid TEXT PRIMARY KEY, data TEXT NOT NULL, expiry REAL NOT NULL)')
+        self.watcher = self._connect()
+        self.watcher_lock = threading.Lock()
+        self.data_version = self.watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    def __len__(self):
+        with self.connection() as connection:
+            return connection.execute('SELECT COUNT(*) FROM sessions WHERE expiry > ?', (time.time(),)).fetchone()[0]
+
+    def changed(self):
+        """Return True if any connection has written since the last call."""
+        with self.watcher_lock:
+            data_version = self.watcher.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self.data_version:
+                return False
+            self.data_version = data_version
+            return True
+
+    def get(self, sid):
+        with self.connection() as connection:
+            row = connection.execute('SELECT data, expiry FROM sessions WHERE sid = ? AND expiry > ?',
+                                     (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, sid, data, expiry=None):
+        expiry = time.time() + self.ttl if expiry is None else expiry
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions (sid, data, expiry) VALUES (?, ?, ?)',
+                               (sid, json.dumps(data), expiry))
+            self.writes += 1
+            # Not exact across threads, nor needs to be
+            if self.writes % self.PURGE_EVERY == 0:
+                connection.execute('DELETE FROM sessions WHERE expiry <= ?', (time.time(),))
+
+    def delete(self, sid):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+
+class TieredSessionStore:
+    def __init__(self, shared, max_sessions=100000, shards=16):
+        self.shared = shared
+        self.ttl = shared.ttl
+        self.memory = MemorySessionStore(shared.ttl, max_sessions, shards)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.shared)
+
+    def _memory_is_current(self):
+        # Any write, by this worker or another, may have changed or deleted
+        # a session kept in memory
+        if self.shared.changed():
+            self.memory.clear()
+            return False
+        return True
+
+    def get(self, sid):
+        with self.lock:
+            self._memory_is_current()
+        entry = self.memory.get(sid)
+        if entry is None:
+            entry = self.shared.get(sid)
+            # Only kept if nothing was written since it was read
+            with self.lock:
+                if entry is not None and self._memory_is_current():
+                    self.memory.set(sid, *entry)
+        return entry
+
+    def set(self, sid, data, expiry=None):
+        self.shared.set(sid, data, expiry)
+        self.memory.delete(sid)
+
+    def delete(self, sid):
+        self.shared.delete(sid)
+        self.memory.delete(sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, rotate_on=('authenticated', 'totp_verified', 'username')):
+        self.store = store
+        # Keys whose change gives the session a new ID
+        self.rotate_on = rotate_on
+
+    def _login_state(self, data):
+        return tuple(data.get(key) for key in self.rotate_on)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        entry = self.store.get(sid) if sid else None
+        if entry is None:
+            session = ServerSession(sid=secrets.token_urlsafe(32), new=True)
+            session.login_state = self._login_state(session)
+            return session
+        data, expiry = entry
+        session = ServerSession(data, sid=sid)
+        session.login_state = self._login_state(data)
+        # Sliding expiry, written at most twice per ttl
+        if expiry - time.time() < self.store.ttl / 2:
+            session.modified = True
+        return session
+
+    def save_session(self, app, session, response):
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session:
+            # Emptied (e.g. by logout): revoke it server-side too
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(self.get_cookie_name(app), domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return
+        rotated = session.cleared or self._login_state(session) != session.login_state
+        if rotated and not session.new:
+            # Never carry a session ID across a login state change
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        if session.modified or session.new or rotated:
+            self.store.set(session.sid, dict(session))
+        if session.new or rotated:
+            response.set_cookie(self.get_cookie_name(app), session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=self.get_cookie_domain(app),
+                                path=self.get_cookie_path(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+
+def session_interface_from_env(default, sqlite_path):
+    """Return the session interface named by MFA_SESSION_STORE, or None for Flask's cookie sessions."""
+    kind = os.environ.get('MFA_SESSION_STORE', default)
+    ttl = float(os.environ.get('MFA_SESSION_TTL', '3600'))
+    if kind == 'cookie':
+        return None
+    if kind == 'memory':
+        return ServerSessionInterface(MemorySessionStore(ttl))
+    if kind == 'sqlite':
+        return ServerSessionInterface(TieredSessionStore(SqliteSessionStore(sqlite_path, ttl)))
+    raise ValueError(f"Unknown session store '{kind}'")
+
+
+def shared_state_path(default, sqlite_path):
+    """Return sqlite_path if MFA_SESSION_STORE keeps the sessions there, else None (one worker process)."""
+    return sqlite_path if os.environ.get('MFA_SESSION_STORE', default) == 'sqlite' else None
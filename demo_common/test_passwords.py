@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.passwords import Pbkdf2Hasher, PasswordHasher, check_password
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(Pbkdf2Hasher(iterations=1000), workers=1)
+    yield hasher
+    hasher.close()
+
+
+@pytest.mark.parametrize('password', [None, 42, b'secret'])
+def test_missing_or_non_str_password_never_matches(hasher, password):
+    assert hasher.verify(password, hasher.hasher.encode('secret')) == (False, None)
+    assert hasher.verify(password, 'secret') == (False, None)
+    assert hasher.verify(password, None) == (False, None)
+    assert check_password(password, 'secret') is False
+
+
+def test_plaintext_password_is_upgraded(hasher):
+    matches, upgraded = hasher.verify('secret', 'secret')
+    assert matches and check_password('secret', upgraded)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.rate_limit import LoginLimiter, SqliteRateLimiter
+
+
+def test_sqlite_buckets_are_shared_by_every_worker(tmp_path):
+    path = str(tmp_path / 'state.db')
+    # One limiter per worker process, on the same database
+    workers = [SqliteRateLimiter(path, 'buckets', rate=1, burst=2) for _ in range(2)]
+    assert workers[0].consume('10.0.0.1', now=100) == 0
+    assert workers[1].consume('10.0.0.1', now=100) == 0
+    assert workers[0].consume('10.0.0.1', now=100) == 1
+    assert workers[1].wait_time('10.0.0.1', now=100.5) == 0.5
+    assert workers[1].consume('10.0.0.1', now=101) == 0
+
+
+def test_shared_username_lockout_is_cleared_by_a_login(tmp_path):
+    path = str(tmp_path / 'state.db')
+    first, second = LoginLimiter(user_burst=1, path=path), LoginLimiter(user_burst=1, path=path)
+    first.failed('alice')
+    assert second.check('10.0.0.2', 'alice') > 0
+    second.succeeded('alice')
+    assert first.check('10.0.0.2', 'alice') == 0
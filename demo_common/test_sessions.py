@@ -0,0 +1,86 @@
+import os
+import sys
+
+import pytest
+from flask import Flask, session
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.sessions import MemorySessionStore, ServerSessionInterface, SqliteSessionStore, TieredSessionStore
+
+
+def make_app(store):
+    app = Flask(__name__)
+    app.secret_key = 'test_secret_key'
+    app.session_interface = ServerSessionInterface(store)
+
+    @app.route('/visit')
+    def visit():
+        session['visits'] = session.get('visits', 0) + 1
+        return ''
+
+    @app.route('/login')
+    def login():
+        session['authenticated'] = True
+        session['username'] = 'demo'
+        return ''
+
+    @app.route('/verify')
+    def verify():
+        session['totp_verified'] = True
+        return ''
+
+    @app.route('/whoami')
+    def whoami():
+        return session.get('username', '')
+
+    @app.route('/relogin')
+    def relogin():
+        session.clear()
+        session['username'] = 'demo'
+        return ''
+
+    return app
+
+
+@pytest.fixture(params=['memory', 'tiered'])
+def client(request, tmp_path):
+    if request.param == 'memory':
+        store = MemorySessionStore()
+    else:
+        store = TieredSessionStore(SqliteSessionStore(str(tmp_path / 'sessions.db')))
+    return make_app(store).test_client()
+
+
+def test_session_id_changes_across_login_and_mfa(client):
+    client.get('/visit')
+    anonymous = client.get_cookie('session').value
+    client.get('/login')
+    logged_in = client.get_cookie('session').value
+    assert logged_in != anonymous
+    client.get('/verify')
+    verified = client.get_cookie('session').value
+    assert verified not in (anonymous, logged_in)
+    assert client.get('/whoami').get_data(as_text=True) == 'demo'
+
+
+def test_fixated_session_id_does_not_become_logged_in(client):
+    client.get('/visit')
+    planted = client.get_cookie('session').value
+    client.get('/login')
+    # The attacker still holds the ID from before the login
+    client.set_cookie('session', planted)
+    assert client.get('/whoami').get_data(as_text=True) == ''
+
+
+def test_session_id_changes_on_clear(client):
+    client.get('/login')
+    before = client.get_cookie('session').value
+    client.get('/relogin')
+    assert client.get_cookie('session').value != before
+
+
+def test_unchanged_login_state_keeps_the_session_id(client):
+    client.get('/login')
+    before = client.get_cookie('session').value
+    client.get('/visit')
+    assert client.get_cookie('session').value == before
@@ -0,0 +1,197 @@
+"""User repository shared by the workers of the MFA demo apps.
+
+Users live in a SQLite database in WAL mode, so any number of worker
+processes can read it while one writes, and a secret enrolled on one
+worker is seen by the next request whatever worker serves it.
+Connections are pooled per process.
+
+Reads go through an in-process cache, so the hot path (every login and
+TOTP check) does not touch the database file. Entries expire after
+cache_ttl seconds, and the cache is dropped as soon as any connection,
+in this process or another, commits a write: a dedicated connection
+polls PRAGMA data_version, which only reads the WAL index in shared
+memory. Writes are rare here (enrollment, password upgrades), so
+dropping the whole cache on each one is cheap.
+
+Client certificates can be bound to users: the certificates table maps
+a certificate identity (any string, e.g. a subject DN or a fingerprint)
+to a username, and is cached the same way.
+"""
+import collections
+import contextlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+COLUMNS = ('password', 'mfa_secret_key', 'backup_codes', 'enrollment')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    mfa_secret_key TEXT,
+    backup_codes TEXT NOT NULL DEFAULT '[]',
+    enrollment TEXT
+)
+"""
+
+CERTIFICATES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificates (
+    identity TEXT PRIMARY KEY,
+    username TEXT NOT NULL
+)
+"""
+
+
+class UserRepository:
+    def __init__(self, path, pool_size=4, cache_ttl=5.0, cache_size=10000):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # username -> (expiry, user dict or None), least recently used first
+        self.cache = collections.OrderedDict()
+        # certificate identity -> (expiry, username or None), likewise
+        self.certificate_cache = collections.OrderedDict()
+        # Bumped on every invalidation: a value loaded while it changed may be stale
+        self.generation = 0
+        self.cache_lock = threading.Lock()
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(self._connect())
+        with self.connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(SCHEMA)
+            connection.execute(CERTIFICATES_SCHEMA)
+        self.watcher = self._connect()
+        self.data_version = self.watcher.execute('PRAGMA data_version').fetchone()[0]
+
+    def __repr__(self):
+        return f'UserRepository({self.path!r})'
+
+    def _connect(self):
+        # Autocommit; writes open their own transactions
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.pool.get()
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    def _drop_stale_cache(self):
+        # Called with the cache lock held
+        data_version = self.watcher.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self._invalidate()
+
+    def _invalidate(self, cache=None, key=None):
+        # Called with the cache lock held; drops one entry, or everything
+        self.generation += 1
+        if cache is None:
+            self.cache.clear()
+            self.certificate_cache.clear()
+        else:
+            cache.pop(key, None)
+
+    def _cached(self, cache, key, load):
+        # Return the value from cache, else load it; misses are cached
+        # too, a login form sees plenty of unknown usernames
+        now = time.monotonic()
+        with self.cache_lock:
+            self._drop_stale_cache()
+            entry = cache.get(key)
+            if entry is not None and entry[0] > now:
+                cache.move_to_end(key)
+                return entry[1]
+            generation = self.generation
+        value = load()
+        with self.cache_lock:
+            # Only kept if nothing was written, here or by another process, during the load
+            self._drop_stale_cache()
+            if self.generation != generation:
+                return value
+            cache[key] = (now + self.cache_ttl, value)
+            cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return value
+
+    def get(self, username):
+        """Return a copy of the user as a dict, or None."""
+        def load():
+            with self.connection() as connection:
+                row = connection.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+            if row is None:
+                return None
+            user = dict(row)
+            user['backup_codes'] = json.loads(user['backup_codes'])
+            return user
+        user = self._cached(self.cache, username, load)
+        return dict(user) if user is not None else None
+
+    def user_for_certificate(self, identity):
+        """Return the username bound to a certificate identity, or None."""
+        def load():
+            with self.connection() as connection:
+                row = connection.execute('SELECT username FROM certificates WHERE identity = ?', (identity,)).fetchone()
+            return row[0] if row is not None else None
+        return self._cached(self.certificate_cache, identity, load)
+
+    def bind_certificate(self, identity, username, replace=False):
+        """Bind a certificate identity to a user; an existing binding is left alone unless replace is set."""
+        with self.connection() as connection:
+            connection.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO certificates (identity, username) "
+                               "VALUES (?, ?)", (identity, username))
+        with self.cache_lock:
+            self._invalidate(self.certificate_cache, identity)
+
+    def add(self, username, password, replace=False, **fields):
+        """Store a new user; an existing user is left alone unless replace is set."""
+        values = {'password': password, 'backup_codes': [], **fields}
+        names = ['username'] + list(values)
+        self._write(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO users ({', '.join(names)}) "
+                    f"VALUES ({', '.join('?' * len(names))})",
+                    [username] + [self._encode(name, value) for name, value in values.items()], username)
+
+    def update(self, username, **fields):
+        """Set some columns of a user; other columns are left as they are."""
+        for name in fields:
+            if name not in COLUMNS:
+                raise ValueError(f"Unknown user attribute '{name}'")
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._write(f'UPDATE users SET {assignments} WHERE username = ?',
+                    [self._encode(name, value) for name, value in fields.items()] + [username], username)
+
+    def delete(self, username):
+        with self.connection() as connection:
+            connection.execute('DELETE FROM certificates WHERE username = ?', (username,))
+        self._write('DELETE FROM users WHERE username = ?', [username], username)
+        with self.cache_lock:
+            self._invalidate()
+
+    def __len__(self):
+        with self.connection() as connection:
+            return connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def _write(self, statement, parameters, username):
+        with self.connection() as connection:
+            connection.execute(statement, parameters)
+        with self.cache_lock:
+            self._invalidate(self.cache, username)
+
+    @staticmethod
+    def _encode(name, value):
+        return json.dumps(value) if name == 'backup_codes' else value
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+        self.watcher.close()
@@ -0,0 +1,195 @@
+"""Benchmarks for the demo MFA-CAC app.
+
+Requests go through the Flask test client with the headers nginx sets
+after verifying a client certificate.
+
+login: a visit is a new connection with no session cookie reaching the
+secure page, with a password (redirect to the login form, password
+check, secure page) or with a certificate bound to the user. The
+certificate is bound by the first password login, as it would be in the
+app.
+
+revocation: check latency with the stand-in responder revoking
+--revoked serials, from the CRL set and from cached OCSP responses,
+against an OCSP request per check.
+
+Usage:
+    python3 bench_mfa_cac.py login --password-visits 50 --cert-visits 2000 --requests 5000
+    python3 bench_mfa_cac.py revocation --revoked 100000 --checks 200000
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+# Users of the benchmarks go to a throwaway database
+os.environ.setdefault('MFA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'users.db'))
+import demo_app_mfa_cac
+from cert_identity import identity_from_headers
+from revocation import GOOD, REVOKED, RevocationChecker
+from revocation_responder import StandInResponder, make_ca
+
+CERTIFICATE = {
+    'X-Client-Verified': 'SUCCESS',
+    'X-Subject-DN': 'CN=Product Demo,OU=Product,L=Chambery,C=FR',
+    'X-Client-Fingerprint': '3f786850e387550fdab836ed7e6dc881de23001b',
+}
+
+
+def headers(visit):
+    # One client address per visit, or the login rate limit would kick in
+    return dict(CERTIFICATE, **{'X-Real-IP': f'10.{visit // 65536 % 256}.{visit // 256 % 256}.{visit % 256}'})
+
+
+def password_visit(visit):
+    client = demo_app_mfa_cac.app.test_client()
+    assert client.get('/secure', headers=headers(visit)).status_code == 302
+    response = client.post('/login', headers=headers(visit), data={'username': 'demo', 'password': 'changeme'})
+    assert response.status_code == 302, response.status_code
+    assert client.get('/secure', headers=headers(visit)).status_code == 200
+    return 3
+
+
+def cert_visit(visit):
+    client = demo_app_mfa_cac.app.test_client()
+    assert client.get('/secure', headers=headers(visit)).status_code == 200
+    return 1
+
+
+def bench_visits(label, visit, visits):
+    requests = 0
+    start = time.perf_counter()
+    for i in range(visits):
+        requests += visit(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {visits / elapsed:,.1f} visits/s, {requests / elapsed:,.0f} requests/s "
+          f"({elapsed / visits * 1000:.2f} ms per visit)")
+
+
+def bench_signed_in(label, requests, extra_headers=None):
+    request_headers = dict(headers(0), **(extra_headers or {}))
+    client = demo_app_mfa_cac.app.test_client()
+    if not demo_app_mfa_cac.CERT_LOGIN:
+        client.post('/login', headers=request_headers, data={'username': 'demo', 'password': 'changeme'})
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get('/secure', headers=request_headers)
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.status_code
+    print(f"{label}: {requests / elapsed:,.0f} requests/s")
+
+
+def bench_parsing(requests):
+    dn = CERTIFICATE['X-Subject-DN']
+    fingerprint = CERTIFICATE['X-Client-Fingerprint']
+    for label, parse in (('uncached', identity_from_headers.__wrapped__), ('cached', identity_from_headers)):
+        start = time.perf_counter()
+        for _ in range(requests):
+            parse(dn, fingerprint)
+        elapsed = time.perf_counter() - start
+        print(f"certificate headers, {label}: {elapsed / requests * 1e6:.2f} us per parse")
+
+
+def per_check(checker, issuer_dn, serials):
+    start = time.perf_counter()
+    statuses = [checker.status(issuer_dn, serial) for serial in serials]
+    return (time.perf_counter() - start) / len(serials) * 1e6, statuses
+
+
+def bench_revocation(args):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    ca_certificate, ca_key = make_ca()
+    issuer_dn = ca_certificate.subject.rfc4514_string()
+    revoked = random.sample(range(1, 2 ** 63), args.revoked)
+    responder = StandInResponder(ca_certificate, ca_key, revoked)
+    server = make_server('127.0.0.1', 0, responder.app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.port}'
+
+    start = time.perf_counter()
+    responder.crl_der()
+    print(f"stand-in responder: CRL of {args.revoked:,} serials signed in {time.perf_counter() - start:.2f}s")
+
+    # Half revoked, half good serials
+    good = [random.randrange(2 ** 63, 2 ** 64) for _ in range(args.checks // 2)]
+    serials = [f'{serial:X}' for pair in zip(random.choices(revoked, k=len(good)), good) for serial in pair]
+
+    crl_checker = RevocationChecker([ca_certificate], [f'{base_url}/crl.der'])
+    start = time.perf_counter()
+    crl_checker.refresh_crls()
+    print(f"CRL fetch, signature check and set: {time.perf_counter() - start:.2f}s "
+          f"({sum(len(revoked) for revoked in crl_checker.revoked.values()):,} serials)")
+    microseconds, statuses = per_check(crl_checker, issuer_dn, serials)
+    assert statuses[:2] == [REVOKED, GOOD] and statuses.count(REVOKED) == len(good), statuses[:2]
+    print(f"CRL set check: {microseconds:.2f} us per check")
+
+    ocsp_checker = RevocationChecker([ca_certificate], ocsp_url=f'{base_url}/ocsp')
+    key = next(iter(ocsp_checker.issuers))
+    start = time.perf_counter()
+    for serial in serials[:args.ocsp_requests]:
+        ocsp_checker.ocsp_status(key, int(serial, 16))
+    print(f"OCSP request per check (inline): {(time.perf_counter() - start) / args.ocsp_requests * 1000:.2f} ms per check")
+
+    # The same certificates coming back: fetched once in the background, then cached
+    returning = serials[:args.ocsp_requests]
+    ocsp_checker.start()
+    start = time.perf_counter()
+    while True:
+        _, statuses = per_check(ocsp_checker, issuer_dn, returning)
+        if statuses.count(GOOD) + statuses.count(REVOKED) == len(returning):
+            break
+        time.sleep(0.01)
+    print(f"OCSP background fetch of {len(returning)} certificates: {time.perf_counter() - start:.2f}s")
+    microseconds, statuses = per_check(ocsp_checker, issuer_dn, returning * (args.checks // len(returning)))
+    print(f"OCSP cached check: {microseconds:.2f} us per check")
+    ocsp_checker.close()
+
+    # End to end, a signed-in request to the secure page
+    password_visit(0)
+    certificate = {'X-Client-Issuer-DN': issuer_dn, 'X-Client-Serial': f'{good[0]:X}'}
+    for label, checker in (('no revocation check', None), ('CRL check', crl_checker)):
+        demo_app_mfa_cac.revocation_checker = checker
+        bench_signed_in(f'signed in, {label}', args.requests, certificate)
+    server.shutdown()
+
+
+def bench_login(args):
+    # Binds the certificate to the demo user
+    password_visit(0)
+    demo_app_mfa_cac.CERT_LOGIN = False
+    bench_visits('password + certificate', password_visit, args.password_visits)
+    bench_signed_in('password + certificate, signed in', args.requests)
+    demo_app_mfa_cac.CERT_LOGIN = True
+    bench_visits('certificate only', cert_visit, args.cert_visits)
+    bench_signed_in('certificate only, signed in', args.requests)
+    bench_parsing(args.requests * 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    login_parser = subparsers.add_parser('login', help='visits per second, password + certificate vs certificate only')
+    login_parser.add_argument('--password-visits', type=int, default=50)
+    login_parser.add_argument('--cert-visits', type=int, default=2000)
+    login_parser.add_argument('--requests', type=int, default=5000)
+    login_parser.set_defaults(func=bench_login)
+
+    revocation_parser = subparsers.add_parser('revocation', help='revocation check latency, CRL set and OCSP cache')
+    revocation_parser.add_argument('--revoked', type=int, default=100000)
+    revocation_parser.add_argument('--checks', type=int, default=200000)
+    revocation_parser.add_argument('--ocsp-requests', type=int, default=200)
+    revocation_parser.add_argument('--requests', type=int, default=5000)
+    revocation_parser.set_defaults(func=bench_revocation)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
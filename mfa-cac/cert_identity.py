@@ -0,0 +1,121 @@
+"""Client certificate identities for the MFA-CAC app.
+
+nginx verifies the client certificate and passes on its subject DN
+($ssl_client_s_dn, RFC 4514: CN=Product Demo,OU=Product,C=FR) and its
+fingerprint ($ssl_client_fingerprint, SHA-1 in hex). identity_from_headers
+parses them into a CertificateIdentity, cached by header value: a client
+presents the same certificate on every request, so each one is parsed
+once.
+
+index_keys() gives the strings the user repository binds to users: the
+fingerprint, which names one certificate, and the canonical DN, which
+still matches when the certificate is re-issued to the same subject.
+"""
+import collections
+import functools
+import re
+import string
+
+# Characters escaped with a backslash in a DN attribute value (RFC 4514)
+DN_SPECIAL = re.compile(r'([,+"\\<>;=])')
+FINGERPRINT = re.compile(r'[0-9a-f]{40}|[0-9a-f]{64}')
+
+
+class CertificateIdentity(collections.namedtuple('CertificateIdentity', 'dn attributes fingerprint')):
+    __slots__ = ()
+
+    @property
+    def common_name(self):
+        return next((value for name, value in self.attributes if name == 'CN'), None)
+
+    def index_keys(self):
+        """Keys to look the certificate up by, the most specific first."""
+        keys = []
+        if self.fingerprint:
+            keys.append(f'fingerprint:{self.fingerprint}')
+        if self.dn:
+            keys.append(f'dn:{self.dn}')
+        return keys
+
+
+def parse_dn(dn):
+    """Return the (type, value) pairs of a DN, leaf first; raise ValueError if it is malformed."""
+    if dn.startswith('/'):
+        # Legacy format ($ssl_client_s_dn_legacy, nginx before 1.11.6):
+        # /C=FR/OU=Product/CN=Product Demo, root first and unescaped
+        pairs = []
+        for part in dn[1:].split('/'):
+            name, sep, value = part.partition('=')
+            if not sep or not name.strip():
+                raise ValueError(f'Malformed DN component {part!r}')
+            pairs.append((name.strip().upper(), value.strip()))
+        return tuple(reversed(pairs))
+
+    pairs = []
+    name = None
+    value = bytearray()
+
+    def finish():
+        if not name:
+            raise ValueError(f'Malformed DN {dn!r}')
+        pairs.append((name, value.decode('utf-8').strip()))
+
+    i = 0
+    while i < len(dn):
+        char = dn[i]
+        if char == '\\':
+            # \, and the like, or \XX for a byte of the UTF-8 value
+            pair = dn[i + 1:i + 3]
+            if len(pair) == 2 and all(c in string.hexdigits for c in pair):
+                value.append(int(pair, 16))
+                i += 3
+                continue
+            if i + 1 == len(dn):
+                raise ValueError(f'Malformed DN {dn!r}')
+            value += dn[i + 1].encode()
+            i += 2
+            continue
+        if name is None and char == '=':
+            name = value.decode('utf-8').strip().upper()
+            value = bytearray()
+        elif name is not None and char in ',+;':
+            finish()
+            name = None
+            value = bytearray()
+        else:
+            value += char.encode()
+        i += 1
+    if name is not None or value.strip():
+        finish()
+    return tuple(pairs)
+
+
+def format_dn(attributes):
+    """The canonical RFC 4514 string of (type, value) pairs."""
+    def escape(value):
+        value = DN_SPECIAL.sub(r'\\\1', value)
+        if value.startswith(('#', ' ')):
+            value = '\\' + value
+        if value.endswith(' '):
+            value = value[:-1] + '\\ '
+        return value
+    return ','.join(f'{name}={escape(value)}' for name, value in attributes)
+
+
+def normalize_fingerprint(fingerprint):
+    """Lowercase hex without separators, or None if it is not a SHA-1 or SHA-256 fingerprint."""
+    fingerprint = re.sub(r'[\s:]', '', fingerprint or '').lower()
+    return fingerprint if FINGERPRINT.fullmatch(fingerprint) else None
+
+
+@functools.lru_cache(maxsize=4096)
+def identity_from_headers(subject_dn, fingerprint):
+    """The CertificateIdentity of the header values, or None if they identify nothing."""
+    try:
+        attributes = parse_dn(subject_dn or '')
+    except ValueError:
+        attributes = ()
+    fingerprint = normalize_fingerprint(fingerprint)
+    if not attributes and not fingerprint:
+        return None
+    return CertificateIdentity(format_dn(attributes), attributes, fingerprint)
@@ -1,17 +1,131 @@
 from flask import Flask, request, render_template, redirect, url_for, session
+import math
+import os
+import sys
+
+# demo_common is shared with the other demo app, one directory up (mounted
+# at /demo_common in the Docker setup)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.auth_check import decision_response
+from demo_common.instrumentation import instrument_from_env
+from demo_common.passwords import PasswordHasher, hasher_from_string
+from demo_common.rate_limit import LoginLimiter
+from demo_common.sessions import session_interface_from_env, shared_state_path
+from demo_common.user_repository import UserRepository
+from cert_identity import identity_from_headers
+from revocation import GOOD, REVOKED, UNKNOWN, checker_from_env
 
 app = Flask(__name__)
+# Per-route timings (GET /debug/requests in debug mode) and optional sampled profiling
+request_log = instrument_from_env(app, os.path.dirname(os.path.abspath(__file__)))
 
 # used for flask encrypting session data and other security-related functions
 app.secret_key = 'demo_secret_key'
 
-# Define a simple in-memory database of user credentials
-# Replace this with a database in a real application
-users = {'demo': {'password': 'changeme'}}
+# Sessions are kept server-side, the cookie only holds their ID (shared by the gunicorn workers);
+# MFA_SESSION_STORE=cookie for Flask's signed cookie sessions
+session_interface = session_interface_from_env('sqlite', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.db'))
+if session_interface:
+    app.session_interface = session_interface
+# Login limits go to the same database as the sessions when they are
+# shared, or every worker would keep its own
+SHARED_STATE_PATH = shared_state_path('sqlite', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.db'))
+
+# User credentials, in a SQLite database shared by all the gunicorn workers;
+# the demo user is created on first start
+users = UserRepository(os.environ.get('MFA_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')))
+users.add('demo', 'changeme')
+
+# Attempts per client IP, and failed passwords per username
+login_limiter = LoginLimiter(path=SHARED_STATE_PATH)
+
+# Passwords are verified in a pool, and re-hashed on login when stored in
+# plaintext or with older parameters, e.g. MFA_PASSWORD_HASHER=scrypt:n=32768,r=8,p=1
+password_hasher = PasswordHasher(hasher_from_string(os.environ.get('MFA_PASSWORD_HASHER', 'scrypt')),
+                                 processes=os.environ.get('MFA_PASSWORD_POOL') == 'process')
+
+# Seconds nginx may cache an allowed /auth decision
+AUTH_CACHE_TTL = int(os.environ.get('MFA_AUTH_CACHE_TTL', '10'))
+
+# A verified client certificate bound to a user signs in without a password
+# on these pages; MFA_CERT_LOGIN=0 always asks for the password
+CERT_LOGIN = os.environ.get('MFA_CERT_LOGIN', '1') == '1'
+CERT_LOGIN_ENDPOINTS = {'home', 'secure_page'}
+# A password login binds the certificate's fingerprint to the user. With
+# MFA_CERT_BIND_DN=1 its subject DN is bound too, so any certificate with
+# that subject signs in; MFA_CERT_REBIND=1 moves a certificate bound to
+# another user instead of leaving it where it is
+CERT_BIND_DN = os.environ.get('MFA_CERT_BIND_DN') == '1'
+CERT_REBIND = os.environ.get('MFA_CERT_REBIND') == '1'
+
+# CRLs and OCSP responses refreshed in the background (MFA_CRL_URLS,
+# MFA_OCSP_URL); None when neither is set, nginx's chain check only
+revocation_checker = checker_from_env(os.path.dirname(os.path.abspath(__file__)))
+
+def client_ip():
+    # The app is only reachable through nginx, which sets X-Real-IP
+    return request.headers.get('X-Real-IP', request.remote_addr)
+
+def client_certificate():
+    # The certificate nginx verified for this request, parsed once per distinct header value
+    if request.headers.get('X-Client-Verified') != 'SUCCESS':
+        return None
+    return identity_from_headers(request.headers.get('X-Subject-DN'), request.headers.get('X-Client-Fingerprint'))
+
+def certificate_user(identity):
+    # Bound by fingerprint first, then by subject DN
+    for key in identity.index_keys():
+        username = users.user_for_certificate(key)
+        if username is not None:
+            return username
+    return None
+
+@app.before_request
+def limit_login_attempts():
+    # Login submissions are limited before any other work is done
+    if request.method != 'POST' or request.endpoint != 'login':
+        return None
+    wait = login_limiter.check(client_ip(), request.form.get('username'))
+    if wait:
+        return 'Too many attempts, try again later', 429, {'Retry-After': str(math.ceil(wait))}
+    return None
+
+@app.before_request
+def reject_revoked_certificates():
+    # Answered from the cached CRLs and OCSP responses, never waits on the network
+    if revocation_checker is None or request.headers.get('X-Client-Verified') != 'SUCCESS':
+        return None
+    status = revocation_checker.status(request.headers.get('X-Client-Issuer-DN'), request.headers.get('X-Client-Serial'))
+    if status == GOOD or (status == UNKNOWN and revocation_checker.soft_fail):
+        return None
+    if request.endpoint == 'auth':
+        # nginx auth_request takes anything but 2xx, 401 and 403 for an error
+        if status == REVOKED:
+            session.clear()
+        return decision_response(app, None, AUTH_CACHE_TTL)
+    if status == UNKNOWN:
+        # Checked in the background, the answer is usually in within a second
+        return 'Client certificate not checked yet, try again shortly', 503, {'Retry-After': '1'}
+    session.clear()
+    return 'Client certificate revoked', 403
+
+@app.before_request
+def login_with_certificate():
+    identity = client_certificate()
+    # A session belongs to the certificate it was opened with
+    if session.get('certificate') and (identity is None or session['certificate'] not in identity.index_keys()):
+        session.clear()
+    if not CERT_LOGIN or request.endpoint not in CERT_LOGIN_ENDPOINTS or session.get('authenticated'):
+        return None
+    username = certificate_user(identity) if identity is not None else None
+    if username is not None:
+        session['authenticated'] = True
+        session['username'] = username
+        session['certificate'] = identity.index_keys()[0]
+    return None
 
 @app.route('/')
 def home():
-    print(users)
     # Check if user is authenticated
     if not session.get('authenticated'):
         # Redirect to login page if not authenticated
@@ -20,22 +134,37 @@ def home():
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    print(users)
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         
         # Authenticate user
-        if username in users and users[username]['password'] == password:
+        user = users.get(username)
+        matches, upgraded = password_hasher.verify(password, user['password'] if user else None)
+        if matches:
+            if upgraded:
+                users.update(username, password=upgraded)
             session['authenticated'] = True
+            session['username'] = username
+            login_limiter.succeeded(username)
+            # The certificate used for this login signs the user in next time
+            identity = client_certificate()
+            if identity is not None:
+                keys = [f'fingerprint:{identity.fingerprint}'] if identity.fingerprint else []
+                if CERT_BIND_DN and identity.dn:
+                    keys.append(f'dn:{identity.dn}')
+                for key in keys:
+                    if users.user_for_certificate(key) != username:
+                        users.bind_certificate(key, username, replace=CERT_REBIND)
+                session['certificate'] = identity.index_keys()[0]
             return redirect(url_for('secure_page'))
         else:
+            login_limiter.failed(username)
             return 'Invalid username or password', 401
     return render_template('login.html')  # Render your login page template here
 
 @app.route('/logout', methods=['POST'])
 def logout():
-    print(users)
     # Clear session data
     session.pop('authenticated', None)
     session.clear()
@@ -43,7 +172,6 @@ def logout():
 
 @app.route('/secure')
 def secure_page():
-    print(users)
     # This endpoint now requires user authentication before proceeding
     if not session.get('authenticated'):
         return redirect(url_for('login'))
@@ -58,5 +186,26 @@ def secure_page():
     else:
         return 'Secure Page - Client SSL authentication failed.', 401
 
+@app.route('/auth')
+def auth():
+    # For nginx auth_request: a verified client certificate and either a
+    # session or a certificate bound to a user, checked without rendering
+    # anything. No session is opened here, nginx does not pass its cookie on
+    identity = client_certificate()
+    username = None
+    ttl = AUTH_CACHE_TTL
+    if identity is not None:
+        if session.get('authenticated'):
+            username = session.get('username', '')
+        elif CERT_LOGIN:
+            username = certificate_user(identity)
+            # nginx caches decisions by session cookie, and this request has
+            # none: every other client without one would share the answer
+            ttl = 0
+    if username is not None:
+        return decision_response(app, username, ttl,
+                                 {'X-Subject-DN': request.headers.get('X-Subject-DN', '')})
+    return decision_response(app, None, AUTH_CACHE_TTL)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,259 @@
+"""Revocation checking of client certificates for the MFA-CAC app.
+
+nginx only checks that a client certificate chains up to combined.pem,
+so a revoked card keeps working. RevocationChecker answers whether a
+certificate (issuer DN and serial, as nginx passes them) is revoked
+without any network call on the request path:
+
+- CRLs are fetched from crl_urls, their signature checked against the
+  issuing CA, and their serials kept in a set per issuer, replaced as a
+  whole on every refresh: a check is one set lookup.
+- For issuers without a CRL, OCSP responses from ocsp_url are cached
+  until their nextUpdate. A certificate seen for the first time is
+  queued, and answers unknown until the response is in; one that is
+  about to expire is queued again while its cached answer still holds.
+
+Fetching is done by a background thread: CRLs every refresh_interval
+seconds, OCSP as soon as something is queued. When a fetch fails the
+last good CRL is kept. Unknown is accepted with soft_fail (the default)
+and refused otherwise.
+
+checker_from_env reads:
+    MFA_CRL_URLS              CRL URLs or file paths, space separated
+    MFA_OCSP_URL              OCSP responder URL
+    MFA_CA_FILE               CA certificates issuing client certificates
+    MFA_REVOCATION_REFRESH    seconds between CRL refreshes (300)
+    MFA_REVOCATION_SOFT_FAIL  0 to refuse certificates of unknown status
+"""
+import collections
+import datetime
+import functools
+import hashlib
+import logging
+import os
+import threading
+import time
+import urllib.request
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+from cert_identity import format_dn, parse_dn
+
+GOOD = 'good'
+REVOKED = 'revoked'
+UNKNOWN = 'unknown'
+
+# Named as nginx names it, not by OID
+NAME_ATTRIBUTES = {NameOID.EMAIL_ADDRESS: 'emailAddress'}
+
+
+def canonical_name(name):
+    """The canonical DN string of an x509.Name, as cert_identity formats header values."""
+    return format_dn(parse_dn(name.rfc4514_string(NAME_ATTRIBUTES)))
+
+
+@functools.lru_cache(maxsize=1024)
+def canonical_issuer(issuer_dn):
+    try:
+        return format_dn(parse_dn(issuer_dn or ''))
+    except ValueError:
+        return None
+
+
+def fetch_url(url, data=None, content_type=None, timeout=10):
+    """The body at url (or the contents of a file path), POSTing data if given."""
+    if '://' not in url:
+        with open(url, 'rb') as f:
+            return f.read()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': content_type} if content_type else {})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def verify_signature(public_key, signature, data, hash_algorithm):
+    """Raise InvalidSignature unless signature is public_key's over data."""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        public_key.verify(signature, data, padding.PKCS1v15(), hash_algorithm)
+    elif isinstance(public_key, ec.EllipticCurvePublicKey):
+        public_key.verify(signature, data, ec.ECDSA(hash_algorithm))
+    else:
+        public_key.verify(signature, data)
+
+
+class RevocationChecker:
+    # Seconds before a cached OCSP failure is tried again
+    FAILURE_RETRY = 30
+    # Cached OCSP answers are refreshed this many seconds before they expire
+    REFRESH_MARGIN = 60
+
+    def __init__(self, issuers, crl_urls=(), ocsp_url=None, refresh_interval=300, soft_fail=True,
+                 max_responses=100000, max_pending=1000, fetch=fetch_url):
+        # canonical DN -> CA certificate
+        self.issuers = {canonical_name(issuer.subject): issuer for issuer in issuers}
+        # canonical DN -> SHA-1 of the CA name and key, as OCSP requests name the CA;
+        # the key hash is the one a subject key identifier is made of
+        self.issuer_hashes = {dn: (hashlib.sha1(issuer.subject.public_bytes()).digest(),
+                                   x509.SubjectKeyIdentifier.from_public_key(issuer.public_key()).digest)
+                              for dn, issuer in self.issuers.items()}
+        self.crl_urls = list(crl_urls)
+        self.ocsp_url = ocsp_url
+        self.refresh_interval = refresh_interval
+        self.soft_fail = soft_fail
+        self.max_responses = max_responses
+        self.max_pending = max_pending
+        self.fetch = fetch
+        # canonical issuer DN -> frozenset of revoked serials, replaced as a whole
+        self.revoked = {}
+        # (canonical issuer DN, serial) -> (status, expiry), least recently fetched first
+        self.responses = collections.OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def status(self, issuer_dn, serial):
+        """GOOD, REVOKED or UNKNOWN for the header values of a certificate; never waits on the network."""
+        issuer = canonical_issuer(issuer_dn)
+        try:
+            serial = int(serial, 16)
+        except (TypeError, ValueError):
+            return UNKNOWN
+        revoked = self.revoked.get(issuer)
+        if revoked is not None:
+            return REVOKED if serial in revoked else GOOD
+        if not self.ocsp_url or issuer not in self.issuers:
+            return UNKNOWN
+        key = (issuer, serial)
+        now = time.time()
+        with self.lock:
+            entry = self.responses.get(key)
+            if entry is not None and entry[1] > now:
+                if entry[1] - now < self.REFRESH_MARGIN and entry[0] != UNKNOWN:
+                    self._queue(key)
+                return entry[0]
+            self._queue(key)
+        return UNKNOWN
+
+    def allowed(self, issuer_dn, serial):
+        status = self.status(issuer_dn, serial)
+        return status == GOOD or (status == UNKNOWN and self.soft_fail)
+
+    def _queue(self, key):
+        # Called with the lock held
+        if key not in self.pending and len(self.pending) < self.max_pending:
+            self.pending.add(key)
+            self.wakeup.set()
+
+    def refresh_crls(self):
+        """Fetch every CRL; an issuer keeps its last good set when its CRL cannot be used."""
+        revoked = dict(self.revoked)
+        for url in self.crl_urls:
+            try:
+                data = self.fetch(url)
+                crl = x509.load_der_x509_crl(data) if data[:1] == b'\x30' else x509.load_pem_x509_crl(data)
+                issuer_dn = canonical_name(crl.issuer)
+                issuer = self.issuers.get(issuer_dn)
+                if issuer is None:
+                    raise ValueError(f'CRL issued by unknown CA {issuer_dn}')
+                if not crl.is_signature_valid(issuer.public_key()):
+                    raise InvalidSignature('CRL signature does not match its issuer')
+                if crl.next_update_utc is not None and crl.next_update_utc < datetime.datetime.now(datetime.timezone.utc):
+                    logging.warning("CRL from %s is past its nextUpdate", url)
+                revoked[issuer_dn] = frozenset(entry.serial_number for entry in crl)
+            except Exception as e:
+                logging.warning("Could not refresh the CRL from %s: %s", url, e)
+        self.revoked = revoked
+
+    def ocsp_status(self, issuer_dn, serial):
+        """Ask the OCSP responder; return (status, expiry)."""
+        issuer = self.issuers[issuer_dn]
+        name_hash, key_hash = self.issuer_hashes[issuer_dn]
+        request = ocsp.OCSPRequestBuilder().add_certificate_by_hash(name_hash, key_hash, serial, hashes.SHA1()).build()
+        response = ocsp.load_der_ocsp_response(self.fetch(self.ocsp_url, request.public_bytes(serialization.Encoding.DER),
+                                                          'application/ocsp-request'))
+        if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+            raise ValueError(f'OCSP responder answered {response.response_status.name}')
+        if response.serial_number != serial or response.issuer_key_hash != key_hash:
+            raise ValueError('OCSP response is for another certificate')
+        verify_signature(self._ocsp_signer(response, issuer).public_key(), response.signature,
+                         response.tbs_response_bytes, response.signature_hash_algorithm)
+        now = time.time()
+        if response.this_update_utc.timestamp() > now + 300:
+            raise ValueError('OCSP response is from the future')
+        expiry = response.next_update_utc.timestamp() if response.next_update_utc else now + self.refresh_interval
+        if expiry <= now:
+            raise ValueError('OCSP response has expired')
+        if response.certificate_status == ocsp.OCSPCertStatus.GOOD:
+            return GOOD, expiry
+        if response.certificate_status == ocsp.OCSPCertStatus.REVOKED:
+            return REVOKED, expiry
+        return UNKNOWN, expiry
+
+    @staticmethod
+    def _ocsp_signer(response, issuer):
+        # Signed by the CA itself, or by a responder certificate it issued for OCSP
+        for certificate in response.certificates:
+            try:
+                certificate.verify_directly_issued_by(issuer)
+                usage = certificate.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value
+            except (ValueError, TypeError, InvalidSignature, x509.ExtensionNotFound):
+                continue
+            if ExtendedKeyUsageOID.OCSP_SIGNING in usage:
+                return certificate
+        return issuer
+
+    def refresh_ocsp(self):
+        """Fetch the OCSP status of every queued certificate."""
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        for issuer_dn, serial in pending:
+            try:
+                entry = self.ocsp_status(issuer_dn, serial)
+            except Exception as e:
+                logging.warning("OCSP check of serial %X failed: %s", serial, e)
+                entry = (UNKNOWN, time.time() + self.FAILURE_RETRY)
+            with self.lock:
+                self.responses[(issuer_dn, serial)] = entry
+                self.responses.move_to_end((issuer_dn, serial))
+                while len(self.responses) > self.max_responses:
+                    self.responses.popitem(last=False)
+
+    def run(self):
+        next_crls = 0
+        while not self.stopped.is_set():
+            if self.crl_urls and time.monotonic() >= next_crls:
+                self.refresh_crls()
+                next_crls = time.monotonic() + self.refresh_interval
+            self.wakeup.clear()
+            self.refresh_ocsp()
+            self.wakeup.wait(max(0, min(next_crls - time.monotonic(), self.refresh_interval)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='revocation-refresh', daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def checker_from_env(directory):
+    """A started RevocationChecker from the MFA_* environment variables, or None if nothing is configured."""
+    crl_urls = os.environ.get('MFA_CRL_URLS', '').split()
+    ocsp_url = os.environ.get('MFA_OCSP_URL')
+    if not crl_urls and not ocsp_url:
+        return None
+    with open(os.environ.get('MFA_CA_FILE', os.path.join(directory, 'combined.pem')), 'rb') as f:
+        issuers = x509.load_pem_x509_certificates(f.read())
+    return RevocationChecker(issuers, crl_urls, ocsp_url,
+                             refresh_interval=float(os.environ.get('MFA_REVOCATION_REFRESH', '300')),
+                             soft_fail=os.environ.get('MFA_REVOCATION_SOFT_FAIL', '1') == '1').start()
@@ -0,0 +1,165 @@
+"""Local stand-in CRL and OCSP responder for the MFA-CAC app.
+
+Makes a throwaway CA (or loads one), and serves for a list of revoked
+serials:
+    GET  /crl.der   a CRL signed by the CA, valid for --validity seconds
+    POST /ocsp      OCSP responses signed by the CA, with the same validity
+
+Any serial not in the list is good. Client certificates for the demo can
+be issued by the same CA with --issue, to try revocation end to end:
+
+    python3 revocation_responder.py --issue 'Product Demo'
+    python3 revocation_responder.py --revoked 1000 2A3B
+    MFA_CA_FILE=revocation_ca.pem MFA_CRL_URLS=http://127.0.0.1:8889/crl.der python3 demo_app_mfa_cac.py
+
+Serials are hexadecimal, as nginx passes them in $ssl_client_serial.
+"""
+import argparse
+import datetime
+import os
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import NameOID
+from flask import Flask, request
+
+
+def make_ca(common_name='Demo Revocation CA'):
+    """A new self-signed CA certificate and its key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=365))
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+                   .sign(key, hashes.SHA256()))
+    return certificate, key
+
+
+def issue(ca_certificate, ca_key, common_name, serial=None):
+    """A client certificate for common_name issued by the CA, and its key."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+                   .issuer_name(ca_certificate.subject)
+                   .public_key(key.public_key())
+                   .serial_number(serial or x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=90))
+                   .sign(ca_key, hashes.SHA256()))
+    return certificate, key
+
+
+class StandInResponder:
+    def __init__(self, ca_certificate, ca_key, revoked_serials=(), validity=300):
+        self.ca_certificate = ca_certificate
+        self.ca_key = ca_key
+        self.revoked = set(revoked_serials)
+        self.validity = datetime.timedelta(seconds=validity)
+        # Revoked at start-up, for the lists and responses
+        self.revoked_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=5)
+        self.crl = None
+        self.crl_expiry = None
+
+    def crl_der(self):
+        """The CRL, signed again once half of its validity has passed."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self.crl is None or now > self.crl_expiry - self.validity / 2:
+            # Given all at once: add_revoked_certificate copies the list on every call
+            builder = x509.CertificateRevocationListBuilder(
+                issuer_name=self.ca_certificate.subject,
+                last_update=now,
+                next_update=now + self.validity,
+                revoked_certificates=[x509.RevokedCertificateBuilder().serial_number(serial)
+                                      .revocation_date(self.revoked_at).build() for serial in self.revoked])
+            self.crl = builder.sign(self.ca_key, hashes.SHA256()).public_bytes(serialization.Encoding.DER)
+            self.crl_expiry = now + self.validity
+        return self.crl
+
+    def ocsp_der(self, request_der):
+        try:
+            ocsp_request = ocsp.load_der_ocsp_request(request_der)
+        except ValueError:
+            return ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.MALFORMED_REQUEST).public_bytes(serialization.Encoding.DER)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        revoked = ocsp_request.serial_number in self.revoked
+        # The request only names the certificate by hash, it is not needed
+        # here: the CA signs the response itself
+        builder = ocsp.OCSPResponseBuilder().add_response_by_hash(
+            issuer_name_hash=ocsp_request.issuer_name_hash,
+            issuer_key_hash=ocsp_request.issuer_key_hash,
+            serial_number=ocsp_request.serial_number,
+            algorithm=ocsp_request.hash_algorithm,
+            cert_status=ocsp.OCSPCertStatus.REVOKED if revoked else ocsp.OCSPCertStatus.GOOD,
+            this_update=now,
+            next_update=now + self.validity,
+            revocation_time=self.revoked_at if revoked else None,
+            revocation_reason=None,
+        ).responder_id(ocsp.OCSPResponderEncoding.HASH, self.ca_certificate)
+        return builder.sign(self.ca_key, hashes.SHA256()).public_bytes(serialization.Encoding.DER)
+
+    def app(self):
+        app = Flask(__name__)
+
+        @app.route('/crl.der')
+        def crl():
+            return self.crl_der(), 200, {'Content-Type': 'application/pkix-crl'}
+
+        @app.route('/ocsp', methods=['POST'])
+        def ocsp_response():
+            return self.ocsp_der(request.get_data()), 200, {'Content-Type': 'application/ocsp-response'}
+
+        return app
+
+
+def load_or_make_ca(certificate_path, key_path):
+    if os.path.exists(certificate_path) and os.path.exists(key_path):
+        with open(certificate_path, 'rb') as f:
+            certificate = x509.load_pem_x509_certificate(f.read())
+        with open(key_path, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None)
+        return certificate, key
+    certificate, key = make_ca()
+    with open(certificate_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certificate, key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ca-cert', default='revocation_ca.pem', help='CA certificate, created if missing')
+    parser.add_argument('--ca-key', default='revocation_ca.key', help='CA private key, created if missing')
+    parser.add_argument('--revoked', nargs='*', default=[], help='revoked serials, in hexadecimal')
+    parser.add_argument('--validity', type=int, default=300, help='seconds a CRL or OCSP response is valid')
+    parser.add_argument('--issue', metavar='COMMON_NAME', help='write a client certificate and key for COMMON_NAME, then exit')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8889)
+    args = parser.parse_args()
+
+    ca_certificate, ca_key = load_or_make_ca(args.ca_cert, args.ca_key)
+    if args.issue:
+        certificate, key = issue(ca_certificate, ca_key, args.issue)
+        with open('client_cert.crt', 'wb') as f:
+            f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        with open('client_privkey.key', 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+        print(f"client_cert.crt issued to {args.issue}, serial {certificate.serial_number:X}")
+        return
+    responder = StandInResponder(ca_certificate, ca_key, (int(serial, 16) for serial in args.revoked), args.validity)
+    responder.app().run(host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault('MFA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'users.db'))
+os.environ.setdefault('MFA_SESSION_STORE', 'memory')
+os.environ.setdefault('MFA_PASSWORD_HASHER', 'pbkdf2_sha256:iterations=1000')
+import demo_app_mfa_cac
+
+DN = 'CN=Shared Card,OU=Product,C=FR'
+
+
+def certificate(fingerprint, dn=DN):
+    return {'X-Client-Verified': 'SUCCESS', 'X-Subject-DN': dn, 'X-Client-Fingerprint': fingerprint}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(demo_app_mfa_cac, 'CERT_BIND_DN', False)
+    monkeypatch.setattr(demo_app_mfa_cac, 'CERT_REBIND', False)
+    # A fresh limiter per test, or the per-IP login limit would kick in
+    monkeypatch.setattr(demo_app_mfa_cac, 'login_limiter', demo_app_mfa_cac.LoginLimiter())
+    return demo_app_mfa_cac
+
+
+def login(app, username, headers):
+    app.users.add(username, 'secret')
+    response = app.app.test_client().post('/login', headers=headers, data={'username': username, 'password': 'secret'})
+    assert response.status_code == 302
+
+
+def signed_in_as(app, headers):
+    """The user a new connection with these certificate headers is signed in as, or None."""
+    response = app.app.test_client().get('/auth', headers=headers)
+    return response.headers.get('X-Auth-User') if response.status_code == 200 else None
+
+
+def test_only_the_fingerprint_is_bound_by_default(app):
+    login(app, 'alice', certificate('a1' * 20))
+    assert signed_in_as(app, certificate('a1' * 20)) == 'alice'
+    # Another certificate with the same subject DN
+    assert signed_in_as(app, certificate('a2' * 20)) is None
+
+
+def test_subject_dn_is_bound_when_enabled(app):
+    app.CERT_BIND_DN = True
+    dn = 'CN=Re-issued Card,C=FR'
+    login(app, 'carol', certificate('c1' * 20, dn))
+    assert signed_in_as(app, certificate('c2' * 20, dn)) == 'carol'
+
+
+def test_binding_to_another_user_is_kept(app):
+    shared = certificate('b1' * 20, 'CN=Test Card,C=FR')
+    login(app, 'bob', shared)
+    login(app, 'mallory', shared)
+    assert signed_in_as(app, shared) == 'bob'
+
+
+def test_binding_moves_when_rebind_is_enabled(app):
+    app.CERT_REBIND = True
+    shared = certificate('d1' * 20, 'CN=Lab Card,C=FR')
+    login(app, 'dave', shared)
+    login(app, 'erin', shared)
+    assert signed_in_as(app, shared) == 'erin'
+
+
+def test_unknown_revocation_status_is_a_denial_at_auth(app, monkeypatch):
+    from revocation import RevocationChecker
+    from revocation_responder import make_ca
+
+    ca_certificate, _ = make_ca()
+    # Never started: every certificate stays of unknown status
+    checker = RevocationChecker([ca_certificate], ocsp_url='http://127.0.0.1:9/ocsp', soft_fail=False)
+    monkeypatch.setattr(app, 'revocation_checker', checker)
+    headers = dict(certificate('e1' * 20), **{'X-Client-Issuer-DN': ca_certificate.subject.rfc4514_string(),
+                                             'X-Client-Serial': '1A2B'})
+    client = app.app.test_client()
+    assert client.get('/auth', headers=headers).status_code == 401
+    assert client.get('/secure', headers=headers).status_code == 503
+
+
+def test_certificate_only_decisions_are_not_cached(app):
+    headers = certificate('f1' * 20)
+    login(app, 'frank', headers)
+    response = app.app.test_client().get('/auth', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Expires'] == '0'
+
+
+def test_login_without_a_password_is_refused(app):
+    app.users.add('grace', 'secret')
+    response = app.app.test_client().post('/login', headers=certificate('a7' * 20), data={'username': 'grace'})
+    assert response.status_code == 401
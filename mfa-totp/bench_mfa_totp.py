@@ -0,0 +1,213 @@
+"""Micro-benchmarks for the demo MFA-TOTP app.
+
+Usage:
+    python3 bench_mfa_totp.py verify --users 1000 --attempts 200000
+    python3 bench_mfa_totp.py replay --users 100000 --logins 2000000 --max-used-codes 50000
+    python3 bench_mfa_totp.py qr --enrollments 500 --workers 0 2
+    python3 bench_mfa_totp.py auth --requests 20000 --items 2000 --batch-sizes 1 10 100
+"""
+import argparse
+import base64
+import io
+import itertools
+import os
+import random
+import re
+import tempfile
+import time
+
+import pyotp
+import qrcode
+
+# Users of the benchmarks go to a throwaway database
+os.environ.setdefault('MFA_DB_PATH', os.path.join(tempfile.mkdtemp(), 'users.db'))
+import demo_app_mfa_totp
+from qr_render import QrRenderer
+from totp_cache import TotpVerifier
+
+# /api/verify is disabled without a token
+demo_app_mfa_totp.API_TOKEN = 'bench-token'
+
+
+def bench_verify(args):
+    secrets = [pyotp.random_base32() for _ in range(args.users)]
+    now = time.time()
+    # A mix of valid and wrong codes, as seen at a login form
+    attempts = []
+    for i in range(args.attempts):
+        user = random.randrange(args.users)
+        code = pyotp.TOTP(secrets[user]).at(now) if i % 2 else '000000'
+        attempts.append((f'user{user}', secrets[user], code))
+
+    start = time.perf_counter()
+    for username, secret, code in attempts:
+        pyotp.TOTP(secret).verify(code, now)
+    uncached = time.perf_counter() - start
+
+    verifier = TotpVerifier(max_verifiers=args.users)
+    start = time.perf_counter()
+    for username, secret, code in attempts:
+        verifier.verifier(username, secret).matching_step(code, now)
+    cached = time.perf_counter() - start
+
+    # Replay checks included: most of the valid codes are replays here
+    verifier = TotpVerifier(max_verifiers=args.users)
+    start = time.perf_counter()
+    for username, secret, code in attempts:
+        verifier.verify(username, secret, code, now)
+    full = time.perf_counter() - start
+
+    for label, seconds in (('pyotp.TOTP per attempt', uncached), ('cached verifier', cached),
+                           ('cached verifier + replay check', full)):
+        print(f"{label}: {args.attempts / seconds:,.0f} verifications/s ({seconds / args.attempts * 1e6:.1f} us each)")
+
+
+def bench_replay(args):
+    """Logins spread evenly over simulated time: the used-code set stays bounded."""
+    verifier = TotpVerifier(max_verifiers=args.users, max_used_codes=args.max_used_codes)
+    secrets = [pyotp.random_base32() for _ in range(args.users)]
+    duration = args.logins / args.rate
+    largest = 0
+    replays = 0
+    start = time.perf_counter()
+    for i in range(args.logins):
+        now = 1700000000 + i / args.rate
+        user = random.randrange(args.users)
+        totp = verifier.verifier(f'user{user}', secrets[user])
+        code = totp.generate_otp(int(now // totp.interval))
+        if not verifier.verify(f'user{user}', secrets[user], code, now):
+            replays += 1
+        largest = max(largest, len(verifier.used_codes))
+    elapsed = time.perf_counter() - start
+    print(f"{args.logins} logins over {duration:,.0f} simulated seconds ({args.rate:,} logins/s) "
+          f"in {elapsed:.2f}s")
+    print(f"used codes: at most {largest} entries (cap {args.max_used_codes}), "
+          f"{len(verifier.used_codes)} at the end")
+    print(f"rejected as replays: {replays} (same user twice in one time step)")
+
+
+enrollments = itertools.count()
+
+
+def enroll(client, username):
+    """Log in as a new user and go through the setup page and its QR code; return (page, image) seconds."""
+    demo_app_mfa_totp.users.add(username, 'changeme')
+    # One client address per enrollment, or the login rate limit would kick in
+    visit = next(enrollments)
+    address = f'10.{visit // 65536 % 256}.{visit // 256 % 256}.{visit % 256}'
+    response = client.post('/login', data={'username': username, 'password': 'changeme'},
+                           environ_base={'REMOTE_ADDR': address})
+    assert response.status_code == 302, response.status_code
+    start = time.perf_counter()
+    page = client.get('/setup-mfa').get_data(as_text=True)
+    page_seconds = time.perf_counter() - start
+    image = client.get(re.search(r'<img src="([^"]+)"', page).group(1))
+    assert image.status_code == 200, image.status_code
+    return page_seconds, time.perf_counter() - start - page_seconds
+
+
+def bench_qr(args):
+    # Before: the QR code rendered on the request thread and inlined as base64
+    start = time.perf_counter()
+    for i in range(args.enrollments):
+        totp_uri = pyotp.totp.TOTP(pyotp.random_base32()).provisioning_uri(name=f'user{i}', issuer_name='Demo MFA GG')
+        buffered = io.BytesIO()
+        qrcode.make(totp_uri).save(buffered, format="PNG")
+        base64.b64encode(buffered.getvalue()).decode()
+    inline = time.perf_counter() - start
+    print(f"inline png + base64 (rendering only): {args.enrollments / inline:,.0f} enrollments/s")
+
+    demo_app_mfa_totp.qr_renderer.close()
+    for workers in args.workers:
+        for fmt in args.formats:
+            demo_app_mfa_totp.qr_renderer = QrRenderer(workers=workers)
+            demo_app_mfa_totp.QR_FORMAT = fmt
+            client = demo_app_mfa_totp.app.test_client()
+            # Start the worker processes before timing
+            enroll(client, f'warmup-{fmt}-{workers}')
+            page_total = image_total = 0
+            start = time.perf_counter()
+            for i in range(args.enrollments):
+                page_seconds, image_seconds = enroll(client, f'{fmt}-{workers}-{i}')
+                page_total += page_seconds
+                image_total += image_seconds
+            elapsed = time.perf_counter() - start
+            demo_app_mfa_totp.qr_renderer.close()
+            print(f"{fmt}, {workers} worker(s): {args.enrollments / elapsed:,.0f} enrollments/s, "
+                  f"setup page {page_total / args.enrollments * 1000:.2f} ms, "
+                  f"image {image_total / args.enrollments * 1000:.2f} ms")
+
+
+def per_second(client, path, requests, status):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(path)
+    assert response.status_code == status, response.status_code
+    return requests / (time.perf_counter() - start)
+
+
+def bench_auth(args):
+    app = demo_app_mfa_totp.app
+    users = demo_app_mfa_totp.users
+    anonymous = app.test_client()
+    client = app.test_client()
+    users.add('bench', 'changeme', mfa_secret_key=pyotp.random_base32())
+    client.post('/login', data={'username': 'bench', 'password': 'changeme'})
+    client.post('/verify-mfa', data={'totp_code': pyotp.TOTP(users.get('bench')['mfa_secret_key']).now()})
+    for label, test_client, path, status in (('/auth, signed in', client, '/auth', 200),
+                                             ('/auth, signed out', anonymous, '/auth', 401),
+                                             ('/protected page, signed in', client, '/protected', 200)):
+        print(f"{label}: {per_second(test_client, path, args.requests, status):,.0f} decisions/s")
+
+    # Every item a different user: codes are single-use
+    secrets = {f'batch{i}': pyotp.random_base32() for i in range(args.items)}
+    for username, secret in secrets.items():
+        users.add(username, 'changeme', replace=True, mfa_secret_key=secret)
+    headers = {'Authorization': f'Bearer {demo_app_mfa_totp.API_TOKEN}'}
+    for batch_size in args.batch_sizes:
+        demo_app_mfa_totp.totp_verifier = TotpVerifier()
+        items = [{'username': username, 'code': pyotp.TOTP(secret).now()} for username, secret in secrets.items()]
+        valid = 0
+        start = time.perf_counter()
+        for offset in range(0, len(items), batch_size):
+            response = client.post('/api/verify', headers=headers, json={'items': items[offset:offset + batch_size]})
+            valid += sum(result['valid'] for result in response.get_json()['results'])
+        elapsed = time.perf_counter() - start
+        print(f"/api/verify, {batch_size} per call: {len(items) / elapsed:,.0f} verifications/s "
+              f"({valid}/{len(items)} valid)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    verify_parser = subparsers.add_parser('verify', help='verification throughput, pyotp vs cached verifiers')
+    verify_parser.add_argument('--users', type=int, default=1000)
+    verify_parser.add_argument('--attempts', type=int, default=200000)
+    verify_parser.set_defaults(func=bench_verify)
+
+    replay_parser = subparsers.add_parser('replay', help='size of the used-code set under sustained logins')
+    replay_parser.add_argument('--users', type=int, default=100000)
+    replay_parser.add_argument('--logins', type=int, default=2000000)
+    replay_parser.add_argument('--rate', type=int, default=1000, help='simulated logins per second')
+    replay_parser.add_argument('--max-used-codes', type=int, default=100000)
+    replay_parser.set_defaults(func=bench_replay)
+
+    qr_parser = subparsers.add_parser('qr', help='enrollments per second, inline rendering vs the renderer')
+    qr_parser.add_argument('--enrollments', type=int, default=500)
+    qr_parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    qr_parser.add_argument('--formats', nargs='+', default=['png', 'svg'])
+    qr_parser.set_defaults(func=bench_qr)
+
+    auth_parser = subparsers.add_parser('auth', help='auth decisions per second, /auth and batched /api/verify')
+    auth_parser.add_argument('--requests', type=int, default=20000)
+    auth_parser.add_argument('--items', type=int, default=2000, help='codes verified per batch size')
+    auth_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100])
+    auth_parser.set_defaults(func=bench_auth)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,67 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify
 import pyotp
-import qrcode
-import io
-import base64
+import concurrent.futures
+import math
+import os
 import random
+import secrets
+import sys
+
+# demo_common is shared with the other demo app, one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.auth_check import bearer_token_matches, decision_response
+from demo_common.instrumentation import instrument_from_env
+from demo_common.passwords import PasswordHasher, hasher_from_string
+from demo_common.rate_limit import LoginLimiter
+from demo_common.sessions import session_interface_from_env, shared_state_path
+from demo_common.user_repository import UserRepository
+from qr_render import FORMATS, QrRenderer, RendererBusy
+from totp_cache import TotpVerifier
 
 
 app = Flask(__name__)
+# Per-route timings (GET /debug/requests in debug mode) and optional sampled profiling
+request_log = instrument_from_env(app, os.path.dirname(os.path.abspath(__file__)))
 # used for flask encrypting session data and other security-related functions
 app.secret_key = 'demo_secret_key'
 
-# Define a simple in-memory database of user credentials
-# Replace this with a database in a real application
-users = {'demo': {'password': 'changeme', 'mfa_secret_key': None, 'backup_codes': []}}
+# Sessions are kept server-side, the cookie only holds their ID (MFA_SESSION_STORE=sqlite when running several workers);
+# MFA_SESSION_STORE=cookie for Flask's signed cookie sessions
+session_interface = session_interface_from_env('memory', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.db'))
+if session_interface:
+    app.session_interface = session_interface
+# Used TOTP codes and login limits go to the same database as the sessions
+# when they are shared, or every worker would keep its own
+SHARED_STATE_PATH = shared_state_path('memory', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions.db'))
+
+# User credentials and MFA enrollment, in a SQLite database shared by all
+# the workers of the app; the demo user is created on first start
+users = UserRepository(os.environ.get('MFA_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')))
+users.add('demo', 'changeme')
+
+# Cached per-user TOTP verifiers; also rejects a code that was already used
+totp_verifier = TotpVerifier(used_codes_path=SHARED_STATE_PATH)
+
+# QR codes are rendered in worker processes and served by setup_mfa_qr.
+# MFA_QR_FORMAT=svg is cheaper than png; the matrix format, for clients
+# that draw the code themselves, is served too but cannot go in an <img>
+QR_FORMAT = os.environ.get('MFA_QR_FORMAT', 'png')
+qr_renderer = QrRenderer(workers=int(os.environ.get('MFA_QR_WORKERS', '2')),
+                         timeout=float(os.environ.get('MFA_QR_TIMEOUT', '5')))
+
+# Attempts per client IP, and failed passwords or TOTP codes per username
+login_limiter = LoginLimiter(path=SHARED_STATE_PATH)
+
+# Passwords are verified in a pool, and re-hashed on login when stored in
+# plaintext or with older parameters, e.g. MFA_PASSWORD_HASHER=scrypt:n=32768,r=8,p=1
+password_hasher = PasswordHasher(hasher_from_string(os.environ.get('MFA_PASSWORD_HASHER', 'scrypt')),
+                                 processes=os.environ.get('MFA_PASSWORD_POOL') == 'process')
+
+# Seconds nginx may cache an allowed /auth decision
+AUTH_CACHE_TTL = int(os.environ.get('MFA_AUTH_CACHE_TTL', '10'))
+# Bearer token of /api/verify, which is disabled without one
+API_TOKEN = os.environ.get('MFA_API_TOKEN')
+VERIFY_BATCH_MAX = 1000
 
 # Goolge Authenticator, and the underlying TOTP concept, does not have backup codes. 
 # These are a different mechanism, which would have to be impemented indepedenty, alongside their TOTP implementation.
@@ -22,20 +71,40 @@ def generate_backup_codes(num_codes=3):
     backup_codes = ['{:06d}'.format(random.randint(0, 999999)) for _ in range(num_codes)]
     return backup_codes
 
+def provisioning_uri(username, totp_secret):
+    return pyotp.totp.TOTP(totp_secret).provisioning_uri(name=username, issuer_name='Demo MFA GG')
+
+def end_enrollment(username, user):
+    # The QR code holds the secret: stop serving it once it is no longer needed
+    if user['enrollment']:
+        users.update(username, enrollment=None)
+        qr_renderer.discard(user['enrollment'])
+
+@app.before_request
+def limit_login_attempts():
+    # Password and TOTP submissions are limited before any other work is done
+    if request.method != 'POST' or request.endpoint not in ('login', 'setup_mfa', 'verify_mfa'):
+        return None
+    username = request.form.get('username') if request.endpoint == 'login' else session.get('username')
+    wait = login_limiter.check(request.remote_addr, username)
+    if wait:
+        return 'Too many attempts, try again later', 429, {'Retry-After': str(math.ceil(wait))}
+    return None
+
 @app.route('/')
 def index():
-    print(users)
     return render_template('login.html')
 
 @app.route('/login', methods=['POST'])
 def login():
-    print(users)
-    
     username = request.form['username']
     password = request.form['password']
 
     user = users.get(username)
-    if user and user['password'] == password:
+    matches, upgraded = password_hasher.verify(password, user['password'] if user else None)
+    if matches:
+        if upgraded:
+            users.update(username, password=upgraded)
         session['authenticated'] = True
         # Authentication successful, check for MFA setup
         if user['mfa_secret_key']:
@@ -47,11 +116,11 @@ def login():
             return redirect(url_for('setup_mfa'))
     else:
         # Authentication failed, display error message
+        login_limiter.failed(username)
         return 'Invalid username or password'
 
 @app.route('/setup-mfa', methods=['GET', 'POST'])
 def setup_mfa():
-    print(users) 
     if 'authenticated' not in session or not session['authenticated']:
         return redirect(url_for('index'))
     user = users.get(session['username'])
@@ -62,49 +131,73 @@ def setup_mfa():
         if request.method == 'GET':
             # Generate TOTP secret and URI
             totp_secret = pyotp.random_base32()
-            users[session['username']]['mfa_secret_key'] = totp_secret  # Store TOTP secret in user data
+            # Never log the secret or the backup codes themselves
+            app.logger.debug("MFA enrollment started for %s", session['username'])
 
-            print("TOTP Secret:", totp_secret)
-            
             # Generate TOTP URI
-            totp_uri = pyotp.totp.TOTP(totp_secret).provisioning_uri(name=session['username'], issuer_name='Demo MFA GG')
+            totp_uri = provisioning_uri(session['username'], totp_secret)
             
             # Generate backup codes based on TOTP secret
             backup_codes = generate_backup_codes()
-            print("Generated Backup Codes:", backup_codes)  # Print generated backup codes for debugging
-            users[session['username']]['backup_codes'] = backup_codes  # Store backup codes in user data
-
-            # Generate QR code image
-            img = qrcode.make(totp_uri)
-            print(type(img))
 
-            # Convert image to base64-encoded string
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            qr_code_data = base64.b64encode(buffered.getvalue()).decode()
+            # The QR code image is served by setup_mfa_qr under an ID of its own;
+            # start rendering it now so it is ready when the browser asks
+            enrollment = secrets.token_urlsafe(16)
+            # Store TOTP secret, backup codes and enrollment in user data
+            users.update(session['username'], mfa_secret_key=totp_secret, backup_codes=backup_codes, enrollment=enrollment)
+            try:
+                qr_renderer.submit(enrollment, totp_uri, QR_FORMAT)
+            except RendererBusy:
+                pass
 
-            return render_template('setup_mfa.html', qr_code=qr_code_data, totp_secret=totp_secret)
+            qr_url = url_for('setup_mfa_qr', enrollment=enrollment, fmt=QR_FORMAT)
+            return render_template('setup_mfa.html', qr_url=qr_url, totp_secret=totp_secret)
         elif request.method == 'POST':
             # Handle POST request for MFA verification
             totp_code = request.form['totp_code']
-            totp_secret = users[session['username']]['mfa_secret_key']
+            totp_secret = user['mfa_secret_key']
 
             if totp_secret:
-                if pyotp.totp.TOTP(totp_secret).verify(totp_code):
+                if totp_verifier.verify(session['username'], totp_secret, totp_code):
                     # MFA verification successful, redirect to protected page
                     return redirect(url_for('protected'))
                 else:
+                    login_limiter.failed(session['username'])
                     # Clear the totp_secret from user data if failed
-                    users[session['username']]['mfa_secret_key'] = None
+                    users.update(session['username'], mfa_secret_key=None)
+                    totp_verifier.forget(session['username'])
+                    end_enrollment(session['username'], user)
                     # MFA verification failed, display error message
                     return 'Invalid MFA code'
             else:
                 # TOTP secret not found in user data, redirect to setup page
                 return redirect(url_for('setup_mfa'))
 
+@app.route('/setup-mfa/qr/<enrollment>.<fmt>')
+def setup_mfa_qr(enrollment, fmt):
+    if 'authenticated' not in session or not session['authenticated']:
+        return redirect(url_for('index'))
+    user = users.get(session['username'])
+    if fmt not in FORMATS or not user['mfa_secret_key'] or user.get('enrollment') != enrollment:
+        return 'Not found', 404
+    # The image of an enrollment never changes, so the browser may keep it
+    # for the rest of the setup; private as it holds the TOTP secret
+    etag = f'{enrollment}.{fmt}'
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        try:
+            image = qr_renderer.get(enrollment, provisioning_uri(session['username'], user['mfa_secret_key']), fmt)
+        except (RendererBusy, concurrent.futures.TimeoutError):
+            return 'QR code rendering is busy, try again', 503, {'Retry-After': '1'}
+        response = app.response_class(image, mimetype=FORMATS[fmt])
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 600
+    return response
+
 @app.route('/verify-mfa', methods=['GET', 'POST'])
 def verify_mfa():
-    print(users) 
     if 'authenticated' not in session or not session['authenticated']:
         return redirect(url_for('index'))
     if request.method == 'GET':
@@ -112,19 +205,22 @@ def verify_mfa():
     elif request.method == 'POST':
         # Handle POST request for MFA verification
         totp_code = request.form['totp_code']
-        totp_secret = users[session['username']]['mfa_secret_key']
+        user = users.get(session['username'])
+        totp_secret = user['mfa_secret_key']
 
         if totp_secret:
-            totp = pyotp.TOTP(totp_secret)
-            if totp.verify(totp_code):
+            if totp_verifier.verify(session['username'], totp_secret, totp_code):
                 # MFA verification successful, set flag in session
                 session['totp_verified'] = True
-                print("MFA verification successful")
-                print("Session:", session)
+                # Only a full login clears the failures of the username
+                login_limiter.succeeded(session['username'])
+                end_enrollment(session['username'], user)
+                app.logger.debug("MFA verification successful for %s", session['username'])
                 # Redirect to protected page
                 return redirect(url_for('protected'))
             else:
                 # MFA verification failed, display error message
+                login_limiter.failed(session['username'])
                 return redirect(url_for('invalid_token'))
         else:
             # TOTP secret not found in user data, redirect to setup page
@@ -132,12 +228,10 @@ def verify_mfa():
         
 @app.route('/invalid-token')
 def invalid_token():
-    print(users) 
     return render_template('invalid_token.html')
 
 @app.route('/protected')
 def protected():
-    print(users) 
     response = require_full_authentication()
     if response:
         return response
@@ -151,7 +245,6 @@ def protected():
 
 @app.route('/backup-codes')
 def backup_codes():
-    print(users) 
     response = require_full_authentication()
     if response:
         return response
@@ -159,7 +252,7 @@ def backup_codes():
     if session.get('totp_verified'):
         # MFA is enabled and verified, allow access to backup page
         # Retrieve backup codes from session
-        backup_codes = users[session['username']]['backup_codes']
+        backup_codes = users.get(session['username'])['backup_codes']
         return render_template('backup_codes.html', backup_codes=backup_codes)
     else:
         # MFA is not verified, redirect to verify MFA page
@@ -171,13 +264,54 @@ def require_full_authentication():
 
 @app.route('/logout', methods=['POST'])
 def logout():
-    print(users) 
     # Clear session data
     session.pop('authenticated', None)
     session.pop('totp_verified', None)
     session.clear()
     return redirect(url_for('index'))
 
+@app.route('/auth')
+def auth():
+    # For nginx auth_request: the session alone decides, nothing is rendered
+    if session.get('authenticated') and session.get('totp_verified'):
+        return decision_response(app, session['username'], AUTH_CACHE_TTL)
+    return decision_response(app, None, AUTH_CACHE_TTL)
+
+@app.route('/api/verify', methods=['POST'])
+def verify_batch():
+    # Verifies many {"username", "code"} pairs for a trusted gateway. Each
+    # code is used up like at /verify-mfa, so results are never cached
+    if not API_TOKEN:
+        return 'Not found', 404
+    if not bearer_token_matches(request, API_TOKEN):
+        return jsonify({'error': 'invalid token'}), 401, {'WWW-Authenticate': 'Bearer'}
+    body = request.get_json(silent=True)
+    items = body.get('items') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'expected {"items": [{"username": ..., "code": ...}, ...]}'}), 400
+    if len(items) > VERIFY_BATCH_MAX:
+        return jsonify({'error': f'at most {VERIFY_BATCH_MAX} items per request'}), 413
+
+    results = []
+    for item in items:
+        username = item.get('username')
+        code = item.get('code')
+        if not isinstance(username, str) or not isinstance(code, str):
+            results.append({'username': username, 'valid': False, 'error': 'invalid item'})
+            continue
+        # Failures count towards the lockout of the username, as on the forms
+        if login_limiter.usernames.wait_time(username):
+            results.append({'username': username, 'valid': False, 'error': 'locked out'})
+            continue
+        user = users.get(username)
+        valid = bool(user and user['mfa_secret_key']) and totp_verifier.verify(username, user['mfa_secret_key'], code)
+        if not valid:
+            login_limiter.failed(username)
+        results.append({'username': username, 'valid': valid})
+    response = jsonify({'results': results})
+    response.cache_control.no_store = True
+    return response
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5000, debug=True)
     # app.run(ssl_context=('cert.pem', 'privkey.pem'), host='0.0.0.0', port=5000, debug=True) # if you want SSL for the app
@@ -0,0 +1,143 @@
+"""QR code rendering for MFA enrollment, off the request thread.
+
+Rendering a QR code is pure CPU work: choosing the mask alone evaluates
+the symbol eight times, and PNG output then goes through Pillow. Requests
+submit it to a small process pool instead, with a bound on the renders
+in flight and a timeout on each, and the results are cached per
+enrollment so the image endpoint can be fetched again cheaply.
+
+Formats:
+    png     qrcode.make through Pillow, as before
+    svg     one <path> built from the module matrix, no Pillow
+    matrix  the module matrix as text, one row of 0/1 per line, for
+            clients that draw the code themselves
+
+svg and matrix use a fixed mask pattern rather than searching for the
+best one. Any mask gives a valid code; the search only lowers the
+chance of large same-colored areas, which does not matter for codes as
+small as a provisioning URI. It makes them about six times cheaper.
+"""
+import collections
+import concurrent.futures
+import io
+import threading
+
+import qrcode
+
+FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'matrix': 'text/plain; charset=utf-8',
+}
+
+# Pixels per module in SVG output, before the browser scales it
+SVG_MODULE_SIZE = 6
+
+
+class RendererBusy(Exception):
+    """Raised when too many renders are already in flight."""
+
+
+def _matrix(data):
+    qr = qrcode.QRCode(border=4, mask_pattern=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def _svg(matrix):
+    size = len(matrix)
+    # One horizontal run of dark modules per h segment
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                path.append(f'M{start} {y}h{x - start}v1h-{x - start}z')
+            else:
+                x += 1
+    pixels = size * SVG_MODULE_SIZE
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+            f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/>'
+            f'<path d="{"".join(path)}" fill="#000"/></svg>').encode()
+
+
+def render(data, fmt):
+    """Render data as a QR code in one of FORMATS; return the encoded bytes."""
+    if fmt == 'png':
+        buffered = io.BytesIO()
+        qrcode.make(data).save(buffered, format='PNG')
+        return buffered.getvalue()
+    matrix = _matrix(data)
+    if fmt == 'svg':
+        return _svg(matrix)
+    if fmt == 'matrix':
+        return '\n'.join(''.join('1' if module else '0' for module in row) for row in matrix).encode()
+    raise ValueError(f"Unknown QR code format '{fmt}'")
+
+
+class QrRenderer:
+    """Renders in a process pool and keeps the results of recent enrollments.
+
+    With workers=0 rendering happens on the calling thread, which is what
+    the Flask reloader and the benchmarks of the inline path want.
+    """
+
+    def __init__(self, workers=2, max_pending=16, timeout=5, max_entries=1024):
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers) if workers else None
+        self.timeout = timeout
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.max_entries = max_entries
+        # (key, fmt) -> Future of the bytes, least recently used first
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, key, data, fmt):
+        """Start rendering unless it is cached; return the Future of the bytes.
+
+        Raises RendererBusy if max_pending renders are already in flight.
+        """
+        with self.lock:
+            future = self.results.get((key, fmt))
+            if future is not None:
+                self.results.move_to_end((key, fmt))
+                return future
+        if self.pool is None:
+            future = concurrent.futures.Future()
+            future.set_result(render(data, fmt))
+        else:
+            if not self.pending.acquire(blocking=False):
+                raise RendererBusy()
+            future = self.pool.submit(render, data, fmt)
+            future.add_done_callback(lambda _: self.pending.release())
+        with self.lock:
+            self.results[(key, fmt)] = future
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+        return future
+
+    def get(self, key, data, fmt):
+        """Return the rendered bytes, waiting at most timeout seconds.
+
+        Raises RendererBusy, or concurrent.futures.TimeoutError if the
+        render takes too long; a timed out render is not cached.
+        """
+        future = self.submit(key, data, fmt)
+        try:
+            return future.result(self.timeout)
+        except Exception:
+            self.discard(key)
+            raise
+
+    def discard(self, key):
+        with self.lock:
+            for fmt in FORMATS:
+                self.results.pop((key, fmt), None)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
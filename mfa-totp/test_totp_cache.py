@@ -0,0 +1,20 @@
+import pyotp
+
+from totp_cache import SqliteUsedCodes, TotpVerifier
+
+
+def test_a_code_is_accepted_once_across_workers(tmp_path):
+    path = str(tmp_path / 'state.db')
+    workers = [TotpVerifier(used_codes_path=path) for _ in range(2)]
+    secret = pyotp.random_base32()
+    code = pyotp.TOTP(secret).at(1000)
+    assert workers[0].verify('alice', secret, code, for_time=1000)
+    assert not workers[1].verify('alice', secret, code, for_time=1001)
+
+
+def test_used_codes_expire(tmp_path):
+    used_codes = SqliteUsedCodes(str(tmp_path / 'state.db'), ttl=30)
+    assert used_codes.add('alice', 1, now=1000)
+    assert len(used_codes) == 0
+    assert used_codes.add('alice', 2)
+    assert len(used_codes) == 1
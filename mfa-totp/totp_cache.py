@@ -0,0 +1,157 @@
+"""TOTP verification with cached verifiers and replay protection.
+
+pyotp base32-decodes the secret every time a code is generated, so the
+verifier of each user is built once, with its key decoded, and kept in a
+bounded LRU cache. The cached verifier is rebuilt whenever the user's
+mfa_secret_key no longer matches the one it was built from.
+
+A code is only accepted once: every accepted (user, time step) is kept
+until the step can no longer be verified, and a second login with a code
+of the same step is rejected (RFC 6238, section 5.2). UsedCodes keeps
+them in the memory of one process; with several worker processes the
+same code would be accepted once by each, so SqliteUsedCodes keeps them
+in a SQLite table every worker shares instead.
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+import pyotp
+from pyotp import utils
+
+
+class CachedTOTP(pyotp.TOTP):
+    """A pyotp.TOTP that decodes its secret once."""
+
+    def __init__(self, secret, interval=30):
+        super().__init__(secret, interval=interval)
+        self.key = super().byte_secret()
+
+    def byte_secret(self):
+        return self.key
+
+    def matching_step(self, code, for_time, valid_window=0):
+        """Return the time step code is valid for at for_time, or None."""
+        step = int(for_time // self.interval)
+        for offset in range(-valid_window, valid_window + 1):
+            if step + offset >= 0 and utils.strings_equal(str(code), self.generate_otp(step + offset)):
+                return step + offset
+        return None
+
+
+class UsedCodes:
+    """(user, time step) pairs that have been accepted, kept until they expire.
+
+    Entries are kept in insertion order, which is expiry order since every
+    entry lives as long, so expired entries are dropped from the front in
+    O(1) each. max_entries caps the memory under any login rate: past it the
+    oldest entries are dropped early, which only reopens replay for codes
+    that are about to expire anyway as long as max_entries covers the
+    logins of one TTL.
+    """
+
+    def __init__(self, ttl, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (user, step) -> expiry time
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, user, step, now=None):
+        """Record a used code; return False if it was already used."""
+        now = time.time() if now is None else now
+        key = (user, step)
+        with self.lock:
+            while self.entries:
+                first_key, expiry = next(iter(self.entries.items()))
+                if expiry > now:
+                    break
+                del self.entries[first_key]
+            if key in self.entries:
+                return False
+            self.entries[key] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+
+class SqliteUsedCodes:
+    """UsedCodes in a SQLite table shared by every worker process."""
+    # Expired entries are purged once every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.writes = 0
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS used_codes '
+                                '(user TEXT NOT NULL, step INTEGER NOT NULL, expiry REAL NOT NULL, PRIMARY KEY (user, step))')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM used_codes WHERE expiry > ?',
+                                           (time.time(),)).fetchone()[0]
+
+    def add(self, user, step, now=None):
+        """Record a used code; return False if it was already used, by any worker."""
+        now = time.time() if now is None else now
+        with self.lock:
+            # The primary key makes the check and the insert one atomic step;
+            # an expired row left in place only names a step too old to verify
+            added = self.connection.execute('INSERT OR IGNORE INTO used_codes (user, step, expiry) VALUES (?, ?, ?)',
+                                            (user, step, now + self.ttl)).rowcount == 1
+            self.writes += 1
+            if self.writes % self.PURGE_EVERY == 0:
+                self.connection.execute('DELETE FROM used_codes WHERE expiry <= ?', (now,))
+        return added
+
+
+class TotpVerifier:
+    def __init__(self, max_verifiers=10000, max_used_codes=100000, valid_window=0, interval=30, used_codes_path=None):
+        self.max_verifiers = max_verifiers
+        self.valid_window = valid_window
+        self.interval = interval
+        # username -> CachedTOTP, least recently used first
+        self.verifiers = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # A step is accepted from valid_window steps before it to
+        # valid_window steps after it, so this outlives every acceptance
+        ttl = interval * (2 * valid_window + 1)
+        if used_codes_path is None:
+            self.used_codes = UsedCodes(ttl, max_used_codes)
+        else:
+            self.used_codes = SqliteUsedCodes(used_codes_path, ttl)
+
+    def verifier(self, username, secret):
+        """Return the cached verifier of a user, rebuilding it if the secret changed."""
+        with self.lock:
+            totp = self.verifiers.get(username)
+            if totp is not None and totp.secret == secret:
+                self.verifiers.move_to_end(username)
+                return totp
+        totp = CachedTOTP(secret, self.interval)
+        with self.lock:
+            self.verifiers[username] = totp
+            self.verifiers.move_to_end(username)
+            while len(self.verifiers) > self.max_verifiers:
+                self.verifiers.popitem(last=False)
+        return totp
+
+    def forget(self, username):
+        with self.lock:
+            self.verifiers.pop(username, None)
+
+    def verify(self, username, secret, code, for_time=None):
+        """Return True if code is valid now and has not been used before."""
+        for_time = time.time() if for_time is None else for_time
+        step = self.verifier(username, secret).matching_step(code, for_time, self.valid_window)
+        if step is None:
+            return False
+        return self.used_codes.add(username, step, for_time)
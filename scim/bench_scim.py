@@ -0,0 +1,397 @@
+"""Micro-benchmarks for the demo SCIM server.
+
+Runs in-process against the Flask app through its test client, so the
+numbers cover request parsing, the handlers and JSON encoding but not the
+network.
+
+Usage:
+    python3 bench_scim.py bulk --users 20000
+    python3 bench_scim.py memory --users 100000 1000000
+    python3 bench_scim.py persistence --writes 20000 --threads 16 --restart-users 1000000
+    python3 bench_scim.py stress --threads 32 --operations 2000
+    python3 bench_scim.py groups --sizes 1000 10000 100000
+    python3 bench_scim.py ndjson --users 1000000 --workers 1 4
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import demo_app_scim
+from scim_groups import GroupRecord, GroupStore
+from scim_ndjson import export_users, import_users
+from scim_persistence import Persistence
+from scim_store import INDEXED_ATTRIBUTES, SORTABLE_ATTRIBUTES, UserStore, index_key
+
+
+def user_payload(i):
+    return {
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+        "userName": f"user{i}@example.com",
+        "name": {"givenName": f"Given{i}", "familyName": f"Family{i}"},
+        "emails": [{"value": f"user{i}@example.com", "type": "work", "primary": True}],
+        "externalId": f"ext-{i}",
+        "urn:custom:role": "member",
+        "urn:custom:accessLevels": ["readonly_secret"],
+    }
+
+
+def reset_store():
+    demo_app_scim.store = demo_app_scim.UserStore()
+    demo_app_scim.groups = GroupStore(demo_app_scim.store)
+    demo_app_scim.store.listeners.append(demo_app_scim.groups)
+    demo_app_scim.serializer.clear()
+
+
+def bench_bulk(args):
+    client = demo_app_scim.app.test_client()
+    batch_size = args.batch_size or demo_app_scim.app.config['SCIM_BULK_MAX_OPERATIONS']
+
+    reset_store()
+    start = time.perf_counter()
+    for i in range(args.users):
+        client.post('/scim/v2/Users', json=user_payload(i))
+    single = time.perf_counter() - start
+
+    reset_store()
+    start = time.perf_counter()
+    for offset in range(0, args.users, batch_size):
+        operations = [
+            {"method": "POST", "path": "/Users", "bulkId": str(i), "data": user_payload(i)}
+            for i in range(offset, min(offset + batch_size, args.users))
+        ]
+        client.post('/scim/v2/Bulk', json={
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkRequest"],
+            "Operations": operations
+        })
+    bulk = time.perf_counter() - start
+    assert len(demo_app_scim.store) == args.users
+
+    print(f"users: {args.users}, bulk batch size: {batch_size}")
+    print(f"single POST: {single:.2f}s, {single / args.users * 1e6:.1f} us/user")
+    print(f"bulk:        {bulk:.2f}s, {bulk / args.users * 1e6:.1f} us/user ({single / bulk:.1f}x)")
+
+
+def measure_records(count, build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = {}
+    for i in range(count):
+        records[i + 1] = build(i)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del records
+    return size / count
+
+
+def bench_memory(args):
+    def dict_user(i):
+        # The dict-of-dicts layout users were stored in before UserRecord
+        data = user_payload(i)
+        return {
+            "id": i + 1,
+            "externalId": data['externalId'],
+            "userName": data['userName'],
+            "name": {
+                "givenName": data['name']['givenName'],
+                "familyName": data['name']['familyName']
+            },
+            "email": data['emails'][0]['value'],
+            "urn:custom:role": data['urn:custom:role'],
+            "urn:custom:remoteId": '',
+            "urn:custom:accessLevels": list(data['urn:custom:accessLevels']),
+            "urn:custom:idpId": ''
+        }
+
+    def record_user(i):
+        return demo_app_scim.new_user(user_payload(i), i + 1)
+
+    for count in args.users:
+        dict_size = measure_records(count, dict_user)
+        record_size = measure_records(count, record_user)
+        print(f"{count} users: dict {dict_size:.0f} bytes/user, "
+              f"UserRecord {record_size:.0f} bytes/user ({dict_size / record_size:.2f}x smaller)")
+
+
+def bench_persistence(args):
+    for durability in args.modes:
+        directory = tempfile.mkdtemp(prefix='scim-bench-')
+        try:
+            store = UserStore()
+            persistence = Persistence(directory, durability, snapshot_every=0)
+            persistence.load(store)
+            store.listeners.append(persistence)
+            per_thread = args.writes // args.threads
+
+            def writer(offset):
+                for i in range(offset, offset + per_thread):
+                    with store.lock:
+                        user = demo_app_scim.new_user(user_payload(i), store.allocate_id())
+                    store.add(user)
+                    persistence.sync()
+
+            threads = [threading.Thread(target=writer, args=(n * per_thread,)) for n in range(args.threads)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            persistence.close()
+            writes = per_thread * args.threads
+            print(f"{durability:>6}: {writes / elapsed:,.0f} writes/s ({args.threads} threads)")
+        finally:
+            shutil.rmtree(directory)
+
+    if not args.restart_users:
+        return
+    directory = tempfile.mkdtemp(prefix='scim-bench-')
+    try:
+        store = UserStore()
+        persistence = Persistence(directory, 'async', snapshot_every=0)
+        persistence.load(store)
+        store.listeners.append(persistence)
+        store.add_many([demo_app_scim.new_user(user_payload(i), store.allocate_id())
+                        for i in range(args.restart_users)])
+        persistence.snapshot()
+        for i in range(args.restart_tail):
+            store.add(demo_app_scim.new_user(user_payload(args.restart_users + i), store.allocate_id()))
+        persistence.close()
+
+        start = time.perf_counter()
+        restored = UserStore()
+        Persistence(directory, 'async', snapshot_every=0).load(restored)
+        elapsed = time.perf_counter() - start
+        assert len(restored) == args.restart_users + args.restart_tail
+        print(f"restart: {elapsed:.2f}s for a {args.restart_users}-user snapshot "
+              f"plus {args.restart_tail} log entries")
+    finally:
+        shutil.rmtree(directory)
+
+
+def check_store_invariants(store, expected_versions):
+    """Return a list of inconsistencies between the store's users and its indexes."""
+    problems = []
+    users = dict(store.users)
+    if users and store.next_user_id <= max(users):
+        problems.append(f"next_user_id {store.next_user_id} <= max id {max(users)}")
+    for attribute, slot in INDEXED_ATTRIBUTES.items():
+        expected = collections.defaultdict(set)
+        for user in users.values():
+            key = index_key(getattr(user, slot))
+            if key not in (None, ''):
+                expected[key].add(user.id)
+        if dict(expected) != store.indexes[attribute]:
+            problems.append(f"hash index on {attribute} is inconsistent")
+    for attribute in SORTABLE_ATTRIBUTES:
+        expected = sorted(store.sort_entry(attribute, user) for user in users.values())
+        if expected != store.sorted_indexes[attribute]:
+            problems.append(f"ordered index on {attribute} is inconsistent")
+    for user_id, version in expected_versions.items():
+        if user_id in users and users[user_id].version != version:
+            problems.append(f"user {user_id} has version {users[user_id].version}, expected {version}")
+    return problems
+
+
+def bench_stress(args):
+    reset_store()
+    lock = threading.Lock()
+    created_ids = []
+    deleted_ids = set()
+    # Version each user should end up with: 1 + number of successful PATCHes
+    expected_versions = collections.Counter()
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = demo_app_scim.app.test_client()
+        for n in range(args.operations):
+            roll = rng.random()
+            with lock:
+                known_ids = list(created_ids[-200:])
+            if roll < 0.35 or not known_ids:
+                i = seed * args.operations + n
+                response = client.post('/scim/v2/Users', json=user_payload(i))
+                if response.status_code != 201:
+                    errors.append(f"POST returned {response.status_code}")
+                    continue
+                with lock:
+                    created_ids.append(response.json['id'])
+                    expected_versions[response.json['id']] += 1
+            elif roll < 0.7:
+                user_id = rng.choice(known_ids)
+                response = client.patch(f'/scim/v2/Users/{user_id}', json={
+                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+                    "Operations": [{"op": "replace", "value": {"userName": f"patched-{seed}-{n}"}}]
+                })
+                if response.status_code == 200:
+                    with lock:
+                        expected_versions[user_id] += 1
+                elif response.status_code != 404:
+                    errors.append(f"PATCH returned {response.status_code}")
+            elif roll < 0.8:
+                user_id = rng.choice(known_ids)
+                response = client.delete(f'/scim/v2/Users/{user_id}')
+                if response.status_code == 204:
+                    with lock:
+                        deleted_ids.add(user_id)
+                elif response.status_code != 404:
+                    errors.append(f"DELETE returned {response.status_code}")
+            else:
+                query = rng.choice([
+                    {'count': 50, 'startIndex': rng.randint(1, 100), 'sortBy': 'userName'},
+                    {'count': 50, 'cursor': '', 'sortBy': 'name.familyName', 'sortOrder': 'descending'},
+                    {'filter': f'userName eq "user{rng.randint(0, 10000)}@example.com"'},
+                    {'filter': 'userName sw "patched"', 'count': 20},
+                ])
+                response = client.get('/scim/v2/Users', query_string=query)
+                if response.status_code != 200:
+                    errors.append(f"GET returned {response.status_code}")
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    store = demo_app_scim.store
+    problems = list(errors)
+    if len(created_ids) != len(set(created_ids)):
+        problems.append("duplicate user IDs were allocated")
+    if len(store) != len(created_ids) - len(deleted_ids):
+        problems.append(f"store holds {len(store)} users, expected {len(created_ids) - len(deleted_ids)}")
+    problems += check_store_invariants(store, expected_versions)
+
+    total = args.threads * args.operations
+    print(f"{total} operations on {args.threads} threads in {elapsed:.2f}s ({total / elapsed:,.0f} ops/s)")
+    print(f"created {len(created_ids)}, deleted {len(deleted_ids)}, stored {len(store)}")
+    if problems:
+        for problem in problems:
+            print(f"FAILED: {problem}")
+        raise SystemExit(1)
+    print("all store invariants hold")
+
+
+def bench_groups(args):
+    client = demo_app_scim.app.test_client()
+    for size in args.sizes:
+        reset_store()
+        store = demo_app_scim.store
+        groups = demo_app_scim.groups
+        store.add_many([demo_app_scim.new_user(user_payload(i), store.allocate_id()) for i in range(size + 1)])
+        # One large group holding every user but the last, plus 100 small
+        # groups the first user also belongs to
+        group = GroupRecord(groups.allocate_id(), f"all-{size}", members=range(1, size + 1))
+        groups.add(group)
+        for n in range(100):
+            groups.add(GroupRecord(groups.allocate_id(), f"small-{n}", members=[1]))
+        outsider = size + 1
+
+        start = time.perf_counter()
+        for _ in range(args.operations):
+            client.patch(f'/scim/v2/Groups/{group.id}', json={"Operations": [
+                {"op": "add", "path": "members", "value": [{"value": str(outsider)}]}]})
+            client.patch(f'/scim/v2/Groups/{group.id}', json={"Operations": [
+                {"op": "remove", "path": f'members[value eq "{outsider}"]'}]})
+        patch = (time.perf_counter() - start) / (2 * args.operations)
+
+        start = time.perf_counter()
+        for _ in range(args.operations):
+            client.get('/scim/v2/Groups', query_string={
+                'filter': f'members[value eq "{outsider - 1}"]', 'excludedAttributes': 'members'})
+        reverse = (time.perf_counter() - start) / args.operations
+
+        start = time.perf_counter()
+        client.delete('/scim/v2/Users/1')
+        delete = time.perf_counter() - start
+        assert 1 not in group.members and not groups.groups_of(1)
+
+        print(f"{size:>7} members: PATCH one member {patch * 1e6:.0f} us, "
+              f"groups of a user {reverse * 1e6:.0f} us, delete user in 101 groups {delete * 1e6:.0f} us")
+
+
+def bench_ndjson(args):
+    directory = tempfile.mkdtemp(prefix='scim-bench-')
+    try:
+        path = os.path.join(directory, 'users.ndjson')
+        with open(path, 'wb') as file:
+            for i in range(args.users):
+                file.write(json.dumps(user_payload(i), separators=(',', ':')).encode() + b'\n')
+        size = os.path.getsize(path)
+        print(f"input: {args.users} records, {size / 1e6:.0f} MB")
+
+        for workers in args.workers:
+            store = UserStore()
+            start = time.perf_counter()
+            with open(path, 'rb') as file:
+                imported, errors = import_users(store, file, args.chunk_size, workers)
+            elapsed = time.perf_counter() - start
+            assert imported == args.users and not errors
+            print(f"import, {workers} worker(s): {elapsed:.1f}s, {imported / elapsed:,.0f} records/s")
+
+        start = time.perf_counter()
+        with open(os.devnull, 'wb') as file:
+            written = export_users(store, file)
+        elapsed = time.perf_counter() - start
+        print(f"export: {elapsed:.1f}s, {written / elapsed:,.0f} records/s")
+        # ru_maxrss is in kilobytes on Linux
+        print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB "
+              f"(the store itself included)")
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    bulk_parser = subparsers.add_parser('bulk', help='single POST vs Bulk provisioning cost per user')
+    bulk_parser.add_argument('--users', type=int, default=20000)
+    bulk_parser.add_argument('--batch-size', type=int, default=None)
+    bulk_parser.set_defaults(func=bench_bulk)
+
+    memory_parser = subparsers.add_parser('memory', help='bytes per stored user, dict vs UserRecord')
+    memory_parser.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    memory_parser.set_defaults(func=bench_memory)
+
+    persistence_parser = subparsers.add_parser('persistence', help='log write throughput and restart time')
+    persistence_parser.add_argument('--modes', nargs='+', default=['always', 'batch', 'async'])
+    persistence_parser.add_argument('--writes', type=int, default=20000)
+    persistence_parser.add_argument('--threads', type=int, default=16)
+    persistence_parser.add_argument('--restart-users', type=int, default=1000000)
+    persistence_parser.add_argument('--restart-tail', type=int, default=100000)
+    persistence_parser.set_defaults(func=bench_persistence)
+
+    stress_parser = subparsers.add_parser('stress', help='concurrent mixed workload, then check store invariants')
+    stress_parser.add_argument('--threads', type=int, default=32)
+    stress_parser.add_argument('--operations', type=int, default=2000, help='operations per thread')
+    stress_parser.set_defaults(func=bench_stress)
+
+    groups_parser = subparsers.add_parser('groups', help='membership PATCH and lookup cost by group size')
+    groups_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    groups_parser.add_argument('--operations', type=int, default=500)
+    groups_parser.set_defaults(func=bench_groups)
+
+    ndjson_parser = subparsers.add_parser('ndjson', help='NDJSON import/export throughput')
+    ndjson_parser.add_argument('--users', type=int, default=1000000)
+    ndjson_parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count()])
+    ndjson_parser.add_argument('--chunk-size', type=int, default=5000)
+    ndjson_parser.set_defaults(func=bench_ndjson)
+
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
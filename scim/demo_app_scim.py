@@ -1,212 +1,447 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, g
 import logging
+import os
 import json
+import base64
+import sys
+import time
+
+from scim_filter import FilterError, answers_exactly, compile_filter, get_attribute, parse_attribute_path
+from scim_groups import GroupRecord, GroupStore
+from scim_journal import ChangeJournal, WatermarkExpired
+from scim_metrics import Metrics, configure_logging
+from scim_patch import (COMPLEX, MULTI_VALUED, OPERATIONS, SIMPLE, PatchError, apply_operations, compile_path,
+                        equality_terms)
+from scim_persistence import Persistence
+from scim_serializer import EncodedDocument, UserSerializer, dumps, user_etag
+from scim_store import SORTABLE_ATTRIBUTES, UserRecord, UserStore, format_timestamp
+
+# demo_common is shared with the MFA demo apps, one directory up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from demo_common.instrumentation import instrument_from_env
 
 app = Flask(__name__)
+# Per-route timings (GET /debug/requests in debug mode) and optional sampled
+# profiling; /metrics has the long-term aggregates
+request_log = instrument_from_env(app, os.path.dirname(os.path.abspath(__file__)))
+
+# Limits advertised in ServiceProviderConfig and enforced by /scim/v2/Bulk
+app.config.setdefault('SCIM_BULK_MAX_OPERATIONS', 1000)
+app.config.setdefault('SCIM_BULK_MAX_PAYLOAD_SIZE', 1048576)
+# Number of encoded user resources kept in the response cache
+app.config.setdefault('SCIM_RESPONSE_CACHE_SIZE', 100000)
+# ListResponses for a count above this are streamed instead of built in memory
+app.config.setdefault('SCIM_STREAM_THRESHOLD', 1000)
+# Directory for the operation log and snapshots; the store is memory-only when unset
+app.config.setdefault('SCIM_DATA_DIR', os.environ.get('SCIM_DATA_DIR'))
+# One of 'always', 'batch' (group commit) or 'async', see scim_persistence.py
+app.config.setdefault('SCIM_DURABILITY', os.environ.get('SCIM_DURABILITY', 'batch'))
+# Number of logged changes after which a compacted snapshot is written
+app.config.setdefault('SCIM_SNAPSHOT_EVERY', int(os.environ.get('SCIM_SNAPSHOT_EVERY', '100000')))
+
+# Number of changes kept for GET /scim/v2/Changes before the journal is compacted
+app.config.setdefault('SCIM_JOURNAL_RETENTION', int(os.environ.get('SCIM_JOURNAL_RETENTION', '100000')))
+# Fraction of INFO request logs that are written; warnings and errors are always kept
+app.config.setdefault('SCIM_LOG_SAMPLE_RATE', float(os.environ.get('SCIM_LOG_SAMPLE_RATE', '1.0')))
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+log_listener = configure_logging(logging.INFO, app.config['SCIM_LOG_SAMPLE_RATE'])
 
 # In-memory user store
-users = {}
-next_user_id = 1
+store = UserStore()
+serializer = UserSerializer(app.config['SCIM_RESPONSE_CACHE_SIZE'])
+
+persistence = None
+if app.config['SCIM_DATA_DIR']:
+    persistence = Persistence(app.config['SCIM_DATA_DIR'], app.config['SCIM_DURABILITY'],
+                              app.config['SCIM_SNAPSHOT_EVERY'])
+    persistence.load(store)
+    store.listeners.append(persistence)
+
+# Registered after loading, so the journal only holds changes made since startup
+journal = ChangeJournal(app.config['SCIM_JOURNAL_RETENTION'])
+store.listeners.append(journal)
+
+# Groups, with forward (group -> users) and reverse (user -> groups) membership indexes.
+# They are memory-only: not in the oplog or snapshots, /Changes or /Bulk
+groups = GroupStore(store)
+store.listeners.append(groups)
+if persistence is not None:
+    logging.warning("Groups are kept in memory only and will be lost on restart; only users are persisted in %s",
+                    app.config['SCIM_DATA_DIR'])
+
+# Request metrics, exposed at /metrics
+metrics = Metrics()
+metrics.gauge('scim_users', 'Users in the store', lambda: len(store))
+metrics.gauge('scim_response_cache_entries', 'Encoded user resources in the response cache',
+              lambda: len(serializer.cache))
+metrics.gauge('scim_index_keys', 'Distinct keys across the attribute indexes',
+              lambda: sum(len(index) for index in store.indexes.values()))
+metrics.gauge('scim_groups', 'Groups in the store', lambda: len(groups))
+metrics.gauge('scim_journal_entries', 'Entries in the change journal', lambda: len(journal))
+if persistence is not None:
+    metrics.gauge('scim_oplog_seq', 'Sequence number of the last logged change', lambda: persistence.log.last_seq)
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        # Streamed responses have no content length and count as 0 bytes
+        metrics.observe_request(request.method, endpoint, response.status_code,
+                                time.perf_counter() - started,
+                                request.content_length or 0, response.content_length or 0)
+    return response
+
+def sync_store():
+    # Wait until the changes made by this request are as durable as configured
+    if persistence is not None:
+        persistence.sync()
+
+def json_response(body, status, etag=None):
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if etag:
+        response.headers['ETag'] = etag
+    return response
+
+def user_response(user, status):
+    return json_response(serializer.encode(user), status, user_etag(user))
+
+def cached_json_response(document):
+    etag = f'"{document.etag}"'
+    if request.if_none_match.contains_weak(document.etag):
+        return '', 304, {"ETag": etag}
+    return json_response(document.body, 200, etag)
+
+class ScimError(Exception):
+    def __init__(self, status, detail, scim_type=None):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.scim_type = scim_type
+
+def scim_error(detail, status, scim_type=None):
+    response = {
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+        "detail": detail,
+        "status": str(status)
+    }
+    if scim_type:
+        response["scimType"] = scim_type
+    return jsonify(response), status
+
+# Cursors are opaque to clients: they carry the sort order and the index
+# entry of the last user returned, so the next page resumes right after it
+# even if users were created or deleted in the meantime
+def encode_cursor(sort_attribute, descending, entry):
+    payload = json.dumps([sort_attribute, descending, entry], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, sort_attribute, descending):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_attribute, cursor_descending, entry = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor")
+    if (not isinstance(cursor_attribute, str) or not isinstance(cursor_descending, bool)
+            or cursor_attribute != sort_attribute or cursor_descending != descending):
+        raise ValueError("Cursor does not match the requested sort order")
+    # Entries are compared with the index entries by bisect, so they must
+    # have the same shape: the id, or (lowercase sort key, id)
+    if sort_attribute == 'id':
+        if not _is_id(entry):
+            raise ValueError("Malformed cursor")
+        return entry
+    if not isinstance(entry, list) or len(entry) != 2 or not isinstance(entry[0], str) or not _is_id(entry[1]):
+        raise ValueError("Malformed cursor")
+    return tuple(entry)
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
 
 # SCIM 2.0 endpoints
 
+SERVICE_PROVIDER_CONFIG = {
+    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"],
+    "documentationUri": "http://example.com/help/scim.html",
+    "patch": {"supported": True},
+    "bulk": {
+        "supported": True,
+        "maxOperations": app.config['SCIM_BULK_MAX_OPERATIONS'],
+        "maxPayloadSize": app.config['SCIM_BULK_MAX_PAYLOAD_SIZE']
+    },
+    "filter": {"supported": True, "maxResults": 200},
+    "changePassword": {"supported": False},
+    "sort": {"supported": True},
+    "pagination": {"cursor": True, "index": True, "defaultPaginationMethod": "index"},
+    "etag": {"supported": True},
+    "authenticationSchemes": [
+        {
+            "name": "OAuth Bearer Token",
+            "description": "Authentication scheme using the OAuth Bearer Token Standard",
+            "specUri": "http://www.rfc-editor.org/info/rfc6750",
+            "documentationUri": "http://example.com/help/oauth.html",
+            "type": "oauthbearertoken",
+            "primary": True
+        }
+    ]
+}
+
+SERVICE_PROVIDER_CONFIG_JSON = EncodedDocument(SERVICE_PROVIDER_CONFIG)
+
 @app.route('/scim/v2/ServiceProviderConfig', methods=['GET'])
 def service_provider_config():
     logging.info("Received GET /scim/v2/ServiceProviderConfig")
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig"],
-        "documentationUri": "http://example.com/help/scim.html",
-        "patch": {"supported": True},
-        "bulk": {"supported": False, "maxOperations": 0, "maxPayloadSize": 0},
-        "filter": {"supported": True, "maxResults": 200},
-        "changePassword": {"supported": False},
-        "sort": {"supported": True},
-        "etag": {"supported": False},
-        "authenticationSchemes": [
-            {
-                "name": "OAuth Bearer Token",
-                "description": "Authentication scheme using the OAuth Bearer Token Standard",
-                "specUri": "http://www.rfc-editor.org/info/rfc6750",
-                "documentationUri": "http://example.com/help/oauth.html",
-                "type": "oauthbearertoken",
-                "primary": True
-            }
-        ]
-    }
-    return jsonify(response), 200
+    return cached_json_response(SERVICE_PROVIDER_CONFIG_JSON)
+
+RESOURCE_TYPES = {
+    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ResourceType"],
+    "Resources": [
+        {
+            "id": "User",
+            "name": "User",
+            "endpoint": "/Users",
+            "description": "User Account",
+            "schema": "urn:ietf:params:scim:schemas:core:2.0:User",
+            "schemaExtensions": []
+        },
+        {
+            "id": "Group",
+            "name": "Group",
+            "endpoint": "/Groups",
+            "description": "Group",
+            "schema": "urn:ietf:params:scim:schemas:core:2.0:Group",
+            "schemaExtensions": []
+        }
+    ]
+}
+
+RESOURCE_TYPES_JSON = EncodedDocument(RESOURCE_TYPES)
 
 @app.route('/scim/v2/ResourceTypes', methods=['GET'])
 def resource_types():
     logging.info("Received GET /scim/v2/ResourceTypes")
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:ResourceType"],
-        "Resources": [
-            {
-                "id": "User",
-                "name": "User",
-                "endpoint": "/Users",
-                "description": "User Account",
-                "schema": "urn:ietf:params:scim:schemas:core:2.0:User",
-                "schemaExtensions": []
-            }
-        ]
-    }
-    return jsonify(response), 200
+    return cached_json_response(RESOURCE_TYPES_JSON)
+
+SCHEMAS = {
+    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Schema"],
+    "Resources": [
+        {
+            "id": "urn:ietf:params:scim:schemas:core:2.0:User",
+            "name": "User",
+            "description": "User Account",
+            "attributes": [
+                {
+                    "name": "userName",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "Unique identifier for the User",
+                    "required": True,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default",
+                    "uniqueness": "server"
+                },
+                {
+                    "name": "email",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "Email address of the User",
+                    "required": True,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default",
+                    "uniqueness": "server"
+                },
+                {
+                    "name": "name",
+                    "type": "complex",
+                    "multiValued": False,
+                    "description": "The components of the user's real name.",
+                    "required": False,
+                    "subAttributes": [
+                        {
+                            "name": "givenName",
+                            "type": "string",
+                            "multiValued": False,
+                            "description": "The given name of the User",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "readWrite",
+                            "returned": "default"
+                        },
+                        {
+                            "name": "familyName",
+                            "type": "string",
+                            "multiValued": False,
+                            "description": "The family name of the User",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "readWrite",
+                            "returned": "default"
+                        }
+                    ]
+                },
+                {
+                    "name": "externalId",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "External ID of the User",
+                    "required": False,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default"
+                },
+                {
+                    "name": "urn:custom:role",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "Role of the User",
+                    "required": False,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default",
+                    "canonicalValues": ["member", "manager", "owner"]
+                },
+                {
+                    "name": "urn:custom:accessLevels",
+                    "type": "complex",
+                    "multiValued": True,
+                    "description": "Access Levels of the User",
+                    "required": False,
+                    "subAttributes": [
+                        {
+                            "name": "value",
+                            "type": "string",
+                            "multiValued": False,
+                            "description": "Access Level ID",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "readWrite",
+                            "returned": "default",
+                            "canonicalValues": [
+                                "readonly_secret",
+                                "write_secret",
+                                "readonly_sca",
+                                "write_sca",
+                                "readonly_iac",
+                                "write_iac",
+                                "readonly_honeytoken",
+                                "write_honeytoken"
+                            ]
+                        }
+                    ]
+                },
+                {
+                    "name": "urn:custom:remoteId",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "Remote ID of the User",
+                    "required": False,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default"
+                },
+                {
+                    "name": "urn:custom:idpId",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "IDP ID of the User",
+                    "required": False,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default"
+                }
+            ]
+        },
+        {
+            "id": "urn:ietf:params:scim:schemas:core:2.0:Group",
+            "name": "Group",
+            "description": "Group",
+            "attributes": [
+                {
+                    "name": "displayName",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "A human-readable name for the Group",
+                    "required": True,
+                    "caseExact": False,
+                    "mutability": "readWrite",
+                    "returned": "default",
+                    "uniqueness": "none"
+                },
+                {
+                    "name": "externalId",
+                    "type": "string",
+                    "multiValued": False,
+                    "description": "Identifier of the Group in the provisioning client",
+                    "required": False,
+                    "caseExact": True,
+                    "mutability": "readWrite",
+                    "returned": "default"
+                },
+                {
+                    "name": "members",
+                    "type": "complex",
+                    "multiValued": True,
+                    "description": "A list of members of the Group",
+                    "required": False,
+                    "mutability": "readWrite",
+                    "returned": "default",
+                    "subAttributes": [
+                        {
+                            "name": "value",
+                            "type": "string",
+                            "multiValued": False,
+                            "description": "Identifier of the member User",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "immutable",
+                            "returned": "default"
+                        },
+                        {
+                            "name": "display",
+                            "type": "string",
+                            "multiValued": False,
+                            "description": "userName of the member User",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "readOnly",
+                            "returned": "default"
+                        },
+                        {
+                            "name": "$ref",
+                            "type": "reference",
+                            "referenceTypes": ["User"],
+                            "multiValued": False,
+                            "description": "The URI of the member User",
+                            "required": False,
+                            "caseExact": False,
+                            "mutability": "immutable",
+                            "returned": "default"
+                        }
+                    ]
+                }
+            ]
+        }
+    ]
+}
+
+SCHEMAS_JSON = EncodedDocument(SCHEMAS)
 
 @app.route('/scim/v2/Schemas', methods=['GET'])
 def schemas():
     logging.info("Received GET /scim/v2/Schemas")
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:Schema"],
-        "Resources": [
-            {
-                "id": "urn:ietf:params:scim:schemas:core:2.0:User",
-                "name": "User",
-                "description": "User Account",
-                "attributes": [
-                    {
-                        "name": "userName",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "Unique identifier for the User",
-                        "required": True,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default",
-                        "uniqueness": "server"
-                    },
-                    {
-                        "name": "email",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "Email address of the User",
-                        "required": True,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default",
-                        "uniqueness": "server"
-                    },
-                    {
-                        "name": "name",
-                        "type": "complex",
-                        "multiValued": False,
-                        "description": "The components of the user's real name.",
-                        "required": False,
-                        "subAttributes": [
-                            {
-                                "name": "givenName",
-                                "type": "string",
-                                "multiValued": False,
-                                "description": "The given name of the User",
-                                "required": False,
-                                "caseExact": False,
-                                "mutability": "readWrite",
-                                "returned": "default"
-                            },
-                            {
-                                "name": "familyName",
-                                "type": "string",
-                                "multiValued": False,
-                                "description": "The family name of the User",
-                                "required": False,
-                                "caseExact": False,
-                                "mutability": "readWrite",
-                                "returned": "default"
-                            }
-                        ]
-                    },
-                    {
-                        "name": "externalId",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "External ID of the User",
-                        "required": False,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default"
-                    },
-                    {
-                        "name": "urn:custom:role",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "Role of the User",
-                        "required": False,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default",
-                        "canonicalValues": ["member", "manager", "owner"]
-                    },
-                    {
-                        "name": "urn:custom:accessLevels",
-                        "type": "complex",
-                        "multiValued": True,
-                        "description": "Access Levels of the User",
-                        "required": False,
-                        "subAttributes": [
-                            {
-                                "name": "value",
-                                "type": "string",
-                                "multiValued": False,
-                                "description": "Access Level ID",
-                                "required": False,
-                                "caseExact": False,
-                                "mutability": "readWrite",
-                                "returned": "default",
-                                "canonicalValues": [
-                                    "readonly_secret",
-                                    "write_secret",
-                                    "readonly_sca",
-                                    "write_sca",
-                                    "readonly_iac",
-                                    "write_iac",
-                                    "readonly_honeytoken",
-                                    "write_honeytoken"
-                                ]
-                            }
-                        ]
-                    },
-                    {
-                        "name": "urn:custom:remoteId",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "Remote ID of the User",
-                        "required": False,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default"
-                    },
-                    {
-                        "name": "urn:custom:idpId",
-                        "type": "string",
-                        "multiValued": False,
-                        "description": "IDP ID of the User",
-                        "required": False,
-                        "caseExact": False,
-                        "mutability": "readWrite",
-                        "returned": "default"
-                    }
-                ]
-            }
-        ]
-    }
-    return jsonify(response), 200
+    return cached_json_response(SCHEMAS_JSON)
 
 # User management endpoints
 
-@app.route('/scim/v2/Users', methods=['POST'])
-def create_user():
-    global next_user_id
-
-    data = request.json
-    logging.info(f"Received POST /scim/v2/Users with data: {data}")
-
-    user_id = next_user_id
-    next_user_id += 1
-
-    user = {
+def new_user(data, user_id):
+    user = UserRecord.from_dict({
         "id": user_id,
         "externalId": data.get('externalId', str(user_id)),
         "userName": data.get('userName', data.get('email', '')),  # Set userName to email if not specified
@@ -219,150 +454,702 @@ def create_user():
         "urn:custom:remoteId": data.get('urn:custom:remoteId', ''),
         "urn:custom:accessLevels": data.get('urn:custom:accessLevels', ['readonly_secret']),  # Default to 'readonly_secret' if not specified
         "urn:custom:idpId": data.get('id', '')
-    }
+    })
+    user.created = user.last_modified = time.time()
+    return user
 
-    users[user_id] = user
+# Attributes of a user as seen by PATCH; emails is derived from the single
+# stored email address
+USER_PATCH_ATTRIBUTES = {
+    'id': SIMPLE,
+    'externalId': SIMPLE,
+    'userName': SIMPLE,
+    'name': COMPLEX,
+    'email': SIMPLE,
+    'emails': MULTI_VALUED,
+    'urn:custom:role': SIMPLE,
+    'urn:custom:remoteId': SIMPLE,
+    'urn:custom:accessLevels': MULTI_VALUED,
+    'urn:custom:idpId': SIMPLE,
+    'meta': COMPLEX,
+}
 
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-        "id": user_id,
-        "externalId": user['externalId'],
-        "userName": user['userName'],
-        "name": user['name'],
-        "email": user['email'],
-        "urn:custom:role": user['urn:custom:role'],
-        "urn:custom:remoteId": user['urn:custom:remoteId'],
-        "urn:custom:accessLevels": user['urn:custom:accessLevels'],
-        "urn:custom:idpId": user['urn:custom:idpId'],
-        "meta": {
-            "resourceType": "User"
-        }
-    }
-    return jsonify(response), 201
+def apply_patch_operations(user, operations):
+    """Return the user with PATCH operations applied, or the same record if nothing changed.
+
+    Raises PatchError if any operation fails; the stored record is untouched
+    either way, as the operations run against a copy.
+    """
+    before = user.to_dict()
+    document = user.to_dict()
+    emails = get_attribute(user, 'emails')
+    document['emails'] = emails
+    apply_operations(document, operations, USER_PATCH_ATTRIBUTES)
+
+    patched_emails = document.pop('emails', None) or []
+    primaries = [email for email in patched_emails if isinstance(email, dict) and email.get('primary')]
+    if len(primaries) > 1:
+        # Only one address may be primary (RFC 7643, section 2.4): one the
+        # patch made primary wins, the others no longer are
+        kept = next((email for email in primaries if email not in emails), primaries[0])
+        patched_emails = [dict(email, primary=False) if email is not kept and email in primaries else email
+                          for email in patched_emails]
+    if patched_emails != emails:
+        # The store keeps a single address: the primary one, else the first
+        primary = next((email for email in patched_emails if isinstance(email, dict) and email.get('primary')),
+                       patched_emails[0] if patched_emails else {})
+        document['email'] = primary.get('value', '') if isinstance(primary, dict) else primary
+    for attribute in ('externalId', 'userName', 'email', 'urn:custom:role', 'urn:custom:remoteId', 'urn:custom:idpId'):
+        value = document.get(attribute)
+        if value is None:
+            # A null value is the same as removing the attribute
+            document.pop(attribute, None)
+        elif not isinstance(value, str):
+            raise PatchError(f"'{attribute}' must be a string")
+    if not all(value is None or isinstance(value, str) for value in (document.get('name') or {}).values()):
+        raise PatchError("The sub-attributes of 'name' must be strings")
+    if not all(isinstance(level, str) for level in document.get('urn:custom:accessLevels') or ()):
+        raise PatchError("'urn:custom:accessLevels' must be a list of strings")
+
+    patched = UserRecord.from_dict(document)
+    if patched.to_dict() == before:
+        return user
+    patched.version = user.version + 1
+    patched.created = user.created
+    patched.last_modified = time.time()
+    return patched
+
+@app.route('/scim/v2/Users', methods=['POST'])
+def create_user():
+    data = request.json
+    logging.info("Received POST /scim/v2/Users with data: %s", data)
+
+    user = new_user(data, store.allocate_id())
+    store.add(user)
+    sync_store()
+
+    return user_response(user, 201)
+
+class UserListing:
+    """A page of GET /scim/v2/Users, produced lazily so it can be streamed.
+
+    Iterating yields the users of the page. Fields only known once the page
+    has been walked (itemsPerPage, nextCursor, and totalResults when the
+    filter needs a scan) are available from tail_fields() afterwards.
+    """
+
+    def __init__(self, args):
+        try:
+            self.count = max(int(args.get('count', '10')), 0)
+            self.start_index = max(int(args.get('startIndex', '1')), 1)
+        except ValueError:
+            raise ScimError(400, "count and startIndex must be integers", "invalidValue")
+        filter_text = args.get('filter')
+        sort_by = args.get('sortBy', 'id')
+        self.descending = args.get('sortOrder', 'ascending').lower() == 'descending'
+        # A `cursor` parameter (empty for the first page) selects cursor pagination
+        self.cursor = args.get('cursor')
+
+        try:
+            self.sort_attribute = '.'.join(parse_attribute_path(sort_by)) if sort_by else 'id'
+        except FilterError:
+            raise ScimError(400, f"Sorting by '{sort_by}' is not supported", "invalidValue")
+        if self.sort_attribute not in SORTABLE_ATTRIBUTES:
+            raise ScimError(400, f"Sorting by '{sort_by}' is not supported", "invalidValue")
+
+        self.user_filter = None
+        if filter_text:
+            try:
+                self.user_filter = compile_filter(filter_text)
+            except FilterError as e:
+                raise ScimError(400, str(e), "invalidFilter")
+
+        self.after = None
+        if self.cursor:
+            try:
+                self.after = decode_cursor(self.cursor, self.sort_attribute, self.descending)
+            except ValueError:
+                raise ScimError(400, "Invalid or expired cursor", "invalidCursor")
+
+        self.total_results = None
+        self.items_per_page = 0
+        self.next_cursor = None
+        self.source, self.skip = self._source()
+
+        self.head_fields = {}
+        if self.total_results is not None:
+            self.head_fields["totalResults"] = self.total_results
+        if self.cursor is None:
+            self.head_fields["startIndex"] = self.start_index
+
+    def _source(self):
+        """Return the users in page order and how many of them to skip."""
+        skip = 0 if self.cursor is not None else self.start_index - 1
+        if self.user_filter is None:
+            self.total_results = len(store)
+            if self.cursor is None:
+                # Serve the page straight from the ordered index
+                page = store.page(self.sort_attribute, self.descending, skip, self.count)
+                return page, 0
+            return store.iter_sorted(self.sort_attribute, self.descending, self.after), 0
+
+        # Use the secondary indexes to narrow the search when the filter allows it
+        candidate_ids = self.user_filter.candidates(store)
+        if candidate_ids is None:
+            metrics.increment('scim_filter_scans_total')
+            source = (user for user in store.iter_sorted(self.sort_attribute, self.descending, self.after)
+                      if self.user_filter.match(user))
+            return source, skip
+
+        metrics.increment('scim_filter_index_lookups_total')
+        matches = [store.get(user_id) for user_id in candidate_ids]
+        matches = [user for user in matches if user is not None and self.user_filter.match(user)]
+        self.total_results = len(matches)
+        entries = sorted((store.sort_entry(self.sort_attribute, user), user.id) for user in matches)
+        if self.descending:
+            entries.reverse()
+        if self.after is not None:
+            entries = [entry for entry in entries
+                       if (entry[0] < self.after if self.descending else entry[0] > self.after)]
+        source = (user for user in (store.get(user_id) for _, user_id in entries) if user is not None)
+        return source, skip
+
+    def __iter__(self):
+        if self.cursor is not None:
+            last = None
+            for user in self.source:
+                if self.items_per_page == self.count:
+                    # A user beyond the page exists, so there is a next page
+                    last_entry = store.sort_entry(self.sort_attribute, last) if last else self.after
+                    self.next_cursor = encode_cursor(self.sort_attribute, self.descending, last_entry)
+                    return
+                self.items_per_page += 1
+                last = user
+                yield user
+            return
+
+        seen = 0
+        for user in self.source:
+            seen += 1
+            if seen <= self.skip:
+                continue
+            if self.items_per_page < self.count:
+                self.items_per_page += 1
+                yield user
+            elif self.total_results is not None:
+                return
+        # Scanning filters learn the total by walking every match once
+        if self.total_results is None:
+            self.total_results = seen
+
+    def tail_fields(self):
+        fields = {"itemsPerPage": self.items_per_page}
+        if "totalResults" not in self.head_fields and self.total_results is not None:
+            fields["totalResults"] = self.total_results
+        if self.next_cursor is not None:
+            fields["nextCursor"] = self.next_cursor
+        return fields
 
 @app.route('/scim/v2/Users', methods=['GET'])
 def list_users():
     logging.info("Received GET /scim/v2/Users")
-    
-    # Get query parameters
-    count = int(request.args.get('count', '10'))
-    start_index = int(request.args.get('startIndex', '1'))
-    
-    # Calculate pagination indices
-    end_index = start_index + count - 1
-    
-    # Convert users dict to list for slicing
-    user_list = list(users.values())
-    paginated_users = user_list[start_index-1:end_index]
-    
-    response = {
-        "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
-        "totalResults": len(user_list),
-        "Resources": []
-    }
-    
-    for user in paginated_users:
-        user_response = {
-            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-            "id": user['id'],
-            "externalId": user['externalId'],
-            "userName": user['userName'],
-            "name": user['name'],
-            "email": user['email'],
-            "urn:custom:role": user['urn:custom:role'],
-            "urn:custom:remoteId": user['urn:custom:remoteId'],
-            "urn:custom:accessLevels": user['urn:custom:accessLevels'],
-            "urn:custom:idpId": user['urn:custom:idpId'],
-            "meta": {
-                "resourceType": "User"
-            }
-        }
-        response["Resources"].append(user_response)
-    
-    return jsonify(response), 200
+
+    try:
+        listing = UserListing(request.args)
+    except ScimError as e:
+        return scim_error(e.detail, e.status, e.scim_type)
+
+    if listing.count > app.config['SCIM_STREAM_THRESHOLD']:
+        # Large pages are streamed, so memory does not grow with count
+        body = serializer.iter_list(listing, remember=False)
+        return app.response_class(body, status=200, mimetype='application/json')
+    return json_response(b''.join(serializer.iter_list(listing)), 200)
 
 @app.route('/scim/v2/Users/<user_id>', methods=['GET'])
 def get_user(user_id):
-    logging.info(f"Received GET /scim/v2/Users/{user_id}")
-    user = users.get(int(user_id))
+    logging.info("Received GET /scim/v2/Users/%s", user_id)
+    user = store.get(int(user_id))
     if not user:
         return jsonify({"detail": "User not found"}), 404
 
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-        "id": user_id,
-        "externalId": user['externalId'],
-        "userName": user['userName'],
-        "name": user['name'],
-        "email": user['email'],
-        "urn:custom:role": user['urn:custom:role'],
-        "urn:custom:remoteId": user['urn:custom:remoteId'],
-        "urn:custom:accessLevels": user['urn:custom:accessLevels'],
-        "urn:custom:idpId": user['urn:custom:idpId'],
-        "meta": {
-            "resourceType": "User"
-        }
-    }
-    return jsonify(response), 200
+    if request.if_none_match.contains_weak(str(user.version)):
+        return '', 304, {"ETag": user_etag(user)}
+    return user_response(user, 200)
 
 @app.route('/scim/v2/Users/<user_id>', methods=['PATCH'])
 def update_user(user_id):
     data = request.json
-    logging.info(f"Received PATCH /scim/v2/Users/{user_id} with data: {data}")
-    user = users.get(int(user_id))
-    if not user:
-        return jsonify({"detail": "User not found"}), 404
-
-    for op in data.get('Operations', []):
-        if op['op'] == 'replace':
-            value = op['value']
-            if isinstance(value, str):
-                value = json.loads(value)
-            for key, val in value.items():
-                if key == 'name':
-                    user['name']['givenName'] = val.get('givenName', user['name']['givenName'])
-                    user['name']['familyName'] = val.get('familyName', user['name']['familyName'])
-                elif key == 'email':
-                    user['email'] = val
-                elif key == 'userName':
-                    user['userName'] = val
-                else:
-                    user[f"urn:custom:{key}"] = val
+    logging.info("Received PATCH /scim/v2/Users/%s with data: %s", user_id, data)
+    # Optimistic concurrency: the patched record only replaces the one it was
+    # built from, otherwise the patch is applied again to the newer record
+    while True:
+        current = store.get(int(user_id))
+        if not current:
+            return jsonify({"detail": "User not found"}), 404
+        if request.if_match and not request.if_match.contains_weak(str(current.version)):
+            return scim_error("The resource has been modified since it was last read", 412)
 
-    users[int(user_id)] = user
+        try:
+            user = apply_patch_operations(current, data.get('Operations', []))
+        except PatchError as e:
+            return scim_error(e.detail, 400, e.scim_type)
+        if user is current:
+            # Nothing changed: no new version, no index or log updates
+            return user_response(user, 200)
+        if store.replace(int(user_id), user, expected=current):
+            break
+    serializer.invalidate(user.id)
+    sync_store()
 
-    response = {
-        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-        "id": user_id,
-        "externalId": user['externalId'],
-        "userName": user['userName'],
-        "name": user['name'],
-        "email": user['email'],
-        "urn:custom:role": user['urn:custom:role'],
-        "urn:custom:remoteId": user['urn:custom:remoteId'],
-        "urn:custom:accessLevels": user['urn:custom:accessLevels'],
-        "urn:custom:idpId": user['urn:custom:idpId'],
-        "meta": {
-            "resourceType": "User"
-        }
-    }
-    return jsonify(response), 200
+    return user_response(user, 200)
 
 @app.route('/scim/v2/Users/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
-    logging.info(f"Received DELETE /scim/v2/Users/{user_id}")
-    if int(user_id) in users:
-        del users[int(user_id)]
+    logging.info("Received DELETE /scim/v2/Users/%s", user_id)
+    # The group store, a store listener, drops the user's memberships
+    # through the reverse index as part of the delete
+    if store.delete(int(user_id)) is not None:
+        serializer.invalidate(int(user_id))
+        sync_store()
         return '', 204
     else:
         return jsonify({"detail": "User not found"}), 404
 
+# Group management endpoints
+
+GROUP_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:Group"
+
+# Attributes of a group as seen by PATCH, apart from members
+GROUP_PATCH_ATTRIBUTES = {
+    'id': SIMPLE,
+    'displayName': SIMPLE,
+    'externalId': SIMPLE,
+    'meta': COMPLEX,
+}
+
+def include_members():
+    # Clients polling large groups ask for them without their members
+    excluded = request.args.get('excludedAttributes', '')
+    attributes = request.args.get('attributes')
+    if 'members' in [name.strip().lower() for name in excluded.split(',')]:
+        return False
+    if attributes is not None:
+        return 'members' in [name.strip().lower() for name in attributes.split(',')]
+    return True
+
+def group_resource(group, with_members=True):
+    with groups.lock:
+        resource = {
+            "schemas": [GROUP_SCHEMA],
+            "id": group.id,
+            "externalId": group.external_id,
+            "displayName": group.display_name,
+            "meta": {
+                "resourceType": "Group",
+                "created": format_timestamp(group.created),
+                "lastModified": format_timestamp(group.last_modified),
+                "version": user_etag(group)
+            }
+        }
+        member_ids = sorted(group.members) if with_members else None
+    if member_ids is not None:
+        members = []
+        for user_id in member_ids:
+            user = store.get(user_id)
+            if user is not None:
+                members.append({"value": str(user_id), "display": user.user_name, "$ref": f"../Users/{user_id}"})
+        resource["members"] = members
+    return resource
+
+def group_response(group, status, with_members=True):
+    resource = group_resource(group, with_members)
+    return json_response(dumps(resource), status, resource['meta']['version'])
+
+def member_ids(value):
+    # One member object, or a list of them; members are users, by ID
+    items = value if isinstance(value, list) else [value]
+    ids = []
+    for item in items:
+        member = item.get('value') if isinstance(item, dict) else item
+        try:
+            ids.append(int(member))
+        except (TypeError, ValueError):
+            raise PatchError(f"Invalid member '{member}'") from None
+    return ids
+
+def member_change(op, path, value, group):
+    """Translate one PATCH operation on members into a GroupStore.update() change."""
+    if path.sub_attribute is not None:
+        raise PatchError("Sub-attributes of members cannot be patched", 'invalidPath')
+    if path.value_filter is None:
+        if op == 'remove':
+            return ('clear', None) if value is None else ('remove', member_ids(value))
+        return (op, member_ids(value))
+    if op != 'remove':
+        raise PatchError("A value selection filter on members is only supported for remove", 'invalidPath')
+    terms = equality_terms(path.value_filter)
+    if terms is not None and set(terms) == {'value'}:
+        # members[value eq "id"]: a set removal, whatever the size of the group
+        return ('remove', member_ids(terms['value']))
+    return ('remove', [user_id for user_id in groups.members_of(group)
+                       if path.value_filter.match({'value': str(user_id)})])
+
+def group_patch_changes(group, operations):
+    """Translate the Operations of a PatchOp request into GroupStore.update() changes.
+
+    Member operations become set additions and removals on the member
+    index; the other attributes go through the generic PATCH engine.
+    """
+    if not isinstance(operations, list):
+        raise PatchError("Operations must be a list", 'invalidSyntax')
+    changes = []
+    attribute_operations = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise PatchError("Each operation must be an object", 'invalidSyntax')
+        op = str(operation.get('op', '')).lower()
+        if op not in OPERATIONS:
+            raise PatchError(f"Unsupported operation '{operation.get('op')}'", 'invalidSyntax')
+        path = operation.get('path')
+        value = operation.get('value')
+        if path and isinstance(path, str):
+            parsed = compile_path(path)
+            if parsed.attribute == 'members':
+                changes.append(member_change(op, parsed, value, group))
+                continue
+        elif not path and isinstance(value, dict):
+            # A pathless value may mix members with other attributes
+            other = {}
+            for name, item in value.items():
+                if compile_path(name).attribute == 'members':
+                    changes.append(member_change(op, compile_path(name), item, group))
+                else:
+                    other[name] = item
+            operation = dict(operation, value=other)
+        attribute_operations.append(operation)
+
+    document = {"displayName": group.display_name, "externalId": group.external_id}
+    apply_operations(document, attribute_operations, GROUP_PATCH_ATTRIBUTES)
+    display_name = document.get('displayName')
+    external_id = document.get('externalId') or ''
+    if not isinstance(display_name, str) or not display_name:
+        raise PatchError("displayName is required and must be a string")
+    if not isinstance(external_id, str):
+        raise PatchError("'externalId' must be a string")
+    attributes = {}
+    if display_name != group.display_name:
+        attributes['display_name'] = display_name
+    if external_id != group.external_id:
+        attributes['external_id'] = external_id
+    if attributes:
+        changes.insert(0, ('set', attributes))
+    return changes
+
+@app.route('/scim/v2/Groups', methods=['POST'])
+def create_group():
+    data = request.json
+    logging.info("Received POST /scim/v2/Groups with %d members", len(data.get('members') or []))
+    display_name = data.get('displayName')
+    if not isinstance(display_name, str) or not display_name:
+        return scim_error("displayName is required", 400, "invalidValue")
+    try:
+        members = member_ids(data.get('members') or [])
+    except PatchError as e:
+        return scim_error(e.detail, 400, e.scim_type)
+
+    group = GroupRecord(groups.allocate_id(), display_name, data.get('externalId', ''), members, time.time())
+    try:
+        groups.add(group)
+    except KeyError as e:
+        return scim_error(f"User '{e.args[0]}' not found", 400, "invalidValue")
+    return group_response(group, 201)
+
+@app.route('/scim/v2/Groups', methods=['GET'])
+def list_groups():
+    logging.info("Received GET /scim/v2/Groups")
+    try:
+        count = max(int(request.args.get('count', '100')), 0)
+        start_index = max(int(request.args.get('startIndex', '1')), 1)
+    except ValueError:
+        return scim_error("count and startIndex must be integers", 400, "invalidValue")
+    group_filter = None
+    if request.args.get('filter'):
+        try:
+            group_filter = compile_filter(request.args['filter'])
+        except FilterError as e:
+            return scim_error(str(e), 400, "invalidFilter")
+
+    with groups.lock:
+        if group_filter is None:
+            # Group IDs are allocated in increasing order
+            group_ids = list(groups.groups)
+        else:
+            candidate_ids = group_filter.candidates(groups)
+            if candidate_ids is None:
+                group_ids = [group.id for group in groups.groups.values() if group_filter.match(group)]
+            elif answers_exactly(group_filter, groups):
+                # e.g. members[value eq "42"]: the reverse index is the answer
+                group_ids = sorted(group_id for group_id in candidate_ids if group_id in groups.groups)
+            else:
+                group_ids = sorted(group_id for group_id in candidate_ids
+                                   if group_id in groups.groups and group_filter.match(groups.groups[group_id]))
+    page = [groups.get(group_id) for group_id in group_ids[start_index - 1:start_index - 1 + count]]
+    with_members = include_members()
+    resources = [group_resource(group, with_members) for group in page if group is not None]
+    return json_response(dumps({
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
+        "totalResults": len(group_ids),
+        "startIndex": start_index,
+        "itemsPerPage": len(resources),
+        "Resources": resources
+    }), 200)
+
+@app.route('/scim/v2/Groups/<int:group_id>', methods=['GET'])
+def get_group(group_id):
+    logging.info("Received GET /scim/v2/Groups/%s", group_id)
+    group = groups.get(group_id)
+    if group is None:
+        return scim_error("Group not found", 404)
+    if request.if_none_match.contains_weak(str(group.version)):
+        return '', 304, {"ETag": user_etag(group)}
+    return group_response(group, 200, include_members())
+
+@app.route('/scim/v2/Groups/<int:group_id>', methods=['PATCH'])
+def update_group(group_id):
+    data = request.json
+    logging.info("Received PATCH /scim/v2/Groups/%s with %d operations", group_id,
+                 len(data.get('Operations') or []))
+    group = groups.get(group_id)
+    if group is None:
+        return scim_error("Group not found", 404)
+    expected_version = None
+    if request.if_match:
+        if not request.if_match.contains_weak(str(group.version)):
+            return scim_error("The resource has been modified since it was last read", 412)
+        expected_version = group.version
+
+    try:
+        changes = group_patch_changes(group, data.get('Operations', []))
+        updated = groups.update(group_id, changes, time.time(), expected_version)
+    except PatchError as e:
+        return scim_error(e.detail, 400, e.scim_type)
+    except KeyError as e:
+        return scim_error(f"User '{e.args[0]}' not found", 400, "invalidValue")
+    if updated is None:
+        if groups.get(group_id) is None:
+            return scim_error("Group not found", 404)
+        return scim_error("The resource has been modified since it was last read", 412)
+
+    # Returning the group would cost O(members) for a one-member change, so
+    # the body is only sent when the client asks for specific attributes
+    if 'attributes' in request.args or 'excludedAttributes' in request.args:
+        return group_response(updated, 200, include_members())
+    return '', 204, {"ETag": user_etag(updated)}
+
+@app.route('/scim/v2/Groups/<int:group_id>', methods=['DELETE'])
+def delete_group(group_id):
+    logging.info("Received DELETE /scim/v2/Groups/%s", group_id)
+    if groups.delete(group_id) is None:
+        return scim_error("Group not found", 404)
+    return '', 204
+
+# Delta sync endpoint, see scim_journal.py for the protocol
+
+CHANGES_SCHEMA = "urn:custom:api:messages:2.0:Changes"
+CHANGES_MAX_COUNT = 10000
+
+@app.route('/scim/v2/Changes', methods=['GET'])
+def list_changes():
+    since = request.args.get('since')
+    logging.info("Received GET /scim/v2/Changes since %s", since)
+    if not since:
+        # Starting point for a consumer about to do its full sync
+        return json_response(dumps({"schemas": [CHANGES_SCHEMA], "watermark": journal.watermark(),
+                                    "hasMore": False, "Changes": []}), 200)
+    try:
+        count = min(max(int(request.args.get('count', '1000')), 1), CHANGES_MAX_COUNT)
+    except ValueError:
+        return scim_error("count must be an integer", 400, "invalidValue")
+    try:
+        seq = journal.parse_watermark(since)
+    except ValueError as e:
+        return scim_error(str(e), 400, "invalidValue")
+    except WatermarkExpired as e:
+        return scim_error(str(e), 410)
+
+    changes, watermark, has_more = journal.changes(seq, count)
+    parts = []
+    for seq, user_id, deleted in changes:
+        user = None if deleted else store.get(user_id)
+        if user is None:
+            parts.append(dumps({"seq": seq, "op": "delete", "id": user_id}))
+        else:
+            # Splice in the cached encoding of the user
+            parts.append(b'{"seq":%d,"op":"upsert","id":%d,"resource":%s}' % (seq, user_id, serializer.encode(user)))
+    head = dumps({"schemas": [CHANGES_SCHEMA], "watermark": watermark, "hasMore": has_more})
+    return json_response(head[:-1] + b',"Changes":[' + b','.join(parts) + b']}', 200)
+
+# Bulk endpoint (RFC 7644, section 3.7)
+
+def resolve_bulk_ids(value, bulk_ids):
+    # Replace "bulkId:<id>" references with the ID created earlier in the batch
+    if isinstance(value, str):
+        if value.startswith('bulkId:'):
+            bulk_id = value[len('bulkId:'):]
+            if bulk_id not in bulk_ids:
+                raise ScimError(409, f"Unresolved bulkId reference '{bulk_id}'", "invalidValue")
+            return str(bulk_ids[bulk_id])
+        return value
+    if isinstance(value, list):
+        return [resolve_bulk_ids(item, bulk_ids) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_bulk_ids(item, bulk_ids) for key, item in value.items()}
+    return value
+
+def bulk_target_user_id(path, bulk_ids):
+    prefix, _, user_id = path.partition('/Users/')
+    if prefix or not user_id:
+        raise ScimError(400, f"Unsupported bulk path '{path}'", "invalidPath")
+    try:
+        return int(resolve_bulk_ids(user_id, bulk_ids))
+    except ValueError:
+        raise ScimError(404, "User not found")
+
+def bulk_operation_fields(operation):
+    """The path and data of a bulk operation; raise ScimError if it is malformed."""
+    if not isinstance(operation, dict):
+        raise ScimError(400, "Each bulk operation must be an object", "invalidSyntax")
+    path = operation.get('path', '')
+    data = operation.get('data', {})
+    if not isinstance(operation.get('method'), str) or not isinstance(path, str):
+        raise ScimError(400, "method and path must be strings", "invalidSyntax")
+    if not isinstance(operation.get('bulkId', ''), str):
+        raise ScimError(400, "bulkId must be a string", "invalidValue")
+    if not isinstance(data, dict):
+        raise ScimError(400, "data must be an object", "invalidSyntax")
+    return path, data
+
+@app.route('/scim/v2/Bulk', methods=['POST'])
+def bulk():
+    max_operations = app.config['SCIM_BULK_MAX_OPERATIONS']
+    max_payload_size = app.config['SCIM_BULK_MAX_PAYLOAD_SIZE']
+    too_large = f"The size of the bulk operation exceeds the maxPayloadSize ({max_payload_size})"
+    if request.content_length is not None and request.content_length > max_payload_size:
+        return scim_error(too_large, 413)
+    # A chunked body has no Content-Length, so the body read is checked too
+    if len(request.get_data()) > max_payload_size:
+        return scim_error(too_large, 413)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('Operations', []), list):
+        return scim_error("The bulk request must be an object with a list of Operations", 400, "invalidSyntax")
+    operations = data.get('Operations', [])
+    fail_on_errors = data.get('failOnErrors')
+    if fail_on_errors is not None and (not isinstance(fail_on_errors, int) or isinstance(fail_on_errors, bool)
+                                       or fail_on_errors < 1):
+        return scim_error("failOnErrors must be a positive integer", 400, "invalidValue")
+    logging.info("Received POST /scim/v2/Bulk with %d operations", len(operations))
+    if len(operations) > max_operations:
+        return scim_error(f"The number of operations exceeds the maxOperations ({max_operations})", 413)
+
+    location_prefix = request.url_root + 'scim/v2/Users/'
+    bulk_ids = {}
+    results = []
+    errors = 0
+    # New users are added to the store in batches, so the ordered indexes are
+    # merged once per batch instead of once per user
+    pending_users = []
+
+    # The whole batch is applied under the store lock, so no other writer can
+    # interleave its changes with the batch
+    with store.lock:
+        try:
+            for operation in operations:
+                fields = operation if isinstance(operation, dict) else {}
+                method = str(fields.get('method', '')).upper()
+                bulk_id = fields.get('bulkId')
+                result = {"method": method}
+                if bulk_id is not None:
+                    result["bulkId"] = bulk_id
+                try:
+                    path, operation_data = bulk_operation_fields(operation)
+                    if method == 'POST':
+                        if path != '/Users':
+                            raise ScimError(400, f"Unsupported bulk path '{path}'", "invalidPath")
+                        if bulk_id is None:
+                            raise ScimError(400, "bulkId is required for POST operations", "invalidValue")
+                        try:
+                            user = new_user(resolve_bulk_ids(operation_data, bulk_ids), store.allocate_id())
+                        except (AttributeError, IndexError, TypeError):
+                            # e.g. a name or emails that are not objects
+                            raise ScimError(400, "Malformed user in data", "invalidValue") from None
+                        pending_users.append(user)
+                        bulk_ids[bulk_id] = user['id']
+                        result["location"] = f"{location_prefix}{user['id']}"
+                        result["version"] = user_etag(user)
+                        result["status"] = "201"
+                    elif method in ('PATCH', 'DELETE'):
+                        if pending_users:
+                            store.add_many(pending_users)
+                            pending_users = []
+                        user_id = bulk_target_user_id(path, bulk_ids)
+                        user = store.get(user_id)
+                        if not user:
+                            raise ScimError(404, "User not found")
+                        if method == 'PATCH':
+                            operations_data = resolve_bulk_ids(operation_data, bulk_ids)
+                            try:
+                                patched = apply_patch_operations(user, operations_data.get('Operations', []))
+                            except PatchError as e:
+                                raise ScimError(400, e.detail, e.scim_type) from None
+                            if patched is not user:
+                                store.replace(user_id, patched)
+                                user = patched
+                            result["version"] = user_etag(user)
+                            result["status"] = "200"
+                        else:
+                            store.delete(user_id)
+                            result["status"] = "204"
+                        serializer.invalidate(user_id)
+                        result["location"] = f"{location_prefix}{user_id}"
+                    else:
+                        raise ScimError(405, f"Unsupported bulk method '{method}'")
+                except ScimError as e:
+                    errors += 1
+                    error = {
+                        "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+                        "detail": e.detail,
+                        "status": str(e.status)
+                    }
+                    if e.scim_type:
+                        error["scimType"] = e.scim_type
+                    result["status"] = str(e.status)
+                    result["response"] = error
+                results.append(result)
+                if fail_on_errors and errors >= fail_on_errors:
+                    break
+        finally:
+            # Users created so far are kept even if an operation fails
+            # unexpectedly, their IDs are already allocated
+            if pending_users:
+                store.add_many(pending_users)
+    # A single wait covers every change in the batch
+    sync_store()
+
+    response = {
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+        "Operations": results
+    }
+    return jsonify(response), 200
+
 # HTML endpoint to display users
-@app.route('/')
-def display_users():
-    users_list = list(users.values())
-    
-    html_template = '''
+
+# Maximum number of matches collected for a search on the admin page
+ADMIN_SEARCH_LIMIT = 1000
+ADMIN_PER_PAGE = 50
+
+# Compiled once at import instead of on every request
+USERS_PAGE_TEMPLATE = app.jinja_env.from_string('''
     <!DOCTYPE html>
     <html>
     <head>
@@ -392,8 +1179,24 @@ def display_users():
             <li><a href="/scim/v2/ResourceTypes">/scim/v2/ResourceTypes</a></li>
             <li><a href="/scim/v2/Schemas">/scim/v2/Schemas</a></li>
             <li><a href="/scim/v2/Users">/scim/v2/Users</a></li>
+            <li><a href="/scim/v2/Groups">/scim/v2/Groups</a></li>
         </ul>
+        <p>
+            {{ group_count }} groups. Groups are kept in memory only: unlike users, they are not saved to the data
+            directory and are lost on restart, and they are not part of /scim/v2/Bulk or /scim/v2/Changes.
+        </p>
         <h1>Users</h1>
+        <form method="get" action="/">
+            <input type="text" name="q" value="{{ query }}" placeholder="User name, email, external or IDP ID">
+            <button type="submit">Search</button>
+            {% if query %}<a href="/">Clear</a>{% endif %}
+        </form>
+        <p>
+            {% if query %}{{ total }}{% if truncated %}+{% endif %} matching users{% else %}{{ total }} users{% endif %},
+            page {{ page }} of {{ pages }}
+            {% if page > 1 %}<a href="?q={{ query | urlencode }}&page={{ page - 1 }}&per_page={{ per_page }}">Previous</a>{% endif %}
+            {% if page < pages %}<a href="?q={{ query | urlencode }}&page={{ page + 1 }}&per_page={{ per_page }}">Next</a>{% endif %}
+        </p>
         <table border="1">
             <tr>
                 <th class="blue">ID</th>
@@ -409,22 +1212,67 @@ def display_users():
             {% for user in users %}
             <tr>
                 <td>{{ user.id }}</td>
-                <td>{{ user.userName }}</td>
-                <td>{{ user.name.givenName }}</td>
-                <td>{{ user.name.familyName }}</td>
+                <td>{{ user.user_name }}</td>
+                <td>{{ user.given_name }}</td>
+                <td>{{ user.family_name }}</td>
                 <td>{{ user.email }}</td>
-                <td>{{ user['urn:custom:role'] }}</td>
-                <td>{{ user['urn:custom:remoteId'] }}</td>
-                <td>{{ user['urn:custom:accessLevels'] | join(', ') }}</td>
-                <td>{{ user['urn:custom:idpId'] }}</td>
+                <td>{{ user.role }}</td>
+                <td>{{ user.remote_id }}</td>
+                <td>{{ user.access_levels | join(', ') }}</td>
+                <td>{{ user.idp_id }}</td>
             </tr>
             {% endfor %}
         </table>
     </body>
     </html>
-    '''
+    ''')
+
+def search_user_ids(query):
+    """Return the IDs of users matching an admin page search, and whether the result was capped.
+
+    Exact matches come from the hash indexes, and userName/email prefix
+    matches from a range of the ordered indexes.
+    """
+    user_ids = set()
+    for attribute in ('userName', 'email', 'externalId', 'urn:custom:idpId'):
+        user_ids |= store.lookup(attribute, query)
+    for attribute in ('userName', 'email'):
+        for user in store.iter_prefix(attribute, query):
+            if len(user_ids) >= ADMIN_SEARCH_LIMIT:
+                return user_ids, True
+            user_ids.add(user.id)
+    return user_ids, False
+
+@app.route('/')
+def display_users():
+    query = request.args.get('q', '').strip()
+    try:
+        page = max(int(request.args.get('page', '1')), 1)
+        per_page = min(max(int(request.args.get('per_page', ADMIN_PER_PAGE)), 1), 500)
+    except ValueError:
+        page, per_page = 1, ADMIN_PER_PAGE
+    offset = (page - 1) * per_page
+
+    truncated = False
+    if query:
+        user_ids, truncated = search_user_ids(query)
+        total = len(user_ids)
+        page_ids = sorted(user_ids)[offset:offset + per_page]
+        users = (user for user in map(store.get, page_ids) if user is not None)
+    else:
+        total = len(store)
+        users = store.page('id', False, offset, per_page)
+
+    # Rows are rendered and sent as the template is generated
+    stream = USERS_PAGE_TEMPLATE.stream(users=users, query=query, total=total, truncated=truncated, group_count=len(groups),
+                                        page=page, per_page=per_page,
+                                        pages=max((total + per_page - 1) // per_page, 1))
+    stream.enable_buffering(size=100)
+    return app.response_class(stream, mimetype='text/html')
 
-    return render_template_string(html_template, users=users_list)
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8081)
@@ -0,0 +1,476 @@
+"""Load generator for the demo SCIM API.
+
+Runs a sequence of workloads at a chosen concurrency, either in-process
+against the Flask app (test client, no network) or over keep-alive HTTP
+connections to a running server, one connection per worker thread. For
+each workload it reports req/s and p50/p95/p99 latency per endpoint, and
+can write the results as JSON so runs on two commits can be compared.
+
+Workloads, run in the order given as name=requests:
+    create  single POST /scim/v2/Users
+    bulk    POST /scim/v2/Bulk, --bulk-size users per request (requests = users)
+    lookup  GET /scim/v2/Users?filter=userName eq "..."
+    scan    GET /scim/v2/Users?cursor=..., --page-size users per page
+    patch   PATCH /scim/v2/Users/<id> with a small attribute-level change
+    get     GET /scim/v2/Users/<id>
+    delete  DELETE /scim/v2/Users/<id>
+
+Usage:
+    python3 load_scim.py bulk=20000 lookup=20000 scan=500 patch=20000 delete=2000 --concurrency 16
+    python3 load_scim.py --target http://127.0.0.1:8081 create=5000 patch=20000 --output after.json
+    python3 load_scim.py --target http://127.0.0.1:8081 patch=20000 --compare after.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+USER_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:User"
+PATCH_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:PatchOp"
+BULK_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+
+
+class InProcessTransport:
+    """Sends requests through the Flask test client of the imported app."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, data=body, content_type='application/json')
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HttpTransport:
+    """Sends requests over one persistent HTTP/1.1 connection."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip('/')
+        self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in (1, 2):
+            try:
+                self.connection.request(method, self.prefix + path, body, headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed the idle connection; reconnect once
+                self.connection.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        self.connection.close()
+
+
+class UserPool:
+    """IDs and user names of the users created or discovered during a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = []
+
+    def add(self, user_id, user_name):
+        with self.lock:
+            self.users.append((user_id, user_name))
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.users) if self.users else None
+
+    def take(self, rng):
+        # Removes the user, so concurrent deletes never target the same one
+        with self.lock:
+            if not self.users:
+                return None
+            index = rng.randrange(len(self.users))
+            self.users[index], self.users[-1] = self.users[-1], self.users[index]
+            return self.users.pop()
+
+    def __len__(self):
+        return len(self.users)
+
+
+def user_payload(tag, i):
+    return {
+        "schemas": [USER_SCHEMA],
+        "userName": f"load-{tag}-{i}@example.com",
+        "name": {"givenName": f"Given{i}", "familyName": f"Family{i}"},
+        "emails": [{"value": f"load-{tag}-{i}@example.com", "type": "work", "primary": True}],
+        "externalId": f"load-{tag}-{i}",
+        "urn:custom:role": "member",
+        "urn:custom:accessLevels": ["readonly_secret"],
+    }
+
+
+class Workload:
+    """Issues the requests of one workload; a task is one request."""
+
+    # Endpoint label -> status codes that count as success
+    expected = {}
+
+    def __init__(self, run):
+        self.run = run
+
+    def prepare(self, transport):
+        pass
+
+    def requests_for(self, count):
+        return count
+
+    def task(self, transport, rng, n):
+        """Issue one request and return (endpoint label, status)."""
+        raise NotImplementedError
+
+
+class CreateWorkload(Workload):
+    expected = {'POST /scim/v2/Users': {201}}
+
+    def task(self, transport, rng, n):
+        i = next(self.run.user_numbers)
+        payload = user_payload(self.run.tag, i)
+        status, body = transport.request('POST', '/scim/v2/Users', json.dumps(payload).encode())
+        if status == 201:
+            self.run.pool.add(json.loads(body)['id'], payload['userName'])
+        return 'POST /scim/v2/Users', status
+
+
+class BulkWorkload(Workload):
+    expected = {'POST /scim/v2/Bulk': {200}}
+
+    def requests_for(self, count):
+        # The count given for bulk is a number of users
+        return max((count + self.run.bulk_size - 1) // self.run.bulk_size, 1)
+
+    def task(self, transport, rng, n):
+        payloads = [user_payload(self.run.tag, next(self.run.user_numbers)) for _ in range(self.run.bulk_size)]
+        operations = [{"method": "POST", "path": "/Users", "bulkId": str(index), "data": payload}
+                      for index, payload in enumerate(payloads)]
+        status, body = transport.request('POST', '/scim/v2/Bulk', json.dumps({
+            "schemas": [BULK_SCHEMA],
+            "Operations": operations
+        }).encode())
+        if status == 200:
+            for result, payload in zip(json.loads(body)['Operations'], payloads):
+                if result.get('status') == '201':
+                    self.run.pool.add(int(result['location'].rsplit('/', 1)[1]), payload['userName'])
+        return 'POST /scim/v2/Bulk', status
+
+
+class LookupWorkload(Workload):
+    expected = {'GET /scim/v2/Users?filter': {200}}
+
+    def prepare(self, transport):
+        self.run.ensure_users(transport)
+
+    def task(self, transport, rng, n):
+        user = self.run.pool.pick(rng)
+        # Every tenth lookup is for a user that does not exist
+        user_name = user[1] if user and n % 10 else f"missing-{n}@example.com"
+        query = urllib.parse.urlencode({'filter': f'userName eq "{user_name}"'})
+        status, _ = transport.request('GET', f'/scim/v2/Users?{query}')
+        return 'GET /scim/v2/Users?filter', status
+
+
+class ScanWorkload(Workload):
+    expected = {'GET /scim/v2/Users?cursor': {200}}
+
+    def __init__(self, run):
+        super().__init__(run)
+        # Each worker thread walks the directory with its own cursor
+        self.cursors = threading.local()
+
+    def task(self, transport, rng, n):
+        cursor = getattr(self.cursors, 'next', None) or ''
+        query = urllib.parse.urlencode({'count': self.run.page_size, 'cursor': cursor})
+        status, body = transport.request('GET', f'/scim/v2/Users?{query}')
+        # Start over from the first page at the end of the directory
+        self.cursors.next = json.loads(body).get('nextCursor') if status == 200 else None
+        return 'GET /scim/v2/Users?cursor', status
+
+
+class PatchWorkload(Workload):
+    expected = {'PATCH /scim/v2/Users/{id}': {200, 404}}
+
+    def prepare(self, transport):
+        self.run.ensure_users(transport)
+
+    def task(self, transport, rng, n):
+        user = self.run.pool.pick(rng)
+        if user is None:
+            return 'PATCH /scim/v2/Users/{id}', 404
+        operation = rng.choice([
+            {"op": "replace", "path": "name.givenName", "value": f"Given-{n}"},
+            {"op": "replace", "path": "urn:custom:role", "value": rng.choice(["member", "admin"])},
+            {"op": "add", "path": "urn:custom:accessLevels", "value": ["readonly_sca"]},
+            {"op": "replace", "value": {"name": {"familyName": f"Family-{n}"}}},
+        ])
+        status, _ = transport.request('PATCH', f'/scim/v2/Users/{user[0]}', json.dumps({
+            "schemas": [PATCH_SCHEMA],
+            "Operations": [operation]
+        }).encode())
+        return 'PATCH /scim/v2/Users/{id}', status
+
+
+class GetWorkload(Workload):
+    expected = {'GET /scim/v2/Users/{id}': {200, 404}}
+
+    def prepare(self, transport):
+        self.run.ensure_users(transport)
+
+    def task(self, transport, rng, n):
+        user = self.run.pool.pick(rng)
+        status, _ = transport.request('GET', f'/scim/v2/Users/{user[0] if user else 0}')
+        return 'GET /scim/v2/Users/{id}', status
+
+
+class DeleteWorkload(Workload):
+    expected = {'DELETE /scim/v2/Users/{id}': {204}}
+
+    def prepare(self, transport):
+        self.run.ensure_users(transport)
+
+    def task(self, transport, rng, n):
+        user = self.run.pool.take(rng)
+        if user is None:
+            raise LookupError("no users left to delete")
+        status, _ = transport.request('DELETE', f'/scim/v2/Users/{user[0]}')
+        return 'DELETE /scim/v2/Users/{id}', status
+
+
+WORKLOADS = {
+    'create': CreateWorkload,
+    'bulk': BulkWorkload,
+    'lookup': LookupWorkload,
+    'scan': ScanWorkload,
+    'patch': PatchWorkload,
+    'get': GetWorkload,
+    'delete': DeleteWorkload,
+}
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    endpoints = {}
+    for label, values in sorted(latencies.items()):
+        values.sort()
+        endpoints[label] = {
+            "requests": len(values),
+            "errors": errors.get(label, 0),
+            "rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    return endpoints
+
+
+class LoadRun:
+    def __init__(self, transport_factory, concurrency, bulk_size, page_size, seed):
+        self.transport_factory = transport_factory
+        self.concurrency = concurrency
+        self.bulk_size = bulk_size
+        self.page_size = page_size
+        self.seed = seed
+        # Distinguishes the users of this run from those of earlier runs on the same server
+        self.tag = uuid.uuid4().hex[:8]
+        self.user_numbers = itertools.count()
+        self.pool = UserPool()
+        self.discovered = False
+
+    def ensure_users(self, transport):
+        """Fill the pool from the server when no earlier workload created users."""
+        if len(self.pool) or self.discovered:
+            return
+        self.discovered = True
+        cursor = ''
+        while cursor is not None and len(self.pool) < 100000:
+            query = urllib.parse.urlencode({'count': 1000, 'cursor': cursor})
+            status, body = transport.request('GET', f'/scim/v2/Users?{query}')
+            if status != 200:
+                break
+            page = json.loads(body)
+            for user in page.get('Resources', []):
+                self.pool.add(user['id'], user['userName'])
+            cursor = page.get('nextCursor')
+
+    def run_workload(self, name, count):
+        workload = WORKLOADS[name](self)
+        total = workload.requests_for(count)
+        setup = self.transport_factory()
+        try:
+            workload.prepare(setup)
+        finally:
+            setup.close()
+
+        tasks = itertools.count()
+        results = []
+        failures = []
+
+        def worker(index):
+            rng = random.Random(self.seed * 1000 + index)
+            transport = self.transport_factory()
+            # Per-thread results, merged once the workload is over
+            latencies = {}
+            errors = {}
+            try:
+                while True:
+                    n = next(tasks)
+                    if n >= total:
+                        break
+                    started = time.perf_counter()
+                    try:
+                        label, status = workload.task(transport, rng, n)
+                    except LookupError:
+                        break
+                    elapsed = time.perf_counter() - started
+                    latencies.setdefault(label, []).append(elapsed)
+                    if status not in workload.expected.get(label, ()):
+                        errors[label] = errors.get(label, 0) + 1
+            except Exception as e:
+                failures.append(f"{type(e).__name__}: {e}")
+            finally:
+                transport.close()
+                results.append((latencies, errors))
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(self.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        latencies = {}
+        errors = {}
+        for thread_latencies, thread_errors in results:
+            for label, values in thread_latencies.items():
+                latencies.setdefault(label, []).extend(values)
+            for label, value in thread_errors.items():
+                errors[label] = errors.get(label, 0) + value
+        requests = sum(len(values) for values in latencies.values())
+        return {
+            "workload": name,
+            "requests": requests,
+            "seconds": round(elapsed, 3),
+            "rps": round(requests / elapsed, 1) if elapsed else 0.0,
+            "endpoints": summarize(latencies, errors, elapsed),
+            "failures": failures[:10],
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    baseline_endpoints = {}
+    if baseline:
+        for result in baseline['workloads']:
+            for label, stats in result['endpoints'].items():
+                baseline_endpoints[(result['workload'], label)] = stats
+
+    print(f"target: {report['target']}, concurrency: {report['concurrency']}, commit: {report['commit']}")
+    header = f"{'workload':<8} {'endpoint':<28} {'requests':>9} {'errors':>7} {'req/s':>10} " \
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    if baseline:
+        header += f" {'req/s vs base':>14} {'p99 vs base':>12}"
+    print(header)
+    for result in report['workloads']:
+        for label, stats in result['endpoints'].items():
+            line = f"{result['workload']:<8} {label:<28} {stats['requests']:>9} {stats['errors']:>7} " \
+                   f"{stats['rps']:>10,.1f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+            base = baseline_endpoints.get((result['workload'], label))
+            if base:
+                line += f" {stats['rps'] / base['rps'] if base['rps'] else 0:>13.2f}x" \
+                        f" {stats['p99_ms'] / base['p99_ms'] if base['p99_ms'] else 0:>11.2f}x"
+            print(line)
+        for failure in result['failures']:
+            print(f"  {result['workload']} worker failed: {failure}")
+
+
+def parse_workload(text):
+    name, _, count = text.partition('=')
+    if name not in WORKLOADS or not count.isdigit():
+        raise argparse.ArgumentTypeError(f"expected one of {', '.join(WORKLOADS)} as name=requests, got '{text}'")
+    return name, int(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='\n'.join(__doc__.splitlines()[7:]))
+    parser.add_argument('workloads', nargs='+', type=parse_workload, metavar='name=requests')
+    parser.add_argument('--target', default='inprocess',
+                        help="'inprocess' (default) or the base URL of a running server")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--bulk-size', type=int, default=100, help='users per Bulk request')
+    parser.add_argument('--page-size', type=int, default=100, help='users per page for scans')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as JSON to this file (- for stdout)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    if args.target == 'inprocess':
+        import demo_app_scim
+        # Request logs would dominate the in-process numbers
+        logging.disable(logging.INFO)
+        transport_factory = lambda: InProcessTransport(demo_app_scim.app)
+    else:
+        transport_factory = lambda: HttpTransport(args.target)
+
+    run = LoadRun(transport_factory, args.concurrency, args.bulk_size, args.page_size, args.seed)
+    report = {
+        "target": args.target,
+        "concurrency": args.concurrency,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "started": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "workloads": [run.run_workload(name, count) for name, count in args.workloads],
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report, baseline)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""ASGI serving mode for the demo SCIM server.
+
+GET /scim/v2/Users is served natively: the ListResponse is encoded by a
+generator over the store and sent chunk by chunk, so memory stays flat
+even for count=100000 exports, and idle or slow IdP connections only cost
+a coroutine instead of a worker thread. Encoding runs on the default
+thread pool so the event loop keeps serving other connections meanwhile.
+Every other endpoint is handed to the Flask app through a small WSGI
+bridge, also on the thread pool.
+
+Usage:
+    pip3 install uvicorn
+    uvicorn scim_asgi:app --host 0.0.0.0 --port 8081
+"""
+import asyncio
+import io
+import logging
+import sys
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+import demo_app_scim
+from scim_serializer import dumps
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    chunks = demo_app_scim.app(environ, start_response)
+    try:
+        body = b''.join(chunks)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return response['status'], response['headers'], body
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def stream_users(scope, send):
+    logging.info("Received GET /scim/v2/Users")
+    args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    try:
+        listing = await asyncio.to_thread(demo_app_scim.UserListing, args)
+    except demo_app_scim.ScimError as e:
+        error = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:Error"],
+            "detail": e.detail,
+            "status": str(e.status)
+        }
+        if e.scim_type:
+            error["scimType"] = e.scim_type
+        await send_response(send, e.status, [('Content-Type', 'application/json')], dumps(error))
+        return
+
+    # Large exports are not added to the response cache, see UserSerializer.encode
+    remember = listing.count <= demo_app_scim.app.config['SCIM_STREAM_THRESHOLD']
+    chunks = demo_app_scim.serializer.iter_list(listing, remember=remember)
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if demo_app_scim.persistence is not None:
+                await asyncio.to_thread(demo_app_scim.persistence.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'GET' and scope['path'].rstrip('/') == '/scim/v2/Users':
+        await stream_users(scope, send)
+        return
+
+    body = await read_body(receive)
+    status, headers, response_body = await asyncio.to_thread(call_wsgi, wsgi_environ(scope, body))
+    await send_response(send, status, headers, response_body)
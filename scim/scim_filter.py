@@ -0,0 +1,391 @@
+"""SCIM 2.0 filter parsing and evaluation (RFC 7644, section 3.4.2.2).
+
+A filter string is tokenized and parsed once into a small tree of nodes.
+Each node knows how to match a stored user record and, when possible, how
+to narrow the search down to a set of candidate IDs using the store's
+secondary indexes, so `userName eq "x"` costs a hash lookup instead of a
+scan over every user.
+"""
+import functools
+import json
+import re
+
+CORE_USER_SCHEMA = 'urn:ietf:params:scim:schemas:core:2.0:User'
+
+# Canonical attribute names, keyed by their lowercase form
+# (SCIM attribute names are case insensitive)
+ATTRIBUTE_NAMES = {
+    'id': 'id',
+    'externalid': 'externalId',
+    'username': 'userName',
+    'name': 'name',
+    'email': 'email',
+    'emails': 'emails',
+    'urn:custom:role': 'urn:custom:role',
+    'urn:custom:remoteid': 'urn:custom:remoteId',
+    'urn:custom:accesslevels': 'urn:custom:accessLevels',
+    'urn:custom:idpid': 'urn:custom:idpId',
+    'meta': 'meta',
+    'displayname': 'displayName',
+    'members': 'members',
+}
+
+# Filter attribute paths that may be answered from a store index; a store
+# returns None from lookup() for attributes it does not index
+INDEXED_PATHS = {
+    ('id',): 'id',
+    ('userName',): 'userName',
+    ('externalId',): 'externalId',
+    ('email',): 'email',
+    ('emails', 'value'): 'email',
+    ('urn:custom:idpId',): 'urn:custom:idpId',
+    ('displayName',): 'displayName',
+    ('members', 'value'): 'members',
+}
+
+COMPARISON_OPERATORS = ('eq', 'ne', 'co', 'sw', 'ew', 'gt', 'ge', 'lt', 'le')
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+      | (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<lbracket>\[)
+      | (?P<rbracket>\])
+      | (?P<word>[^\s()\[\]"]+)
+    )''', re.VERBOSE)
+
+
+class FilterError(ValueError):
+    """Raised when a filter expression cannot be parsed."""
+
+
+def get_attribute(record, name):
+    """Return the value of a top-level attribute of a user record or sub-value."""
+    if name == 'emails' and 'emails' not in record:
+        # The store only keeps the primary work address of a user
+        if not record.get('email'):
+            return []
+        return [{'value': record['email'], 'type': 'work', 'primary': True}]
+    return record.get(name)
+
+
+def resolve_path(value, path):
+    """Follow sub-attribute names into a value, flattening multi-valued attributes."""
+    for name in path:
+        if isinstance(value, list):
+            value = [item.get(name) if isinstance(item, dict) else None for item in value]
+        elif isinstance(value, dict):
+            value = value.get(name)
+        else:
+            return None
+    return value
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return value.lower()
+    return value
+
+
+def _compare(op, actual, expected):
+    if actual is None:
+        return op == 'ne' and expected is not None
+    if isinstance(actual, (int, float)) and not isinstance(actual, bool) and isinstance(expected, str):
+        actual = str(actual)
+    actual = _normalize(actual)
+    if op == 'eq':
+        return actual == expected
+    if op == 'ne':
+        return actual != expected
+    if not isinstance(actual, type(expected)) and not isinstance(expected, type(actual)):
+        return False
+    if op == 'co':
+        return isinstance(actual, str) and expected in actual
+    if op == 'sw':
+        return isinstance(actual, str) and actual.startswith(expected)
+    if op == 'ew':
+        return isinstance(actual, str) and actual.endswith(expected)
+    if op == 'gt':
+        return actual > expected
+    if op == 'ge':
+        return actual >= expected
+    if op == 'lt':
+        return actual < expected
+    if op == 'le':
+        return actual <= expected
+    return False
+
+
+def _present(value):
+    if value is None:
+        return False
+    if isinstance(value, (str, list, dict)):
+        return len(value) > 0
+    return True
+
+
+class Comparison:
+    def __init__(self, path, op, value):
+        self.path = path
+        self.op = op
+        self.value = _normalize(value)
+        # As written, for values a PATCH creates from the filter
+        self.literal = value
+
+    def match(self, record):
+        actual = resolve_path(get_attribute(record, self.path[0]), self.path[1:])
+        if self.op == 'pr':
+            if isinstance(actual, list):
+                return any(_present(item) for item in actual)
+            return _present(actual)
+        if isinstance(actual, list):
+            if self.op == 'ne':
+                return all(_compare('ne', item, self.value) for item in actual)
+            return any(_compare(self.op, item, self.value) for item in actual)
+        return _compare(self.op, actual, self.value)
+
+    def candidates(self, store):
+        attribute = INDEXED_PATHS.get(self.path)
+        if self.op == 'eq' and attribute and isinstance(self.value, str) and self.value:
+            return store.lookup(attribute, self.value)
+        return None
+
+
+class ValuePath:
+    """`attr[filter]`: true when any element of a multi-valued attribute matches."""
+
+    def __init__(self, path, element_filter):
+        self.path = path
+        self.element_filter = element_filter
+
+    def match(self, user):
+        values = resolve_path(get_attribute(user, self.path[0]), self.path[1:])
+        if not isinstance(values, list):
+            values = [values] if values is not None else []
+        for item in values:
+            if not isinstance(item, dict):
+                item = {'value': item}
+            if self.element_filter.match(item):
+                return True
+        return False
+
+    def candidates(self, store):
+        element_filter = self.element_filter
+        if isinstance(element_filter, And):
+            # emails[type eq "work" and value eq "x"]
+            for side in (element_filter.left, element_filter.right):
+                if isinstance(side, Comparison) and side.path == ('value',):
+                    element_filter = side
+                    break
+        if isinstance(element_filter, Comparison) and element_filter.path == ('value',):
+            return Comparison(self.path + ('value',), element_filter.op, element_filter.value).candidates(store)
+        return None
+
+
+class And:
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def match(self, record):
+        return self.left.match(record) and self.right.match(record)
+
+    def candidates(self, store):
+        left = self.left.candidates(store)
+        right = self.right.candidates(store)
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return left & right
+
+
+class Or:
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def match(self, record):
+        return self.left.match(record) or self.right.match(record)
+
+    def candidates(self, store):
+        left = self.left.candidates(store)
+        if left is None:
+            return None
+        right = self.right.candidates(store)
+        if right is None:
+            return None
+        return left | right
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+    def match(self, record):
+        return not self.operand.match(record)
+
+    def candidates(self, store):
+        return None
+
+
+def answers_exactly(node, store):
+    """Return whether node.candidates(store) holds exactly the records node matches.
+
+    When it does, the candidates need not be matched one by one, which
+    matters for attributes that are costly to match, such as the members
+    of a large group. store.indexed_attributes names what it indexes.
+    """
+    if isinstance(node, Comparison):
+        return (node.op == 'eq' and isinstance(node.value, str) and bool(node.value)
+                and INDEXED_PATHS.get(node.path) in store.indexed_attributes)
+    if isinstance(node, ValuePath):
+        element_filter = node.element_filter
+        return (isinstance(element_filter, Comparison) and element_filter.path == ('value',)
+                and answers_exactly(Comparison(node.path + ('value',), element_filter.op, element_filter.value), store))
+    if isinstance(node, (And, Or)):
+        return answers_exactly(node.left, store) and answers_exactly(node.right, store)
+    return False
+
+
+class Parser:
+    def __init__(self, text):
+        self.tokens = self._tokenize(text)
+        self.position = 0
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN_RE.match(text, position)
+            if not match or match.end() == position:
+                raise FilterError(f"Unexpected character at position {position}")
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind)))
+            position = match.end()
+        return tokens
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise FilterError("Unexpected end of filter")
+        self.position += 1
+        return token
+
+    def _peek_keyword(self):
+        kind, text = self._peek()
+        return text.lower() if kind == 'word' else None
+
+    def parse(self):
+        node = self._parse_or()
+        if self._peek()[0] is not None:
+            raise FilterError(f"Unexpected token '{self._peek()[1]}'")
+        return node
+
+    def _parse_or(self):
+        node = self._parse_and()
+        while self._peek_keyword() == 'or':
+            self._next()
+            node = Or(node, self._parse_and())
+        return node
+
+    def _parse_and(self):
+        node = self._parse_not()
+        while self._peek_keyword() == 'and':
+            self._next()
+            node = And(node, self._parse_not())
+        return node
+
+    def _parse_not(self):
+        if self._peek_keyword() == 'not':
+            self._next()
+            if self._peek()[0] != 'lparen':
+                raise FilterError("Expected '(' after 'not'")
+            return Not(self._parse_atom())
+        return self._parse_atom()
+
+    def _parse_atom(self):
+        kind, text = self._next()
+        if kind == 'lparen':
+            node = self._parse_or()
+            if self._next()[0] != 'rparen':
+                raise FilterError("Expected ')'")
+            return node
+        if kind != 'word':
+            raise FilterError(f"Expected attribute path, got '{text}'")
+        path = parse_attribute_path(text)
+        if self._peek()[0] == 'lbracket':
+            self._next()
+            element_filter = self._parse_or()
+            if self._next()[0] != 'rbracket':
+                raise FilterError("Expected ']'")
+            return ValuePath(path, element_filter)
+        op = self._next()[1].lower()
+        if op == 'pr':
+            return Comparison(path, 'pr', None)
+        if op not in COMPARISON_OPERATORS:
+            raise FilterError(f"Unknown operator '{op}'")
+        return Comparison(path, op, self._parse_value())
+
+    def _parse_value(self):
+        kind, text = self._next()
+        if kind == 'string':
+            return json.loads(text)
+        if kind == 'word':
+            lowered = text.lower()
+            if lowered in ('true', 'false'):
+                return lowered == 'true'
+            if lowered == 'null':
+                return None
+            try:
+                return json.loads(text)
+            except ValueError:
+                pass
+        raise FilterError(f"Invalid comparison value '{text}'")
+
+
+def parse_attribute_path(text):
+    """Split an attribute path such as `name.familyName` into canonical names."""
+    if text.lower().startswith(CORE_USER_SCHEMA.lower() + ':'):
+        text = text[len(CORE_USER_SCHEMA) + 1:]
+    if text.lower().startswith('urn:'):
+        # Custom extension attributes keep their colons, sub-attributes follow a dot
+        urn, _, rest = text.partition('.')
+        names = [urn] + (rest.split('.') if rest else [])
+    else:
+        names = text.split('.')
+    if not all(names):
+        raise FilterError(f"Invalid attribute path '{text}'")
+    head = ATTRIBUTE_NAMES.get(names[0].lower(), names[0])
+    return (head,) + tuple(_canonical_sub_attribute(name) for name in names[1:])
+
+
+def _canonical_sub_attribute(name):
+    return {
+        'givenname': 'givenName',
+        'familyname': 'familyName',
+        'value': 'value',
+        'type': 'type',
+        'primary': 'primary',
+        'display': 'display',
+        'resourcetype': 'resourceType',
+        'created': 'created',
+        'lastmodified': 'lastModified',
+        'version': 'version',
+    }.get(name.lower(), name)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_filter(text):
+    """Parse a filter expression, reusing the compiled form for repeated filters."""
+    if not text or not text.strip():
+        raise FilterError("Empty filter")
+    return Parser(text).parse()
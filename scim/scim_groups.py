@@ -0,0 +1,232 @@
+"""In-memory group store for the demo SCIM server.
+
+Each group keeps its members as a set of user IDs (the forward index), and
+the store keeps the groups of each user (the reverse index), so adding or
+removing one member costs O(1) whatever the size of the group, and
+finding or cleaning up the groups of a user never scans every group.
+
+Unlike users, groups are changed in place: copying the member set of a
+100k-member group on every PATCH is exactly what the indexes avoid. Every
+change and every read of a member set therefore happens under the store
+lock. The store is registered as a listener of the user store, so a
+deleted user is removed from its groups by the same delete. It must not
+take the user store lock itself: the user store calls it while holding
+that lock.
+
+Groups are not persisted: the operation log, snapshots, change journal
+and /Bulk only cover users, so groups are lost when the server restarts.
+"""
+import threading
+import time
+
+from scim_store import index_key
+
+
+class GroupRecord:
+    __slots__ = ('id', 'display_name', 'external_id', 'members', 'version', 'created', 'last_modified')
+
+    def __init__(self, id, display_name, external_id='', members=(), created=None):
+        self.id = id
+        self.display_name = display_name
+        self.external_id = external_id
+        # User IDs; only changed through GroupStore
+        self.members = set(members)
+        # Bumped on every change, exposed as meta.version / ETag
+        self.version = 1
+        self.created = created
+        self.last_modified = created
+
+    def get(self, attribute, default=None):
+        # Dict-style reads for filters; members is read under the store lock
+        if attribute == 'id':
+            return self.id
+        if attribute == 'displayName':
+            return self.display_name
+        if attribute == 'externalId':
+            return self.external_id
+        if attribute == 'members':
+            return [{'value': str(user_id)} for user_id in self.members]
+        return default
+
+    def __contains__(self, attribute):
+        return attribute in ('id', 'displayName', 'externalId', 'members')
+
+
+class GroupStore:
+    # Attributes lookup() answers from an index, see scim_filter.answers_exactly
+    indexed_attributes = frozenset(('id', 'displayName', 'externalId', 'members'))
+
+    def __init__(self, users):
+        # The user store, to check that new members exist
+        self.users = users
+        self.groups = {}
+        self.next_group_id = 1
+        self.lock = threading.RLock()
+        # user ID -> set of group IDs
+        self.user_groups = {}
+        # Lowercase displayName / externalId -> set of group IDs
+        self.display_names = {}
+        self.external_ids = {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def allocate_id(self):
+        with self.lock:
+            group_id = self.next_group_id
+            self.next_group_id += 1
+            return group_id
+
+    def get(self, group_id):
+        return self.groups.get(group_id)
+
+    def values(self):
+        with self.lock:
+            return list(self.groups.values())
+
+    def missing_users(self, user_ids):
+        return [user_id for user_id in user_ids if self.users.get(user_id) is None]
+
+    def add(self, group):
+        """Store a new group. Raises KeyError if a member is not a known user."""
+        with self.lock:
+            # Checked under the lock: a user deleted after this check is
+            # removed from the group by on_delete once the lock is released
+            missing = self.missing_users(group.members)
+            if missing:
+                raise KeyError(missing[0])
+            self.groups[group.id] = group
+            self._index(self.display_names, group.display_name, group.id)
+            self._index(self.external_ids, group.external_id, group.id)
+            for user_id in group.members:
+                self.user_groups.setdefault(user_id, set()).add(group.id)
+
+    def update(self, group_id, changes, timestamp, expected_version=None):
+        """Apply attribute and member changes to a group as one unit.
+
+        changes is a list of (kind, argument) with kind one of 'set'
+        ({attribute slot: value}), 'add' and 'remove' (user IDs), 'replace'
+        (the new member IDs) and 'clear'. Returns the group, or None if it
+        does not exist or its version is not expected_version. Raises
+        KeyError before changing anything if a member to add is unknown.
+        """
+        with self.lock:
+            group = self.groups.get(group_id)
+            if group is None or (expected_version is not None and group.version != expected_version):
+                return None
+            for kind, argument in changes:
+                if kind in ('add', 'replace'):
+                    missing = self.missing_users(argument)
+                    if missing:
+                        raise KeyError(missing[0])
+
+            for kind, argument in changes:
+                if kind == 'set':
+                    self._set_attributes(group, argument)
+                elif kind == 'add':
+                    self._add_members(group, argument)
+                elif kind == 'remove':
+                    self._remove_members(group, argument)
+                elif kind == 'replace':
+                    new_members = set(argument)
+                    self._remove_members(group, group.members - new_members)
+                    self._add_members(group, new_members)
+                elif kind == 'clear':
+                    self._remove_members(group, list(group.members))
+            group.version += 1
+            group.last_modified = timestamp
+            return group
+
+    def delete(self, group_id):
+        with self.lock:
+            group = self.groups.pop(group_id, None)
+            if group is None:
+                return None
+            self._unindex(self.display_names, group.display_name, group_id)
+            self._unindex(self.external_ids, group.external_id, group_id)
+            for user_id in group.members:
+                self._unindex(self.user_groups, user_id, group_id)
+            return group
+
+    def groups_of(self, user_id):
+        with self.lock:
+            return set(self.user_groups.get(user_id, ()))
+
+    def members_of(self, group):
+        """Return a sorted copy of the member IDs of a group."""
+        with self.lock:
+            return sorted(group.members)
+
+    def lookup(self, attribute, value):
+        """Return the set of group IDs whose attribute equals value, or None if it is not indexed."""
+        if attribute == 'id':
+            try:
+                group_id = int(value)
+            except (TypeError, ValueError):
+                return set()
+            return {group_id} if group_id in self.groups else set()
+        if attribute == 'displayName':
+            index = self.display_names
+        elif attribute == 'externalId':
+            index = self.external_ids
+        elif attribute == 'members':
+            try:
+                return self.groups_of(int(value))
+            except (TypeError, ValueError):
+                return set()
+        else:
+            return None
+        with self.lock:
+            return set(index.get(index_key(value), ()))
+
+    # User store listener: only deletes concern groups
+
+    def on_put(self, user):
+        pass
+
+    def on_delete(self, user):
+        with self.lock:
+            for group_id in self.user_groups.pop(user.id, ()):
+                group = self.groups[group_id]
+                group.members.discard(user.id)
+                group.version += 1
+                group.last_modified = time.time()
+
+    def _set_attributes(self, group, attributes):
+        if 'display_name' in attributes:
+            self._unindex(self.display_names, group.display_name, group.id)
+            group.display_name = attributes['display_name']
+            self._index(self.display_names, group.display_name, group.id)
+        if 'external_id' in attributes:
+            self._unindex(self.external_ids, group.external_id, group.id)
+            group.external_id = attributes['external_id']
+            self._index(self.external_ids, group.external_id, group.id)
+
+    def _add_members(self, group, user_ids):
+        for user_id in user_ids:
+            if user_id not in group.members:
+                group.members.add(user_id)
+                self.user_groups.setdefault(user_id, set()).add(group.id)
+
+    def _remove_members(self, group, user_ids):
+        for user_id in user_ids:
+            if user_id in group.members:
+                group.members.discard(user_id)
+                self._unindex(self.user_groups, user_id, group.id)
+
+    @staticmethod
+    def _index(index, value, group_id):
+        key = index_key(value)
+        if key in (None, ''):
+            return
+        index.setdefault(key, set()).add(group_id)
+
+    @staticmethod
+    def _unindex(index, value, group_id):
+        key = index_key(value)
+        ids = index.get(key)
+        if ids is None:
+            return
+        ids.discard(group_id)
+        if not ids:
+            del index[key]
@@ -0,0 +1,102 @@
+"""Change journal for delta sync of the demo SCIM directory.
+
+The journal is a store listener: every put and delete gets the next
+sequence number, and a consumer that remembers the watermark of its last
+sync only asks for the entries after it, instead of walking the whole
+directory again.
+
+Only the newest entry of each user matters to a consumer, so when the
+journal outgrows its retention, superseded entries are dropped first.
+If that is not enough, the oldest entries are dropped too, and
+watermarks older than them are refused: those consumers must do a full
+sync. Sequence numbers restart with the process, so a watermark carries
+the epoch it was issued in and watermarks from another epoch are refused
+the same way.
+
+Sync protocol for a consumer:
+    1. GET /scim/v2/Changes (no since) for the current watermark
+    2. walk GET /scim/v2/Users for a full copy
+    3. repeat GET /scim/v2/Changes?since=<watermark>, applying upserts and
+       deletes, until hasMore is false, and keep the last watermark
+"""
+import bisect
+import secrets
+import threading
+
+
+class WatermarkExpired(Exception):
+    """Raised for a watermark the journal can no longer answer from."""
+
+
+class ChangeJournal:
+    def __init__(self, retention=100000):
+        self.retention = retention
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0
+        # (seq, user_id, deleted) in sequence order
+        self.entries = []
+        # user ID -> seq of the newest entry of the user
+        self.latest = {}
+        # Changes up to this seq have been compacted away
+        self.floor = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def on_put(self, user):
+        self._record(user.id, False)
+
+    def on_delete(self, user):
+        self._record(user.id, True)
+
+    def _record(self, user_id, deleted):
+        # Called under the store lock, so sequence order is commit order
+        with self.lock:
+            self.seq += 1
+            self.entries.append((self.seq, user_id, deleted))
+            self.latest[user_id] = self.seq
+            if len(self.entries) > self.retention:
+                self._compact()
+
+    def _compact(self):
+        entries = [entry for entry in self.entries if self.latest[entry[1]] == entry[0]]
+        # Keep half the retention free, so compaction runs once per
+        # retention / 2 changes at most
+        excess = len(entries) - self.retention // 2
+        if excess > 0:
+            for seq, user_id, deleted in entries[:excess]:
+                del self.latest[user_id]
+            self.floor = entries[excess - 1][0]
+            entries = entries[excess:]
+        self.entries = entries
+
+    def watermark(self, seq=None):
+        return f'{self.epoch}.{self.seq if seq is None else seq}'
+
+    def parse_watermark(self, watermark):
+        """Return the sequence number of a watermark issued by this journal."""
+        epoch, _, seq = watermark.partition('.')
+        if not seq.isdigit():
+            raise ValueError(f"Invalid watermark '{watermark}'")
+        seq = int(seq)
+        if epoch != self.epoch or seq > self.seq:
+            raise WatermarkExpired("The watermark was issued before a restart; a full sync is required")
+        if seq < self.floor:
+            raise WatermarkExpired("The watermark is older than the journal retention; a full sync is required")
+        return seq
+
+    def changes(self, since, count):
+        """Return up to count (seq, user_id, deleted) entries after since, the new watermark and whether more remain."""
+        with self.lock:
+            position = bisect.bisect_right(self.entries, (since, float('inf')))
+            changes = []
+            while position < len(self.entries) and len(changes) < count:
+                entry = self.entries[position]
+                # Superseded entries are skipped: the newer one follows
+                if self.latest.get(entry[1]) == entry[0]:
+                    changes.append(entry)
+                position += 1
+            if position < len(self.entries):
+                return changes, self.watermark(self.entries[position - 1][0] if position else since), True
+            return changes, self.watermark(), False
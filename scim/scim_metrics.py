@@ -0,0 +1,152 @@
+"""Request metrics for the demo SCIM server, in Prometheus text format.
+
+Recording a request is a couple of dict lookups and additions under a
+lock; the text exposition is only built when /metrics is scraped. Gauges
+are callbacks evaluated at scrape time, so the store is never polled in
+the background.
+
+Also sets up logging through a queue, so writing log lines never happens
+on a request thread.
+"""
+import bisect
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One slot per bucket plus the +Inf overflow slot
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, **labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {self.count}')
+        lines.append(f'{name}_sum{_labels(**labels)} {self.sum}')
+        lines.append(f'{name}_count{_labels(**labels)} {self.count}')
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, endpoint) -> Histogram
+        self.latency = {}
+        # (method, endpoint, status) -> count
+        self.requests = {}
+        # (method, endpoint) -> bytes
+        self.request_bytes = {}
+        self.response_bytes = {}
+        # name -> count, e.g. filter lookups answered from an index vs by a scan
+        self.counters = {}
+        # name -> (help, callback)
+        self.gauges = {}
+
+    def observe_request(self, method, endpoint, status, seconds, request_bytes, response_bytes):
+        key = (method, endpoint)
+        with self.lock:
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(seconds)
+            status_key = (method, endpoint, status)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.request_bytes[key] = self.request_bytes.get(key, 0) + request_bytes
+            self.response_bytes[key] = self.response_bytes.get(key, 0) + response_bytes
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, help_text, callback):
+        self.gauges[name] = (help_text, callback)
+
+    def render(self):
+        lines = [
+            '# HELP scim_request_duration_seconds Request latency by endpoint',
+            '# TYPE scim_request_duration_seconds histogram',
+        ]
+        with self.lock:
+            for (method, endpoint), histogram in sorted(self.latency.items()):
+                lines += histogram.render('scim_request_duration_seconds', method=method, endpoint=endpoint)
+
+            lines += ['# HELP scim_requests_total Requests by endpoint and status',
+                      '# TYPE scim_requests_total counter']
+            for (method, endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'scim_requests_total{_labels(method=method, endpoint=endpoint, status=status)} {count}')
+
+            for name, values, help_text in (
+                ('scim_request_bytes_total', self.request_bytes, 'Request body bytes by endpoint'),
+                ('scim_response_bytes_total', self.response_bytes, 'Response body bytes by endpoint'),
+            ):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for (method, endpoint), value in sorted(values.items()):
+                    lines.append(f'{name}{_labels(method=method, endpoint=endpoint)} {value}')
+
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE {name} counter', f'{name} {value}']
+
+        # Gauges read live state, outside the metrics lock
+        for name, (help_text, callback) in sorted(self.gauges.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {callback()}']
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingFilter(logging.Filter):
+    """Let through a fraction of records below WARNING; warnings and errors always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them on the calling thread.
+
+    The stock QueueHandler formats the message before queueing it; here the
+    record is queued as is and the listener thread formats it, so a request
+    never pays for turning a large payload into a string. Callers must not
+    mutate the objects they pass as logging arguments.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.INFO, sample_rate=1.0):
+    """Route the root logger through a queue drained by a background thread."""
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample_rate))
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [handler]
+    listener.start()
+    return listener
@@ -0,0 +1,286 @@
+"""NDJSON import and export of the demo SCIM directory.
+
+Works offline on the server's data directory (SCIM_DATA_DIR), so stop the
+server first. Each line is one SCIM User resource, as returned by
+GET /scim/v2/Users/<id>; exports can be imported again as they are.
+
+Import is a streaming pipeline: lines are read in chunks, chunks are
+parsed and validated in a pool of worker processes with a bounded number
+of chunks in flight, and valid records are committed to the store batch
+by batch. Indexes are built in one pass once every batch is in, and the
+result is written as a fresh snapshot. Records without an id get a new
+one; records with an id keep it, so an export can be restored as is.
+
+Export streams the users in id order, encoded in chunks.
+
+Usage:
+    python3 scim_ndjson.py import users.ndjson --data-dir data
+    cat users.ndjson | python3 scim_ndjson.py import - --data-dir data --workers 4
+    python3 scim_ndjson.py export --data-dir data -o backup.ndjson
+    python3 scim_ndjson.py export --data-dir data | gzip > backup.ndjson.gz
+"""
+import argparse
+import calendar
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+
+from scim_persistence import Persistence
+from scim_serializer import UserSerializer
+from scim_store import UserRecord, UserStore, paused_gc
+
+VERSION_RE = re.compile(r'^W/"(\d+)"$')
+
+# Errors printed in full; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def _parse_timestamp(value):
+    # meta.created / meta.lastModified as written by format_timestamp,
+    # e.g. 2024-05-01T12:00:00.250Z; parsed by hand as strptime is slow
+    if not value:
+        return None
+    timestamp = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    fraction = value[20:].rstrip('Z')
+    return timestamp + (int(fraction[:3].ljust(3, '0')) / 1000 if fraction else 0)
+
+
+def _string(data, name, default=''):
+    value = data.get(name, default)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise ValueError(f"'{name}' must be a string")
+    return value
+
+
+def validate_record(data):
+    """Return the UserRecord fields of one imported resource, or raise ValueError."""
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    user_id = data.get('id')
+    if user_id is not None and (not isinstance(user_id, int) or isinstance(user_id, bool) or user_id < 1):
+        raise ValueError("'id' must be a positive integer")
+    name = data.get('name') or {}
+    if not isinstance(name, dict):
+        raise ValueError("'name' must be an object")
+    emails = data.get('emails') or []
+    if not isinstance(emails, list) or not all(isinstance(email, dict) for email in emails):
+        raise ValueError("'emails' must be a list of objects")
+    email = _string(data, 'email') or next(
+        (email.get('value') for email in emails if email.get('primary')), emails[0].get('value') if emails else '')
+    if not isinstance(email, str):
+        raise ValueError("email values must be strings")
+    # Same defaults as POST /scim/v2/Users
+    user_name = _string(data, 'userName') or email
+    if not user_name:
+        raise ValueError("'userName' is required")
+    access_levels = data.get('urn:custom:accessLevels')
+    if access_levels is None:
+        access_levels = ['readonly_secret']
+    if not isinstance(access_levels, list) or not all(isinstance(level, str) for level in access_levels):
+        raise ValueError("'urn:custom:accessLevels' must be a list of strings")
+
+    meta = data.get('meta') or {}
+    if not isinstance(meta, dict):
+        raise ValueError("'meta' must be an object")
+    version = meta.get('version') or ''
+    if not isinstance(version, str):
+        raise ValueError("'meta.version' must be a string")
+    version = VERSION_RE.match(version)
+    try:
+        created = _parse_timestamp(meta.get('created'))
+        last_modified = _parse_timestamp(meta.get('lastModified'))
+    except (ValueError, TypeError):
+        raise ValueError("invalid meta timestamps") from None
+    return (
+        user_id,
+        _string(data, 'externalId', str(user_id or '')),
+        user_name,
+        _string(name, 'givenName'),
+        _string(name, 'familyName'),
+        email,
+        _string(data, 'urn:custom:role', 'member') or 'member',
+        _string(data, 'urn:custom:remoteId'),
+        tuple(access_levels),
+        _string(data, 'urn:custom:idpId'),
+        int(version.group(1)) if version else 1,
+        created,
+        last_modified,
+    )
+
+
+def validate_chunk(chunk):
+    """Parse and validate (first line number, lines); return ([(line number, record)], [(line number, error)])."""
+    first_line, lines = chunk
+    records = []
+    errors = []
+    for line_number, line in enumerate(lines, first_line):
+        try:
+            records.append((line_number, validate_record(json.loads(line))))
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+    return records, errors
+
+
+def read_chunks(stream, chunk_size):
+    lines = []
+    first_line = 1
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        if not lines:
+            first_line = line_number
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            yield first_line, lines
+            lines = []
+    if lines:
+        yield first_line, lines
+
+
+def validated_chunks(stream, chunk_size, workers):
+    """Yield the results of validate_chunk in input order, validating up to 2 * workers chunks ahead."""
+    chunks = read_chunks(stream, chunk_size)
+    if workers <= 1:
+        yield from map(validate_chunk, chunks)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(validate_chunk, chunk))
+            # Bounded read-ahead keeps memory flat however large the input is
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def import_users(store, stream, chunk_size=5000, workers=None, report=None):
+    """Stream users from NDJSON lines into a store; return (imported, errors).
+
+    report, if given, is called with (line number, error) for each
+    rejected record.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    imported = 0
+    errors = 0
+    seen_ids = set(store.users)
+    # Millions of new objects and no cycles among them: let the collector rest
+    with paused_gc():
+        for records, chunk_errors in validated_chunks(stream, chunk_size, workers):
+            batch = []
+            for line_number, fields in records:
+                user_id = fields[0]
+                if user_id is None:
+                    user_id = store.allocate_id()
+                elif user_id in seen_ids:
+                    errors += 1
+                    if report:
+                        report(line_number, f"duplicate id {user_id}")
+                    continue
+                else:
+                    # Keep later allocations clear of the ids given in the input
+                    store.next_user_id = max(store.next_user_id, user_id + 1)
+                seen_ids.add(user_id)
+                batch.append(UserRecord(user_id, *fields[1:]))
+            # Committed per chunk without indexing; indexes are built once at the end
+            store.load(batch)
+            imported += len(batch)
+            errors += len(chunk_errors)
+            if report:
+                for line_number, error in chunk_errors:
+                    report(line_number, error)
+        store.rebuild_indexes()
+    return imported, errors
+
+
+def export_users(store, stream, chunk_size=65536):
+    """Write every user of a store as NDJSON in id order; return the number written."""
+    serializer = UserSerializer(max_entries=0)
+    buffer = bytearray()
+    written = 0
+    for user_id in list(store.sorted_indexes['id']):
+        user = store.get(user_id)
+        if user is None:
+            continue
+        buffer += json.dumps(serializer.to_resource(user), separators=(',', ':')).encode()
+        buffer += b'\n'
+        written += 1
+        if len(buffer) >= chunk_size:
+            stream.write(buffer)
+            buffer = bytearray()
+    stream.write(buffer)
+    stream.flush()
+    return written
+
+
+def open_store(data_dir):
+    store = UserStore()
+    persistence = Persistence(data_dir, 'async', snapshot_every=0)
+    persistence.load(store)
+    return store, persistence
+
+
+def command_import(args):
+    store, persistence = open_store(args.data_dir)
+    reported = [0]
+
+    def report(line_number, error):
+        reported[0] += 1
+        if reported[0] <= MAX_REPORTED_ERRORS:
+            where = f"line {line_number}" if line_number else "record"
+            print(f"{where}: {error}", file=sys.stderr)
+
+    stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    try:
+        imported, errors = import_users(store, stream, args.chunk_size, args.workers, report)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    # The imported users are made durable by one snapshot rather than a log entry each
+    persistence.snapshot()
+    persistence.close()
+    print(f"imported {imported} users, rejected {errors}, {len(store)} users in {args.data_dir}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def command_export(args):
+    store, persistence = open_store(args.data_dir)
+    persistence.close()
+    stream = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        written = export_users(store, stream)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+    print(f"exported {written} users", file=sys.stderr)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='load users from NDJSON into the data directory')
+    import_parser.add_argument('input', help="NDJSON file, or - for stdin")
+    import_parser.add_argument('--data-dir', default=os.environ.get('SCIM_DATA_DIR'), required=not os.environ.get('SCIM_DATA_DIR'))
+    import_parser.add_argument('--workers', type=int, default=None, help='validation processes (default: CPU count)')
+    import_parser.add_argument('--chunk-size', type=int, default=5000, help='records per validation chunk')
+    import_parser.set_defaults(func=command_import)
+
+    export_parser = subparsers.add_parser('export', help='write the users of the data directory as NDJSON')
+    export_parser.add_argument('--data-dir', default=os.environ.get('SCIM_DATA_DIR'), required=not os.environ.get('SCIM_DATA_DIR'))
+    export_parser.add_argument('-o', '--output', default='-', help="NDJSON file, or - for stdout (default)")
+    export_parser.set_defaults(func=command_export)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""SCIM PATCH operations (RFC 7644, section 3.5.2).
+
+Operations are applied to a working copy of a resource in its wire format,
+and the caller only stores the copy once every operation has succeeded, so
+a request is applied entirely or not at all. Paths such as
+`name.givenName` or `emails[type eq "work"].value` are parsed once and
+cached, since IdPs send the same handful of paths over and over.
+
+Attributes a resource does not have are ignored rather than rejected, as
+IdPs routinely send attributes (e.g. `active`) this demo does not store.
+"""
+import functools
+import json
+import re
+
+from scim_filter import And, Comparison, FilterError, compile_filter, parse_attribute_path
+
+# How an attribute combines with the value of an add or replace
+SIMPLE = 'simple'
+COMPLEX = 'complex'
+MULTI_VALUED = 'multi'
+
+OPERATIONS = ('add', 'remove', 'replace')
+
+# attribute[filter] optionally followed by .subAttribute; plain attribute
+# paths (including name.givenName) are left to parse_attribute_path
+PATH_RE = re.compile(r'^(?P<attribute>[^\[\]]+?)(?:\[(?P<filter>.+)\](?:\.(?P<sub_attribute>[^\[\].]+))?)?$')
+
+
+class PatchError(ValueError):
+    """Raised when a PATCH request cannot be applied; carries the SCIM error type."""
+
+    def __init__(self, detail, scim_type='invalidValue'):
+        super().__init__(detail)
+        self.detail = detail
+        self.scim_type = scim_type
+
+
+class PatchPath:
+    def __init__(self, attribute, value_filter=None, sub_attribute=None):
+        self.attribute = attribute
+        self.value_filter = value_filter
+        self.sub_attribute = sub_attribute
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(text):
+    """Parse a PATCH path, reusing the parsed form for repeated paths."""
+    match = PATH_RE.match(text.strip())
+    if not match:
+        raise PatchError(f"Invalid path '{text}'", 'invalidPath')
+    try:
+        names = parse_attribute_path(match.group('attribute'))
+        value_filter = None
+        if match.group('filter'):
+            value_filter = compile_filter(match.group('filter'))
+            if len(names) > 1:
+                raise FilterError(f"Invalid path '{text}'")
+            if match.group('sub_attribute'):
+                names = parse_attribute_path(f"{names[0]}.{match.group('sub_attribute')}")
+    except FilterError as e:
+        raise PatchError(str(e), 'invalidPath') from None
+    # Nesting deeper than one sub-attribute is rejected once the attribute is
+    # known to exist, see _apply
+    return PatchPath(names[0], value_filter, '.'.join(names[1:]) or None)
+
+
+def apply_operations(document, operations, attributes, read_only=('id', 'meta')):
+    """Apply the Operations of a PatchOp request to a resource document in place.
+
+    attributes maps each attribute of the resource to SIMPLE, COMPLEX or
+    MULTI_VALUED. The document must be a copy the caller can discard if
+    a PatchError is raised part way through.
+    """
+    if not isinstance(operations, list):
+        raise PatchError("Operations must be a list", 'invalidSyntax')
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise PatchError("Each operation must be an object", 'invalidSyntax')
+        op = str(operation.get('op', '')).lower()
+        if op not in OPERATIONS:
+            raise PatchError(f"Unsupported operation '{operation.get('op')}'", 'invalidSyntax')
+        path = operation.get('path')
+        value = operation.get('value')
+        if path:
+            if not isinstance(path, str):
+                raise PatchError("path must be a string", 'invalidPath')
+            if op != 'remove' and 'value' not in operation:
+                raise PatchError(f"A value is required for {op} operations")
+            _apply(document, op, compile_path(path), value, attributes, read_only)
+            continue
+
+        if op == 'remove':
+            raise PatchError("A path is required for remove operations", 'noTarget')
+        if isinstance(value, str):
+            # Some IdPs send the value object JSON encoded
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        if not isinstance(value, dict):
+            raise PatchError(f"The value of an {op} operation without a path must be an object")
+        for name, item in value.items():
+            if name != 'schemas':
+                _apply(document, op, compile_path(name), item, attributes, read_only)
+
+
+def _resolve_attribute(name, attributes):
+    if name in attributes:
+        return name
+    # Short names of the custom attributes are accepted for compatibility
+    # with earlier clients of this demo
+    if f'urn:custom:{name}' in attributes:
+        return f'urn:custom:{name}'
+    return None
+
+
+def _apply(document, op, path, value, attributes, read_only):
+    attribute = _resolve_attribute(path.attribute, attributes)
+    if attribute is None:
+        return
+    if attribute in read_only:
+        raise PatchError(f"Attribute '{attribute}' is read-only", 'mutability')
+    kind = attributes[attribute]
+    if path.sub_attribute is not None and '.' in path.sub_attribute:
+        raise PatchError(f"Invalid path into '{attribute}'", 'invalidPath')
+
+    if path.value_filter is not None:
+        if kind != MULTI_VALUED:
+            raise PatchError(f"Attribute '{attribute}' is not multi-valued", 'invalidPath')
+        _apply_selected(document, op, attribute, path, value)
+    elif path.sub_attribute is not None:
+        if kind == COMPLEX:
+            target = dict(document.get(attribute) or {})
+            if op == 'remove':
+                target.pop(path.sub_attribute, None)
+            else:
+                target[path.sub_attribute] = value
+            document[attribute] = target
+        elif kind == MULTI_VALUED:
+            # e.g. emails.value: applies to every value of the attribute
+            elements = list(document.get(attribute) or [])
+            if not elements and op != 'remove':
+                elements.append({})
+            document[attribute] = [_set_sub_attribute(element, path.sub_attribute, op, value)
+                                   for element in elements]
+        else:
+            raise PatchError(f"Attribute '{attribute}' has no sub-attributes", 'invalidPath')
+    elif op == 'remove':
+        document.pop(attribute, None)
+    elif kind == MULTI_VALUED:
+        values = value if isinstance(value, list) else [value]
+        if op == 'replace':
+            document[attribute] = list(values)
+        else:
+            existing = list(document.get(attribute) or [])
+            for item in values:
+                if not _contains(existing, item):
+                    existing.append(item)
+            document[attribute] = existing
+    elif kind == COMPLEX:
+        if not isinstance(value, dict):
+            raise PatchError(f"The value of '{attribute}' must be an object")
+        # Sub-attributes that are not given are left unchanged, for add and replace alike
+        target = dict(document.get(attribute) or {})
+        for name, item in value.items():
+            target[_sub_attribute_name(attribute, name)] = item
+        document[attribute] = target
+    else:
+        document[attribute] = value
+
+
+def _apply_selected(document, op, attribute, path, value):
+    """Apply an operation to the values of a multi-valued attribute matching attr[filter]."""
+    elements = list(document.get(attribute) or [])
+    selected = [index for index, element in enumerate(elements) if path.value_filter.match(_as_complex(element))]
+    sub_attribute = path.sub_attribute
+
+    if op == 'remove':
+        if sub_attribute is None:
+            selected = set(selected)
+            document[attribute] = [element for index, element in enumerate(elements) if index not in selected]
+        else:
+            for index in selected:
+                elements[index] = _set_sub_attribute(elements[index], sub_attribute, op, value)
+            document[attribute] = elements
+        return
+
+    if sub_attribute is None:
+        if op == 'add':
+            raise PatchError("A value selection filter is not allowed for add without a sub-attribute",
+                             'invalidPath')
+        if not selected:
+            raise PatchError(f"No values of '{attribute}' match the filter", 'noTarget')
+        for index in selected:
+            elements[index] = value
+    elif selected:
+        for index in selected:
+            elements[index] = _set_sub_attribute(elements[index], sub_attribute, op, value)
+    else:
+        # IdPs set e.g. emails[type eq "work"].value on users without a work
+        # address; the equality terms of the filter describe the new value
+        template = equality_terms(path.value_filter)
+        if template is None:
+            raise PatchError(f"No values of '{attribute}' match the filter", 'noTarget')
+        elements.append(_set_sub_attribute(template, sub_attribute, op, value))
+    document[attribute] = elements
+
+
+def _as_complex(element):
+    # Values of multi-valued simple attributes are filtered on as {"value": ...}
+    return element if isinstance(element, dict) else {'value': element}
+
+
+def _set_sub_attribute(element, sub_attribute, op, value):
+    if not isinstance(element, dict):
+        if sub_attribute != 'value':
+            raise PatchError(f"Values have no sub-attribute '{sub_attribute}'", 'invalidPath')
+        if op == 'remove':
+            raise PatchError("Cannot remove the value of a simple multi-valued attribute", 'invalidPath')
+        return value
+    element = dict(element)
+    if op == 'remove':
+        element.pop(sub_attribute, None)
+    else:
+        element[sub_attribute] = value
+    return element
+
+
+def _contains(values, item):
+    # Complex values with a "value" are the same value when their "value" matches
+    if isinstance(item, dict) and 'value' in item:
+        return any(isinstance(value, dict) and value.get('value') == item['value'] for value in values)
+    return item in values
+
+
+def _sub_attribute_name(attribute, name):
+    return parse_attribute_path(f'{attribute}.{name}')[1] if isinstance(name, str) and name else name
+
+
+def equality_terms(node):
+    """Return {sub-attribute: value} for a filter made only of `eq` terms joined by `and`."""
+    if isinstance(node, Comparison) and node.op == 'eq' and len(node.path) == 1:
+        return {node.path[0]: node.literal}
+    if isinstance(node, And):
+        left = equality_terms(node.left)
+        right = equality_terms(node.right)
+        if left is not None and right is not None:
+            return dict(left, **right)
+    return None
@@ -0,0 +1,292 @@
+"""Durable storage for the demo SCIM server.
+
+Every change to the user store is appended to an operation log, and the
+whole store is periodically written to a compacted snapshot. On startup
+the latest snapshot is loaded and only the log entries written after it
+are replayed.
+
+Layout of the data directory:
+    snapshot.ndjson      header line {"seq": S, "nextUserId": N}, then one user per line
+    oplog-<n>.ndjson     log segments, one JSON entry per line, n increasing
+
+Durability modes:
+    always  write and fsync each entry before the request returns
+    batch   group commit: a background thread fsyncs whatever entries have
+            accumulated, and each request waits for the fsync covering its entry
+    async   the background thread fsyncs every flush interval and requests
+            never wait (a crash can lose the last interval of changes)
+"""
+import json
+import logging
+import os
+import re
+import threading
+
+from scim_store import UserRecord
+
+DURABILITY_MODES = ('always', 'batch', 'async')
+SEGMENT_RE = re.compile(r'^oplog-(\d+)\.ndjson$')
+
+
+def _dumps(document):
+    return (json.dumps(document, separators=(',', ':')) + '\n').encode()
+
+
+def _fsync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def encode_user(user):
+    return {"user": user.to_dict(), "version": user.version,
+            "created": user.created, "lastModified": user.last_modified}
+
+
+def decode_user(entry):
+    user = UserRecord.from_dict(entry['user'])
+    user.version = entry['version']
+    # Entries written before timestamps were recorded have none
+    user.created = entry.get('created')
+    user.last_modified = entry.get('lastModified')
+    return user
+
+
+class OperationLog:
+    """An append-only log of JSON entries split into numbered segment files."""
+
+    def __init__(self, directory, segment, durability='batch', flush_interval=0.005):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode '{durability}'")
+        self.directory = directory
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.segment = segment
+        self.file = open(self._segment_path(segment), 'ab')
+        self.last_seq = 0
+        self.durable_seq = 0
+        self.buffer = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        # Serializes writes to the segment file between the flusher and rotate()
+        self.io_lock = threading.Lock()
+        self.flusher = None
+        if durability != 'always':
+            self.flusher = threading.Thread(target=self._flush_loop, name='scim-oplog-flusher', daemon=True)
+            self.flusher.start()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f'oplog-{segment}.ndjson')
+
+    def append(self, entry):
+        """Append an entry and return its sequence number."""
+        if self.durability == 'always':
+            # Same lock order as flush() and rotate(): io_lock, then lock
+            with self.io_lock, self.lock:
+                seq = self._assign_seq(entry)
+                self.file.write(_dumps(entry))
+                _fsync(self.file)
+                self.durable_seq = seq
+            return seq
+        with self.lock:
+            seq = self._assign_seq(entry)
+            self.buffer.append(_dumps(entry))
+            if self.durability == 'batch':
+                self.condition.notify_all()
+            return seq
+
+    def _assign_seq(self, entry):
+        self.last_seq += 1
+        entry['seq'] = self.last_seq
+        return self.last_seq
+
+    def wait(self, seq):
+        """Block until the entry with the given sequence number is on disk (batch mode)."""
+        if self.durability != 'batch':
+            return
+        with self.condition:
+            while self.durable_seq < seq and not self.closed:
+                self.condition.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                if self.durability == 'batch':
+                    while not self.buffer and not self.closed:
+                        self.condition.wait()
+                else:
+                    self.condition.wait(self.flush_interval)
+                if self.closed and not self.buffer:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                seq = self.last_seq
+            if lines:
+                # Appends keep going while this group is written and fsynced
+                self.file.write(b''.join(lines))
+                _fsync(self.file)
+        with self.condition:
+            self.durable_seq = max(self.durable_seq, seq)
+            self.condition.notify_all()
+
+    def rotate(self):
+        """Start a new segment and return the sequence number the old one ends at."""
+        with self.io_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                seq = self.last_seq
+                self.file.write(b''.join(lines))
+                _fsync(self.file)
+                self.file.close()
+                self.segment += 1
+                self.file = open(self._segment_path(self.segment), 'ab')
+                self.durable_seq = seq
+                self.condition.notify_all()
+        return seq
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        self.file.close()
+
+
+class Persistence:
+    """Keeps a UserStore durable through an operation log and snapshots.
+
+    Register it as a store listener after load(); the store then reports
+    every put and delete, and request handlers call sync() before replying
+    so the change is as durable as the configured mode promises.
+    """
+
+    def __init__(self, directory, durability='batch', snapshot_every=100000, flush_interval=0.005):
+        self.directory = directory
+        self.durability = durability
+        self.snapshot_every = snapshot_every
+        self.flush_interval = flush_interval
+        self.store = None
+        self.log = None
+        self.entries_since_snapshot = 0
+        self.snapshot_thread = None
+        self.snapshot_lock = threading.Lock()
+        self.local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot.ndjson')
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def load(self, store):
+        """Fill an empty store from the snapshot and the log tail, then open a new segment."""
+        users = {}
+        snapshot_seq = 0
+        next_user_id = 1
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as file:
+                header = json.loads(file.readline())
+                snapshot_seq = header['seq']
+                next_user_id = header['nextUserId']
+                for line in file:
+                    user = decode_user(json.loads(line))
+                    users[user.id] = user
+
+        last_seq = snapshot_seq
+        replayed = 0
+        segments = self._segments()
+        for segment in segments:
+            path = os.path.join(self.directory, f'oplog-{segment}.ndjson')
+            with open(path, 'rb') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of a segment after a crash
+                        logging.warning("Ignoring truncated entry in %s", path)
+                        break
+                    if entry['seq'] <= snapshot_seq:
+                        continue
+                    last_seq = entry['seq']
+                    replayed += 1
+                    if entry['op'] == 'put':
+                        user = decode_user(entry)
+                        users[user.id] = user
+                        next_user_id = max(next_user_id, user.id + 1)
+                    elif entry['op'] == 'delete':
+                        users.pop(entry['id'], None)
+
+        # Build every index in one pass instead of replaying changes one by one
+        store.add_many(list(users.values()))
+        store.next_user_id = max(store.next_user_id, next_user_id)
+        self.store = store
+        self.entries_since_snapshot = replayed
+        self.log = OperationLog(self.directory, (segments[-1] + 1) if segments else 1,
+                                self.durability, self.flush_interval)
+        self.log.last_seq = self.log.durable_seq = last_seq
+        logging.info("Loaded %d users from %s (%d log entries replayed)", len(users), self.directory, replayed)
+
+    def on_put(self, user):
+        self._append(dict(encode_user(user), op='put'))
+
+    def on_delete(self, user):
+        self._append({"op": "delete", "id": user.id})
+
+    def _append(self, entry):
+        self.local.seq = self.log.append(entry)
+        self.entries_since_snapshot += 1
+        if self.snapshot_every and self.entries_since_snapshot >= self.snapshot_every:
+            self.snapshot_in_background()
+
+    def sync(self):
+        """Wait until the changes made by the current thread are durable."""
+        seq = getattr(self.local, 'seq', None)
+        if seq is not None:
+            self.log.wait(seq)
+
+    def snapshot_in_background(self):
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            return
+        self.entries_since_snapshot = 0
+        self.snapshot_thread = threading.Thread(target=self.snapshot, name='scim-snapshot', daemon=True)
+        self.snapshot_thread.start()
+
+    def snapshot(self):
+        """Write a compacted snapshot of the store and drop the log segments it covers."""
+        with self.snapshot_lock:
+            with self.store.lock:
+                # Records are replaced rather than mutated, so a shallow copy
+                # taken under the lock is a consistent view of the store
+                seq = self.log.rotate()
+                users = list(self.store.values())
+                next_user_id = self.store.next_user_id
+                first_live_segment = self.log.segment
+            temporary_path = self.snapshot_path + '.tmp'
+            with open(temporary_path, 'wb') as file:
+                file.write(_dumps({"seq": seq, "nextUserId": next_user_id}))
+                for user in users:
+                    file.write(_dumps(encode_user(user)))
+                _fsync(file)
+            os.replace(temporary_path, self.snapshot_path)
+            for segment in self._segments():
+                if segment < first_live_segment:
+                    os.remove(os.path.join(self.directory, f'oplog-{segment}.ndjson'))
+            logging.info("Wrote snapshot of %d users at seq %d", len(users), seq)
+
+    def close(self):
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        self.log.close()
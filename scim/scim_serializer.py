@@ -0,0 +1,112 @@
+"""JSON encoding of SCIM resources with cached response bodies.
+
+Static discovery documents are encoded once, and each user's encoded
+resource is cached until the user changes, so reads and list pages are
+mostly a matter of joining bytes that already exist.
+"""
+import collections
+import hashlib
+import json
+import threading
+
+from scim_store import format_timestamp
+
+USER_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:User"
+LIST_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:ListResponse"
+
+
+def dumps(document):
+    return json.dumps(document, separators=(',', ':')).encode()
+
+
+def user_etag(user):
+    # Weak entity tag derived from the record version, as used in meta.version
+    return f'W/"{user.version}"'
+
+
+class EncodedDocument:
+    """A document encoded once, with an entity tag derived from its content."""
+
+    def __init__(self, document):
+        self.body = dumps(document)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+class UserSerializer:
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        # user ID -> (version, encoded resource), least recently used first
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def to_resource(self, user):
+        return {
+            "schemas": [USER_SCHEMA],
+            "id": user['id'],
+            "externalId": user['externalId'],
+            "userName": user['userName'],
+            "name": user['name'],
+            "email": user['email'],
+            "urn:custom:role": user['urn:custom:role'],
+            "urn:custom:remoteId": user['urn:custom:remoteId'],
+            "urn:custom:accessLevels": user['urn:custom:accessLevels'],
+            "urn:custom:idpId": user['urn:custom:idpId'],
+            "meta": {
+                "resourceType": "User",
+                "created": format_timestamp(user.created),
+                "lastModified": format_timestamp(user.last_modified),
+                "version": user_etag(user)
+            }
+        }
+
+    def encode(self, user, remember=True):
+        """Return the encoded resource of a user, reusing the cached bytes if current.
+
+        With remember=False a freshly encoded resource is not added to the
+        cache, so one large export does not evict the users being polled.
+        """
+        user_id = user.id
+        with self.lock:
+            cached = self.cache.get(user_id)
+            if cached is not None and cached[0] == user.version:
+                self.cache.move_to_end(user_id)
+                return cached[1]
+        body = dumps(self.to_resource(user))
+        if not remember:
+            return body
+        with self.lock:
+            self.cache[user_id] = (user.version, body)
+            self.cache.move_to_end(user_id)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return body
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.cache.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def iter_list(self, listing, chunk_size=65536, remember=True):
+        """Encode a ListResponse incrementally, splicing in the cached resources.
+
+        listing is iterated for the users of the page and provides
+        head_fields, emitted before the resources, and tail_fields(),
+        emitted after them. Output is yielded in chunks of about chunk_size
+        bytes, so memory stays flat however many users the page holds.
+        """
+        header = dumps(dict({"schemas": [LIST_RESPONSE_SCHEMA]}, **listing.head_fields))
+        chunk = bytearray(header[:-1] + b',"Resources":[')
+        separator = b''
+        for user in listing:
+            chunk += separator
+            chunk += self.encode(user, remember)
+            separator = b','
+            if len(chunk) >= chunk_size:
+                yield bytes(chunk)
+                chunk = bytearray()
+        tail = dumps(listing.tail_fields())
+        chunk += b'],' + tail[1:] if tail != b'{}' else b']}'
+        yield bytes(chunk)
@@ -0,0 +1,429 @@
+"""In-memory user store for the demo SCIM server.
+
+Users are kept in a dict keyed by ID, alongside secondary hash indexes on
+the attributes IdPs look users up by, so equality filters on those
+attributes are answered without scanning the whole directory. Sortable
+attributes also have ordered indexes (sorted lists of (key, id) entries),
+so a page of results is a slice of an index rather than a sort of every
+user.
+
+Each user is held as a compact UserRecord rather than a dict of dicts;
+to_dict()/from_dict() convert to and from the wire format used by the
+handlers.
+
+Thread safety: records are never modified once stored. A change builds a
+new record and swaps it in with replace(), which can be made conditional
+on the record the change was derived from (compare-and-swap), so readers
+never take a lock and concurrent PATCHes of one user cannot lose updates.
+Index maintenance is serialized by the store lock, and IDs come from an
+allocator with its own lock.
+"""
+import bisect
+import contextlib
+import gc
+import sys
+import threading
+import time
+
+# Attributes with a secondary index (value -> set of user IDs), and the
+# UserRecord slot each one is read from
+INDEXED_ATTRIBUTES = {
+    'userName': 'user_name',
+    'externalId': 'external_id',
+    'email': 'email',
+    'urn:custom:idpId': 'idp_id',
+}
+
+# Attributes with an ordered index by sortBy name, and their UserRecord slot
+SORTABLE_ATTRIBUTES = {
+    'id': 'id',
+    'userName': 'user_name',
+    'externalId': 'external_id',
+    'email': 'email',
+    'name.givenName': 'given_name',
+    'name.familyName': 'family_name',
+}
+
+
+def index_key(value):
+    # Indexed attributes are not caseExact, so keys are stored lowercase
+    if isinstance(value, str):
+        return value.lower()
+    return value
+
+
+def sort_key(user, attribute):
+    value = getattr(user, SORTABLE_ATTRIBUTES[attribute])
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value.lower()
+    return str(value)
+
+
+# Single-valued string attributes and the record slot holding each of them
+ATTRIBUTE_SLOTS = {
+    'id': 'id',
+    'externalId': 'external_id',
+    'userName': 'user_name',
+    'email': 'email',
+    'urn:custom:role': 'role',
+    'urn:custom:remoteId': 'remote_id',
+    'urn:custom:idpId': 'idp_id',
+}
+
+
+def format_timestamp(timestamp):
+    # SCIM DateTime (xsd:dateTime) in UTC with millisecond precision
+    if timestamp is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f'.{int(timestamp * 1000) % 1000:03d}Z'
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """Pause the cyclic garbage collector during a bulk load.
+
+    The collector would otherwise run over and over while millions of
+    records and index entries are allocated, none of which form cycles.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _intern(value):
+    # Roles and access levels come from a handful of canonical values,
+    # so every record can share the same string objects
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserRecord:
+    """A user as stored in memory.
+
+    Slots avoid a per-instance __dict__, and the name and access levels are
+    flattened into the record instead of living in nested containers. The
+    read accessors mirror a dict (get, [], in) so filters, indexes and
+    templates can treat a record like the wire-format user.
+    """
+    __slots__ = ('id', 'external_id', 'user_name', 'given_name', 'family_name',
+                 'email', 'role', 'remote_id', 'access_levels', 'idp_id', 'version',
+                 'created', 'last_modified')
+
+    def __init__(self, id, external_id, user_name, given_name, family_name,
+                 email, role, remote_id, access_levels, idp_id, version=1,
+                 created=None, last_modified=None):
+        self.id = id
+        self.external_id = external_id
+        self.user_name = user_name
+        self.given_name = given_name
+        self.family_name = family_name
+        self.email = email
+        self.role = _intern(role)
+        self.remote_id = remote_id
+        self.access_levels = tuple(_intern(level) for level in access_levels)
+        self.idp_id = idp_id
+        # Bumped on every change, exposed as meta.version / ETag
+        self.version = version
+        # Epoch seconds, exposed as meta.created / meta.lastModified
+        self.created = created
+        self.last_modified = last_modified
+
+    @classmethod
+    def from_dict(cls, user):
+        name = user.get('name') or {}
+        return cls(
+            user['id'],
+            user.get('externalId', ''),
+            user.get('userName', ''),
+            name.get('givenName', ''),
+            name.get('familyName', ''),
+            user.get('email', ''),
+            user.get('urn:custom:role', 'member'),
+            user.get('urn:custom:remoteId', ''),
+            user.get('urn:custom:accessLevels') or (),
+            user.get('urn:custom:idpId', ''),
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "externalId": self.external_id,
+            "userName": self.user_name,
+            "name": {
+                "givenName": self.given_name,
+                "familyName": self.family_name
+            },
+            "email": self.email,
+            "urn:custom:role": self.role,
+            "urn:custom:remoteId": self.remote_id,
+            "urn:custom:accessLevels": list(self.access_levels),
+            "urn:custom:idpId": self.idp_id
+        }
+
+    def get(self, attribute, default=None):
+        slot = ATTRIBUTE_SLOTS.get(attribute)
+        if slot is not None:
+            return getattr(self, slot)
+        if attribute == 'name':
+            return {"givenName": self.given_name, "familyName": self.family_name}
+        if attribute == 'urn:custom:accessLevels':
+            return list(self.access_levels)
+        if attribute == 'meta':
+            # Lets filters such as `meta.lastModified gt "..."` find recent changes
+            return {
+                "created": format_timestamp(self.created),
+                "lastModified": format_timestamp(self.last_modified),
+                "version": f'W/"{self.version}"'
+            }
+        return default
+
+    def __getitem__(self, attribute):
+        if attribute not in self:
+            raise KeyError(attribute)
+        return self.get(attribute)
+
+    def __contains__(self, attribute):
+        return attribute in ATTRIBUTE_SLOTS or attribute in ('name', 'urn:custom:accessLevels', 'meta')
+
+
+class UserStore:
+    # Attributes lookup() answers from an index
+    indexed_attributes = frozenset(INDEXED_ATTRIBUTES) | {'id'}
+    # Entries iter_sorted reads from an ordered index per hold of the lock
+    ITER_CHUNK = 256
+
+    def __init__(self):
+        self.users = {}
+        self.next_user_id = 1
+        self.id_lock = threading.Lock()
+        self.indexes = {attribute: {} for attribute in INDEXED_ATTRIBUTES}
+        # IDs are allocated in increasing order, so the id index holds plain IDs
+        self.sorted_indexes = {attribute: [] for attribute in SORTABLE_ATTRIBUTES}
+        # Held by every change; writers that apply several changes as one unit
+        # (e.g. Bulk) hold it across the whole batch
+        self.lock = threading.RLock()
+        # Objects notified of each change through on_put(user) / on_delete(user)
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def allocate_id(self):
+        with self.id_lock:
+            user_id = self.next_user_id
+            self.next_user_id += 1
+            return user_id
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def values(self):
+        return self.users.values()
+
+    def add(self, user):
+        with self.lock:
+            self.users[user.id] = user
+            self._index(user)
+            for attribute in SORTABLE_ATTRIBUTES:
+                bisect.insort(self.sorted_indexes[attribute], self.sort_entry(attribute, user))
+            for listener in self.listeners:
+                listener.on_put(user)
+
+    def add_many(self, users):
+        """Add a batch of users, merging their sort entries into each ordered index at once."""
+        with self.lock:
+            for user in users:
+                self.users[user.id] = user
+                self._index(user)
+            for attribute, index in self.sorted_indexes.items():
+                index.extend(self.sort_entry(attribute, user) for user in users)
+                # Timsort merges the appended run with the existing sorted run in linear time
+                index.sort()
+            for listener in self.listeners:
+                for user in users:
+                    listener.on_put(user)
+
+    def load(self, users):
+        """Add users without indexing them or notifying listeners.
+
+        For offline loads: call rebuild_indexes() once every batch is in.
+        """
+        with self.lock:
+            for user in users:
+                self.users[user.id] = user
+                if user.id >= self.next_user_id:
+                    self.next_user_id = user.id + 1
+
+    def rebuild_indexes(self):
+        """Build every index from scratch in one pass over the users."""
+        with paused_gc(), self.lock:
+            users = list(self.users.values())
+            for attribute, slot in INDEXED_ATTRIBUTES.items():
+                index = {}
+                for user in users:
+                    key = index_key(getattr(user, slot))
+                    if key not in (None, ''):
+                        ids = index.get(key)
+                        if ids is None:
+                            index[key] = {user.id}
+                        else:
+                            ids.add(user.id)
+                self.indexes[attribute] = index
+            for attribute in SORTABLE_ATTRIBUTES:
+                if attribute == 'id':
+                    self.sorted_indexes[attribute] = sorted(self.users)
+                else:
+                    entries = [(sort_key(user, attribute), user.id) for user in users]
+                    entries.sort()
+                    self.sorted_indexes[attribute] = entries
+
+    def replace(self, user_id, user, expected=None):
+        """Swap in a new version of a user, updating only the indexes that changed.
+
+        If expected is given, the swap only happens while it is still the
+        stored record; returns whether the user was replaced.
+        """
+        with self.lock:
+            old_user = self.users.get(user_id)
+            if old_user is None or (expected is not None and old_user is not expected):
+                return False
+            for attribute, slot in INDEXED_ATTRIBUTES.items():
+                old_key = index_key(getattr(old_user, slot))
+                new_key = index_key(getattr(user, slot))
+                if old_key != new_key:
+                    self._unindex_value(attribute, old_key, user_id)
+                    self._index_value(attribute, new_key, user_id)
+            for attribute in SORTABLE_ATTRIBUTES:
+                old_entry = self.sort_entry(attribute, old_user)
+                new_entry = self.sort_entry(attribute, user)
+                if old_entry != new_entry:
+                    self._remove_sort_entry(attribute, old_entry)
+                    bisect.insort(self.sorted_indexes[attribute], new_entry)
+            self.users[user_id] = user
+            for listener in self.listeners:
+                listener.on_put(user)
+            return True
+
+    def delete(self, user_id):
+        with self.lock:
+            user = self.users.pop(user_id, None)
+            if user is None:
+                return None
+            for attribute, slot in INDEXED_ATTRIBUTES.items():
+                self._unindex_value(attribute, index_key(getattr(user, slot)), user_id)
+            for attribute in SORTABLE_ATTRIBUTES:
+                self._remove_sort_entry(attribute, self.sort_entry(attribute, user))
+            for listener in self.listeners:
+                listener.on_delete(user)
+            return user
+
+    def lookup(self, attribute, value):
+        """Return the set of user IDs whose attribute equals value, or None if it is not indexed."""
+        if attribute == 'id':
+            try:
+                user_id = int(value)
+            except (TypeError, ValueError):
+                return set()
+            return {user_id} if user_id in self.users else set()
+        index = self.indexes.get(attribute)
+        if index is None:
+            return None
+        return set(index.get(index_key(value), ()))
+
+    def sort_entry(self, attribute, user):
+        """Return the entry a user occupies in the ordered index of an attribute."""
+        if attribute == 'id':
+            return user.id
+        return (sort_key(user, attribute), user.id)
+
+    def page(self, attribute, descending, start, count):
+        """Return the users at positions [start, start + count) of an ordered index."""
+        index = self.sorted_indexes[attribute]
+        if descending:
+            stop = max(len(index) - start, 0)
+            entries = index[max(stop - count, 0):stop][::-1]
+        else:
+            entries = index[start:start + count]
+        users = (self.users.get(self._entry_id(entry)) for entry in entries)
+        # Skip users deleted since the slice was taken
+        return [user for user in users if user is not None]
+
+    def iter_sorted(self, attribute, descending=False, after=None):
+        """Yield users in index order, resuming strictly after an entry if given.
+
+        Entries are sliced off the index a chunk at a time under the lock, and
+        each chunk resumes by bisecting from the last entry read rather than
+        from a position, so users added or removed meanwhile never make the
+        walk skip or repeat one.
+        """
+        last = after
+        while True:
+            with self.lock:
+                index = self.sorted_indexes[attribute]
+                if descending:
+                    stop = len(index) if last is None else bisect.bisect_left(index, last)
+                    entries = index[max(stop - self.ITER_CHUNK, 0):stop][::-1]
+                else:
+                    start = 0 if last is None else bisect.bisect_right(index, last)
+                    entries = index[start:start + self.ITER_CHUNK]
+            if not entries:
+                return
+            last = entries[-1]
+            for entry in entries:
+                user = self.users.get(self._entry_id(entry))
+                # Skip users deleted since the chunk was taken
+                if user is not None:
+                    yield user
+
+    def iter_prefix(self, attribute, prefix):
+        """Yield users whose key in an ordered index starts with prefix, in index order."""
+        index = self.sorted_indexes[attribute]
+        prefix = prefix.lower()
+        # (prefix,) sorts right before every (key, id) entry whose key starts with prefix
+        position = bisect.bisect_left(index, (prefix,))
+        while True:
+            try:
+                key, user_id = index[position]
+            except IndexError:
+                return
+            if not key.startswith(prefix):
+                return
+            user = self.users.get(user_id)
+            if user is not None:
+                yield user
+            position += 1
+
+    @staticmethod
+    def _entry_id(entry):
+        return entry if isinstance(entry, int) else entry[1]
+
+    def _remove_sort_entry(self, attribute, entry):
+        index = self.sorted_indexes[attribute]
+        position = bisect.bisect_left(index, entry)
+        if position < len(index) and index[position] == entry:
+            del index[position]
+
+    def _index(self, user):
+        for attribute, slot in INDEXED_ATTRIBUTES.items():
+            self._index_value(attribute, index_key(getattr(user, slot)), user.id)
+
+    def _index_value(self, attribute, key, user_id):
+        if key in (None, ''):
+            return
+        self.indexes[attribute].setdefault(key, set()).add(user_id)
+
+    def _unindex_value(self, attribute, key, user_id):
+        ids = self.indexes[attribute].get(key)
+        if ids is None:
+            return
+        ids.discard(user_id)
+        if not ids:
+            del self.indexes[attribute][key]
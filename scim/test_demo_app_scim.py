@@ -0,0 +1,122 @@
+import base64
+import io
+import json
+
+import pytest
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import demo_app_scim
+
+
+def cursor(*payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+@pytest.fixture
+def client():
+    return demo_app_scim.app.test_client()
+
+
+@pytest.mark.parametrize('sort_by, value', [
+    ('userName', cursor('userName', False, [1, 'x'])),
+    ('userName', cursor('userName', False, ['x', 'y'])),
+    ('userName', cursor('userName', False, ['x', True])),
+    ('userName', cursor('userName', False, ['x', 1, 2])),
+    ('userName', cursor('userName', 0, ['x', 1])),
+    ('userName', cursor('email', False, ['x', 1])),
+    ('userName', cursor('userName', False, 1)),
+    ('id', cursor('id', False, ['x', 1])),
+    ('id', cursor('id', False, True)),
+    ('id', cursor('id', False, '1')),
+    ('id', cursor(['id'], False, 1)),
+    ('id', cursor({'id': 1})),
+    ('id', 'not base64 json'),
+])
+def test_malformed_cursor_is_rejected(client, sort_by, value):
+    response = client.get('/scim/v2/Users', query_string={'sortBy': sort_by, 'cursor': value})
+    assert response.status_code == 400
+    assert response.get_json()['scimType'] == 'invalidCursor'
+
+
+@pytest.mark.parametrize('query', [
+    {'sortBy': 'a..b'},
+    {'sortBy': 'name.'},
+    {'sortBy': 'password'},
+    {'count': 'ten'},
+])
+def test_malformed_listing_parameter_is_rejected(client, query):
+    response = client.get('/scim/v2/Users', query_string=query)
+    assert response.status_code == 400
+    assert response.get_json()['scimType'] == 'invalidValue'
+
+def test_cursor_pages_through_users(client):
+    for name in ('cursor-a', 'cursor-b', 'cursor-c'):
+        client.post('/scim/v2/Users', json={'userName': name, 'emails': [{'value': f'{name}@example.com'}]})
+    names = []
+    query = {'sortBy': 'userName', 'filter': 'userName sw "cursor-"', 'count': 1, 'cursor': ''}
+    while True:
+        page = client.get('/scim/v2/Users', query_string=query).get_json()
+        names += [user['userName'] for user in page['Resources']]
+        if not page.get('nextCursor'):
+            break
+        query['cursor'] = page['nextCursor']
+    assert names == ['cursor-a', 'cursor-b', 'cursor-c']
+
+
+@pytest.mark.parametrize('operation', [
+    'not an object',
+    {'method': 'POST', 'path': '/Users', 'bulkId': 'x', 'data': 'not an object'},
+    {'method': 'POST', 'path': '/Users', 'bulkId': 'x', 'data': {'name': 'not an object'}},
+    {'method': 'POST', 'path': '/Users', 'bulkId': ['x'], 'data': {}},
+    {'method': 'PATCH', 'path': ['/Users/1'], 'data': {}},
+    {'method': 1, 'path': '/Users'},
+])
+def test_malformed_bulk_operation_fails_alone(client, operation):
+    created = {'method': 'POST', 'path': '/Users', 'bulkId': 'ok', 'data': {'userName': 'bulk-kept'}}
+    response = client.post('/scim/v2/Bulk', json={'Operations': [created, operation]})
+    assert response.status_code == 200
+    results = response.get_json()['Operations']
+    assert results[0]['status'] == '201'
+    assert results[1]['status'] == '400'
+    user_id = results[0]['location'].rsplit('/', 1)[1]
+    assert client.get(f'/scim/v2/Users/{user_id}').status_code == 200
+
+
+@pytest.mark.parametrize('fail_on_errors', ['1', 0, -1, True, 1.5])
+def test_invalid_fail_on_errors_is_rejected(client, fail_on_errors):
+    response = client.post('/scim/v2/Bulk', json={'failOnErrors': fail_on_errors, 'Operations': []})
+    assert response.status_code == 400
+    assert response.get_json()['scimType'] == 'invalidValue'
+
+
+def test_chunked_bulk_body_is_held_to_max_payload_size():
+    body = json.dumps({'Operations': [], 'padding': 'x' * demo_app_scim.app.config['SCIM_BULK_MAX_PAYLOAD_SIZE']})
+    environ = EnvironBuilder('/scim/v2/Bulk', method='POST', input_stream=io.BytesIO(body.encode()),
+                             headers={'Content-Type': 'application/json', 'Transfer-Encoding': 'chunked'}).get_environ()
+    # As a server passes a chunked body on: read to the end, with no length
+    del environ['CONTENT_LENGTH']
+    environ['wsgi.input_terminated'] = True
+    _, status, _ = run_wsgi_app(demo_app_scim.app, environ)
+    assert status.startswith('413')
+
+
+def patch_user(client, user_id, *operations):
+    return client.patch(f'/scim/v2/Users/{user_id}', json={
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'], 'Operations': list(operations)})
+
+
+def test_patch_adding_a_primary_email_replaces_the_old_one(client):
+    user = client.post('/scim/v2/Users', json={'userName': 'primary-swap',
+                                               'emails': [{'value': 'old@example.com'}]}).get_json()
+    response = patch_user(client, user['id'], {'op': 'add', 'path': 'emails',
+                                               'value': [{'value': 'new@example.com', 'primary': True}]})
+    assert response.status_code == 200
+    assert response.get_json()['email'] == 'new@example.com'
+
+
+def test_patch_keeps_the_case_of_filter_values(client):
+    user = client.post('/scim/v2/Users', json={'userName': 'filter-case'}).get_json()
+    response = patch_user(client, user['id'], {'op': 'replace', 'path': 'emails[value eq "Jane.Doe@Example.com"].type',
+                                               'value': 'work'})
+    assert response.status_code == 200
+    assert response.get_json()['email'] == 'Jane.Doe@Example.com'
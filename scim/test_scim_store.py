@@ -0,0 +1,23 @@
+import pytest
+
+from scim_store import UserRecord, UserStore
+
+
+def make_store(*names):
+    store = UserStore()
+    for name in names:
+        store.add(UserRecord.from_dict({'id': store.allocate_id(), 'userName': name}))
+    return store
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_changes_during_a_walk_neither_skip_nor_repeat_users(monkeypatch, descending):
+    monkeypatch.setattr(UserStore, 'ITER_CHUNK', 2)
+    store = make_store('b', 'd', 'f', 'h')
+    walk = store.iter_sorted('userName', descending)
+    seen = [next(walk).user_name]
+    # Shift every position: one user before the walk, one deleted behind it
+    store.add(UserRecord.from_dict({'id': store.allocate_id(), 'userName': 'i' if descending else 'a'}))
+    store.delete(next(user.id for user in store.users.values() if user.user_name == seen[0]))
+    seen += [user.user_name for user in walk]
+    assert seen == (['h', 'f', 'd', 'b'] if descending else ['b', 'd', 'f', 'h'])